@@ -0,0 +1,192 @@
+"""
+异步数据库管理器模块
+基于mysql.connector.aio的asyncio版本数据库节点与连接池
+"""
+import asyncio
+import time
+from typing import Dict, List, Optional, Tuple
+from mysql.connector import aio as mysql_aio
+from config import DatabaseConfig
+from logger import database_logger, log_connection_event, log_database_operation
+
+class AsyncPooledConnection:
+    """异步池化连接，close()时归还连接池"""
+
+    def __init__(self, node: 'AsyncDatabaseNode', connection):
+        self._node = node
+        self._connection = connection
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    async def close(self):
+        """归还连接"""
+        if not self._released:
+            self._released = True
+            await self._node.release(self._connection)
+
+    async def discard(self):
+        """丢弃连接：语句被取消、连接状态未知时关闭底层连接而不归还连接池"""
+        if not self._released:
+            self._released = True
+            await self._node.discard(self._connection)
+
+class AsyncDatabaseNode:
+    """异步数据库节点类"""
+
+    def __init__(self, node_id: str, config: Dict, pool_size: int = None):
+        self.node_id = node_id
+        self.config = config
+        self.pool_size = pool_size or DatabaseConfig.CONNECTION_POOL_SIZE
+        self.is_available = True
+        self.last_check = 0
+        # 在事件循环内首次使用时创建，避免绑定到错误的事件循环
+        self._idle: Optional[asyncio.LifoQueue] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    async def _connect(self):
+        """建立新连接"""
+        return await mysql_aio.connect(**self.config)
+
+    async def get_connection(self) -> AsyncPooledConnection:
+        """获取连接：优先复用空闲连接，连接数达到上限时等待归还"""
+        if self._slots is None:
+            self._idle = asyncio.LifoQueue()
+            self._slots = asyncio.Semaphore(self.pool_size)
+
+        await self._slots.acquire()
+        try:
+            while not self._idle.empty():
+                connection = self._idle.get_nowait()
+                if await connection.is_connected():
+                    return AsyncPooledConnection(self, connection)
+
+            connection = await self._connect()
+            self.is_available = True
+            return AsyncPooledConnection(self, connection)
+        except Exception as e:
+            self._slots.release()
+            self.is_available = False
+            log_connection_event(f"Get connection failed for node {self.node_id}",
+                               f"{self.config['host']}:{self.config['port']}", False, str(e))
+            raise
+
+    async def release(self, connection):
+        """归还连接，未结束的事务先回滚"""
+        try:
+            await connection.rollback()
+            self._idle.put_nowait(connection)
+        except Exception as e:
+            database_logger.warning(f"Discarding broken connection for {self.node_id}: {e}")
+            try:
+                await connection.close()
+            except Exception:
+                pass
+        finally:
+            self._slots.release()
+
+    async def discard(self, connection):
+        """关闭连接并释放名额，服务端随连接断开回滚未准备的分支"""
+        try:
+            await connection.close()
+        except Exception as e:
+            database_logger.warning(f"Error closing discarded connection for {self.node_id}: {e}")
+        finally:
+            self._slots.release()
+
+    async def check_health(self) -> bool:
+        """检查节点健康状态"""
+        conn = None
+        try:
+            conn = await self.get_connection()
+            cursor = await conn.cursor()
+            await cursor.execute("SELECT 1")
+            await cursor.fetchone()
+            await cursor.close()
+            self.is_available = True
+        except Exception as e:
+            self.is_available = False
+            database_logger.warning(f"Health check failed for {self.node_id}: {e}")
+        finally:
+            self.last_check = time.time()
+            if conn:
+                await conn.close()
+        return self.is_available
+
+    async def close(self):
+        """关闭所有空闲连接"""
+        while self._idle is not None and not self._idle.empty():
+            connection = self._idle.get_nowait()
+            try:
+                await connection.close()
+            except Exception:
+                pass
+
+class AsyncDatabaseManager:
+    """异步分布式数据库管理器"""
+
+    def __init__(self):
+        self.nodes: Dict[str, AsyncDatabaseNode] = {}
+        self._initialize_nodes()
+
+    def _initialize_nodes(self):
+        """初始化数据库节点"""
+        for node_id in DatabaseConfig.get_node_ids():
+            self.nodes[node_id] = AsyncDatabaseNode(node_id, DatabaseConfig.get_node_config(node_id))
+
+        database_logger.info("Async database manager initialized with nodes: " +
+                           ", ".join(self.nodes.keys()))
+
+    async def get_connection(self, node_id: str) -> AsyncPooledConnection:
+        """获取指定节点的连接"""
+        if node_id not in self.nodes:
+            raise ValueError(f"Unknown database node: {node_id}")
+        return await self.nodes[node_id].get_connection()
+
+    async def execute_query(self, node_id: str, query: str, params: Optional[Tuple] = None) -> List:
+        """在指定节点执行查询"""
+        conn = None
+        try:
+            conn = await self.get_connection(node_id)
+            cursor = await conn.cursor(dictionary=True)
+            await cursor.execute(query, params)
+            result = await cursor.fetchall()
+            await cursor.close()
+
+            log_database_operation("SELECT", node_id, "query", True)
+            return result
+
+        except Exception as e:
+            log_database_operation("SELECT", node_id, "query", False, str(e))
+            raise e
+        finally:
+            if conn:
+                await conn.close()
+
+    async def get_node_status(self) -> Dict[str, Dict]:
+        """并发检查并获取所有节点状态"""
+        node_ids = list(self.nodes.keys())
+        results = await asyncio.gather(*(self.nodes[node_id].check_health() for node_id in node_ids))
+
+        status = {}
+        for node_id, available in zip(node_ids, results):
+            node = self.nodes[node_id]
+            status[node_id] = {
+                'available': available,
+                'host': node.config['host'],
+                'port': node.config['port'],
+                'database': node.config['database'],
+                'last_check': node.last_check
+            }
+        return status
+
+    async def close_all_connections(self):
+        """关闭所有节点的空闲连接"""
+        for node_id, node in self.nodes.items():
+            try:
+                await node.close()
+                log_connection_event(f"Connection pool closed for node {node_id}",
+                                   f"{node.config['host']}:{node.config['port']}", True)
+            except Exception as e:
+                database_logger.error(f"Error closing connection pool for {node_id}: {e}")
@@ -0,0 +1,307 @@
+"""
+异步2PC事务管理器
+EnhancedTransactionManager的asyncio版本，参与者延迟加入，各阶段并发下发到所有节点
+"""
+import asyncio
+import time
+import uuid
+from typing import Dict, List, Optional, Callable, Any
+from config import TransactionConfig
+from transaction_manager import TransactionState, ParticipantState
+from logger import (transaction_logger, log_transaction_start,
+                   log_transaction_prepare, log_transaction_commit, log_system_error)
+
+class AsyncTransactionParticipant:
+    """异步事务参与者类"""
+
+    def __init__(self, participant_id: str, connection):
+        self.participant_id = participant_id
+        self.connection = connection
+        self.state = ParticipantState.ACTIVE
+        self.xa_id = None
+        self.last_operation_time = time.time()
+        self.touched = False
+        self.read_only = True
+        # 语句执行中被取消（准备超时），连接上的协议状态未知，不能再下发语句
+        self.cancelled = False
+
+    async def execute(self, *statements: str):
+        """依次执行XA控制语句"""
+        cursor = await self.connection.cursor()
+        for statement in statements:
+            await cursor.execute(statement)
+        await cursor.close()
+        self.last_operation_time = time.time()
+
+class AsyncTransactionManager:
+    """异步分布式事务管理器"""
+
+    def __init__(self, db_manager, coordinator_log=None):
+        self.transaction_id = str(uuid.uuid1())
+        self.db_manager = db_manager
+        self.coordinator_log = coordinator_log
+        self.participants: Dict[str, AsyncTransactionParticipant] = {}
+        self.state = TransactionState.INIT
+        self.start_time = time.time()
+        self.timeout = TransactionConfig.TRANSACTION_TIMEOUT
+        self.prepare_timeout = TransactionConfig.PREPARE_TIMEOUT
+        self._lock = asyncio.Lock()
+        self.operations: List[Dict] = []
+        self.one_phase = False
+
+        log_transaction_start(self.transaction_id, [])
+
+    def _check_timeout(self) -> bool:
+        """检查事务是否超时"""
+        return time.time() - self.start_time > self.timeout
+
+    def _generate_xa_id(self, participant_id: str) -> str:
+        """生成XA事务ID"""
+        return f"{self.transaction_id}_{participant_id}"
+
+    async def begin_transaction(self) -> bool:
+        """开始分布式事务（参与者在首次操作时加入）"""
+        async with self._lock:
+            if self.state != TransactionState.INIT:
+                raise Exception(f"Transaction {self.transaction_id} is not in INIT state")
+
+            if self._check_timeout():
+                raise Exception(f"Transaction {self.transaction_id} timed out before starting")
+
+            self.state = TransactionState.ACTIVE
+            transaction_logger.info(f"Transaction {self.transaction_id} started successfully")
+            return True
+
+    async def _enlist(self, node_id: str) -> AsyncTransactionParticipant:
+        """借用连接并开启XA分支"""
+        connection = await self.db_manager.get_connection(node_id)
+        participant = AsyncTransactionParticipant(node_id, connection)
+        participant.xa_id = self._generate_xa_id(node_id)
+        try:
+            await participant.execute(f"XA START '{participant.xa_id}'")
+        except Exception:
+            await connection.close()
+            raise
+
+        self.participants[node_id] = participant
+        transaction_logger.debug(f"Transaction {self.transaction_id} enlisted participant {node_id}")
+        return participant
+
+    async def execute_operation(self, participant_id: str, operation: Callable, *args, **kwargs) -> Any:
+        """在指定节点上执行异步操作：operation(conn, *args, **kwargs)"""
+        async with self._lock:
+            if self.state != TransactionState.ACTIVE:
+                raise Exception(f"Transaction {self.transaction_id} is not active")
+
+            if self._check_timeout():
+                raise Exception(f"Transaction {self.transaction_id} timed out")
+
+            participant = self.participants.get(participant_id)
+            if participant is None:
+                try:
+                    participant = await self._enlist(participant_id)
+                except ValueError:
+                    raise
+                except Exception as e:
+                    log_system_error(f"AsyncTransactionManager.enlist.{participant_id}", str(e))
+                    raise Exception(f"Failed to enlist {participant_id}: {e}")
+
+            try:
+                self.operations.append({
+                    'participant_id': participant_id,
+                    'operation': getattr(operation, '__name__', str(operation)),
+                    'args': args,
+                    'kwargs': kwargs,
+                    'timestamp': time.time()
+                })
+
+                participant.touched = True
+                if not getattr(operation, 'read_only', False):
+                    participant.read_only = False
+                result = await operation(participant.connection, *args, **kwargs)
+                participant.last_operation_time = time.time()
+                return result
+
+            except Exception as e:
+                # 分支仍处于ACTIVE状态，回滚时先XA END再XA ROLLBACK
+                log_system_error(f"AsyncTransactionManager.execute_operation.{participant_id}", str(e))
+                raise Exception(f"Operation failed on {participant_id}: {e}")
+
+    async def _gather(self, action: Callable, participants: Dict[str, AsyncTransactionParticipant],
+                      timeout: Optional[float] = None) -> Dict[str, Optional[BaseException]]:
+        """
+        并发对参与者执行操作，返回每个参与者的异常（成功为None）。
+        超时未完成的操作被取消并等待其结束，对应参与者标记为已取消，异常为TimeoutError
+        """
+        tasks = {pid: asyncio.ensure_future(action(pid, participant))
+                 for pid, participant in participants.items()}
+        if not tasks:
+            return {}
+        _, unfinished = await asyncio.wait(tasks.values(), timeout=timeout)
+        for task in unfinished:
+            task.cancel()
+        # 等待被取消的操作真正结束后才能处理其连接
+        await asyncio.gather(*unfinished, return_exceptions=True)
+
+        errors = {}
+        for pid, task in tasks.items():
+            if task in unfinished:
+                participants[pid].cancelled = True
+                participants[pid].state = ParticipantState.FAILED
+                errors[pid] = TimeoutError(f"{pid} did not finish within {timeout}s")
+            else:
+                errors[pid] = task.exception()
+        return errors
+
+    async def _prepare_action(self, participant_id: str, participant: AsyncTransactionParticipant):
+        """只读参与者一阶段提交，唯一写入者只结束分支，其余执行XA PREPARE"""
+        try:
+            if participant.read_only:
+                await participant.execute(f"XA END '{participant.xa_id}'",
+                                          f"XA COMMIT '{participant.xa_id}' ONE PHASE")
+                participant.state = ParticipantState.READ_ONLY
+            elif self.one_phase:
+                await participant.execute(f"XA END '{participant.xa_id}'")
+                participant.state = ParticipantState.IDLE
+            else:
+                await participant.execute(f"XA END '{participant.xa_id}'",
+                                          f"XA PREPARE '{participant.xa_id}'")
+                participant.state = ParticipantState.PREPARED
+            log_transaction_prepare(self.transaction_id, participant_id, True)
+
+        except Exception:
+            participant.state = ParticipantState.FAILED
+            log_transaction_prepare(self.transaction_id, participant_id, False)
+            raise
+
+    async def prepare(self) -> bool:
+        """第一阶段：并发准备所有参与者"""
+        async with self._lock:
+            if self.state != TransactionState.ACTIVE:
+                raise Exception(f"Transaction {self.transaction_id} is not active")
+
+            if self._check_timeout():
+                raise Exception(f"Transaction {self.transaction_id} timed out")
+
+            self.state = TransactionState.PREPARING
+            written = [pid for pid, p in self.participants.items() if not p.read_only]
+            self.one_phase = len(written) <= 1
+
+            try:
+                errors = await self._gather(self._prepare_action, self.participants,
+                                            timeout=self.prepare_timeout)
+                failed = {pid: e for pid, e in errors.items() if e is not None}
+                if failed:
+                    details = "; ".join(f"{pid}: {e}" for pid, e in failed.items())
+                    raise Exception(f"Prepare failed for {details}")
+
+                self.state = TransactionState.PREPARED
+                transaction_logger.info(f"Transaction {self.transaction_id} prepared successfully"
+                                      f"{' (one-phase)' if self.one_phase else ''}")
+                return True
+
+            except Exception as e:
+                self.state = TransactionState.ABORTING
+                log_system_error("AsyncTransactionManager.prepare", str(e))
+                await self._rollback_internal()
+                raise Exception(f"Prepare phase failed for transaction {self.transaction_id}: {e}")
+
+    async def _commit_participant(self, participant_id: str, participant: AsyncTransactionParticipant):
+        """提交单个参与者"""
+        try:
+            if participant.state == ParticipantState.IDLE:
+                await participant.execute(f"XA COMMIT '{participant.xa_id}' ONE PHASE")
+            else:
+                await participant.execute(f"XA COMMIT '{participant.xa_id}'")
+            participant.state = ParticipantState.COMMITTED
+        except Exception:
+            participant.state = ParticipantState.FAILED
+            raise
+
+    async def commit(self) -> bool:
+        """第二阶段：并发提交所有参与者"""
+        async with self._lock:
+            if self.state != TransactionState.PREPARED:
+                raise Exception(f"Transaction {self.transaction_id} is not prepared")
+
+            # 先持久化提交决策（协调者日志为阻塞实现，放到线程中等待）
+            if not self.one_phase and self.coordinator_log is not None:
+                prepared = [pid for pid, p in self.participants.items()
+                            if p.state == ParticipantState.PREPARED]
+                try:
+                    loop = asyncio.get_running_loop()
+                    await loop.run_in_executor(None, self.coordinator_log.log_decision,
+                                               self.transaction_id, prepared)
+                except Exception as e:
+                    log_system_error("AsyncTransactionManager.commit", str(e))
+                    await self._rollback_internal()
+                    raise Exception(f"Commit phase failed for transaction {self.transaction_id}: {e}")
+
+            self.state = TransactionState.COMMITTING
+
+            pending = {pid: p for pid, p in self.participants.items()
+                       if p.state in (ParticipantState.PREPARED, ParticipantState.IDLE)}
+            errors = await self._gather(self._commit_participant, pending)
+            for participant_id, error in errors.items():
+                if error is not None:
+                    transaction_logger.error(f"Commit failed for {participant_id}: {error}")
+
+            self.state = TransactionState.COMMITTED
+            # 只有所有分支都已提交时决策才不再需要；提交失败的分支留给恢复流程按决策提交
+            if (not self.one_phase and self.coordinator_log is not None
+                    and all(p.state == ParticipantState.COMMITTED for p in pending.values())):
+                self.coordinator_log.log_end(self.transaction_id)
+            log_transaction_commit(self.transaction_id, True)
+            transaction_logger.info(f"Transaction {self.transaction_id} committed successfully")
+            return True
+
+    async def rollback(self) -> bool:
+        """回滚事务"""
+        async with self._lock:
+            return await self._rollback_internal()
+
+    async def _rollback_participant(self, participant_id: str, participant: AsyncTransactionParticipant):
+        """回滚单个参与者"""
+        if participant.cancelled:
+            # 不在状态未知的连接上下发语句：断开连接，服务端回滚未准备的分支，
+            # 已准备的分支没有提交决策，由恢复流程回滚
+            await participant.connection.discard()
+            transaction_logger.warning(f"Discarded connection of {participant_id} after cancelled statement")
+        elif participant.state in (ParticipantState.PREPARED, ParticipantState.IDLE):
+            await participant.execute(f"XA ROLLBACK '{participant.xa_id}'")
+        elif participant.state == ParticipantState.ACTIVE:
+            await participant.execute(f"XA END '{participant.xa_id}'",
+                                      f"XA ROLLBACK '{participant.xa_id}'")
+        participant.state = ParticipantState.ABORTED
+
+    async def _rollback_internal(self) -> bool:
+        """内部回滚实现"""
+        if self.state in [TransactionState.COMMITTED, TransactionState.ABORTED]:
+            return True
+
+        self.state = TransactionState.ABORTING
+        pending = {pid: p for pid, p in self.participants.items()
+                   if p.state != ParticipantState.READ_ONLY}
+        errors = await self._gather(self._rollback_participant, pending)
+        for participant_id, error in errors.items():
+            if error is not None:
+                transaction_logger.error(f"Rollback failed for {participant_id}: {error}")
+
+        self.state = TransactionState.ABORTED
+        log_transaction_commit(self.transaction_id, False)
+        transaction_logger.info(f"Transaction {self.transaction_id} rolled back successfully")
+        return True
+
+    async def cleanup(self):
+        """清理资源：未完成的事务回滚，并归还所有连接"""
+        try:
+            if self.state not in [TransactionState.COMMITTED, TransactionState.ABORTED]:
+                await self.rollback()
+        except Exception:
+            pass
+
+        for participant in self.participants.values():
+            try:
+                await participant.connection.close()
+            except Exception:
+                pass
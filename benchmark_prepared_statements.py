@@ -0,0 +1,106 @@
+"""
+预编译语句基准测试
+在真实的db1/db2上比较转账热点语句两种执行方式的单笔耗时、客户端CPU和往返次数：
+  text     每条语句新建游标并发送SQL文本（原实现）
+  registry 连接级StatementRegistry（每条SQL预编译一次，之后复用prepared游标）
+每笔转账在本地事务中执行后回滚，不修改数据。
+用法: python benchmark_prepared_statements.py [--transfers 2000] [--from-account 1001] [--to-account 1002]
+"""
+import argparse
+import time
+import mysql.connector
+from config import DatabaseConfig
+from database_manager import StatementRegistry
+from distributed_app import DEBIT_SQL, CREDIT_SQL, INSERT_TRANSACTION_SQL
+
+def connect(node_id: str):
+    """建立纯Python实现的连接，以便统计发送的命令数"""
+    config = dict(DatabaseConfig.get_node_config(node_id))
+    config['use_pure'] = True
+    return mysql.connector.connect(**config)
+
+def count_commands(conn) -> list:
+    """包装连接的命令发送函数，返回计数器（每个命令一次往返，STMT_CLOSE除外）"""
+    counter = [0]
+    send_cmd = conn._send_cmd
+
+    def counting_send_cmd(*args, **kwargs):
+        counter[0] += 1
+        return send_cmd(*args, **kwargs)
+
+    conn._send_cmd = counting_send_cmd
+    return counter
+
+def transfer_statements(from_account: int, to_account: int):
+    """一笔转账在两个节点上执行的语句"""
+    return [('db1', DEBIT_SQL, (1, from_account, 1)),
+            ('db1', CREDIT_SQL, (1, to_account)),
+            ('db2', INSERT_TRANSACTION_SQL, (from_account, to_account, 1, 'BENCHMARK'))]
+
+def run_text(conns, statements):
+    """原实现：每条语句新建游标"""
+    for node_id, sql, params in statements:
+        cursor = conns[node_id].cursor()
+        cursor.execute(sql, params)
+        cursor.close()
+
+def make_registry_runner(conns):
+    """StatementRegistry：连接级语句缓存"""
+    registries = {node_id: StatementRegistry(conn) for node_id, conn in conns.items()}
+
+    def run(conns, statements):
+        for node_id, sql, params in statements:
+            registries[node_id].execute(sql, params)
+    return run
+
+def measure(name: str, run, conns, counters, statements, transfers: int):
+    """执行transfers笔转账（每笔回滚），输出单笔耗时、CPU和往返次数"""
+    # 预热：首次预编译不计入
+    run(conns, statements)
+    for conn in conns.values():
+        conn.rollback()
+
+    for counter in counters:
+        counter[0] = 0
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    for _ in range(transfers):
+        run(conns, statements)
+        for conn in conns.values():
+            conn.rollback()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    # 扣除每笔转账两次回滚的往返
+    round_trips = sum(counter[0] for counter in counters) / transfers - len(conns)
+
+    print(f"{name:<10} {wall / transfers * 1000:8.3f} ms  {cpu / transfers * 1000:8.3f} ms CPU  "
+          f"{round_trips:5.1f} round trips per transfer")
+    return wall / transfers, cpu / transfers, round_trips
+
+def main():
+    parser = argparse.ArgumentParser(description='预编译语句基准测试')
+    parser.add_argument('--transfers', type=int, default=2000, help='转账笔数')
+    parser.add_argument('--from-account', type=int, default=1001)
+    parser.add_argument('--to-account', type=int, default=1002)
+    args = parser.parse_args()
+
+    statements = transfer_statements(args.from_account, args.to_account)
+    results = {}
+    for name in ('text', 'registry'):
+        # 每种方式使用新连接，互不影响
+        conns = {node_id: connect(node_id) for node_id in ('db1', 'db2')}
+        counters = [count_commands(conn) for conn in conns.values()]
+        run = run_text if name == 'text' else make_registry_runner(conns)
+        try:
+            results[name] = measure(name, run, conns, counters, statements, args.transfers)
+        finally:
+            for conn in conns.values():
+                conn.rollback()
+                conn.close()
+
+    wall, cpu, trips = results['registry']
+    base_wall, base_cpu, base_trips = results['text']
+    print(f"registry vs text: {base_wall / wall:.2f}x latency, {base_cpu / cpu:.2f}x CPU, "
+          f"{trips - base_trips:+.1f} round trips per transfer")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+结果集序列化基准测试
+比较原逐值判断的process_query_result与按列类型转换的serialization在大结果集上的耗时
+用法: python benchmark_serialization.py [--rows 100000] [--repeat 5]
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from mysql.connector import FieldType
+import serialization
+from database_manager import ResultSet
+
+# 与inventory表一致的列描述
+DESCRIPTION = [
+    ('product_id', FieldType.LONG, None, None, None, None, 0, 0, 63),
+    ('product_name', FieldType.VAR_STRING, None, None, None, None, 0, 0, 45),
+    ('quantity', FieldType.LONG, None, None, None, None, 0, 0, 63),
+    ('price', FieldType.NEWDECIMAL, None, None, None, None, 0, 0, 63),
+    ('created_at', FieldType.TIMESTAMP, None, None, None, None, 1, 0, 63),
+    ('updated_at', FieldType.TIMESTAMP, None, None, None, None, 1, 0, 63),
+]
+
+def make_rows(count: int) -> ResultSet:
+    """生成模拟的查询结果"""
+    base = datetime(2024, 1, 1)
+    return ResultSet(({
+        'product_id': i,
+        'product_name': f'Product {i}',
+        'quantity': i % 1000,
+        'price': Decimal(i % 10000) / 100,
+        'created_at': base + timedelta(seconds=i),
+        'updated_at': base + timedelta(seconds=2 * i),
+    } for i in range(count)), DESCRIPTION)
+
+def legacy_convert(obj):
+    """原web_interface.convert_decimal_and_datetime"""
+    if isinstance(obj, Decimal):
+        return float(obj)
+    elif isinstance(obj, datetime):
+        return obj.isoformat()
+    return obj
+
+def legacy_path(rows) -> str:
+    """原实现：逐个单元格判断类型后用标准库编码"""
+    for item in rows:
+        for key, value in item.items():
+            item[key] = legacy_convert(value)
+    return json.dumps({'success': True, 'data': rows})
+
+def columnar_path(rows, fast: bool) -> str:
+    """新实现：按列描述转换后编码"""
+    return serialization.dumps({'success': True, 'data': serialization.serialize_rows(rows)}, fast=fast)
+
+def measure(name: str, func, count: int, repeat: int):
+    """多次运行取最好成绩（每次使用新生成的结果集）"""
+    best = None
+    for _ in range(repeat):
+        rows = make_rows(count)
+        start = time.perf_counter()
+        func(rows)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{name:<32} {best * 1000:9.1f} ms  {count / best:12,.0f} rows/s")
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='结果集序列化基准测试')
+    parser.add_argument('--rows', type=int, default=100000, help='结果集行数')
+    parser.add_argument('--repeat', type=int, default=5, help='重复次数')
+    args = parser.parse_args()
+
+    # 先确认两种实现输出一致
+    assert json.loads(legacy_path(make_rows(100))) == json.loads(columnar_path(make_rows(100), fast=False))
+
+    print(f"Serializing {args.rows:,} rows, best of {args.repeat}")
+    baseline = measure('process_query_result + json', legacy_path, args.rows, args.repeat)
+    columnar = measure('serialize_rows + json', lambda rows: columnar_path(rows, False), args.rows, args.repeat)
+    print(f"{'speedup':<32} {baseline / columnar:9.2f}x")
+
+    if serialization.orjson is not None:
+        fast = measure('serialize_rows + orjson', lambda rows: columnar_path(rows, True), args.rows, args.repeat)
+        print(f"{'speedup':<32} {baseline / fast:9.2f}x")
+    else:
+        print("orjson is not installed, skipping the fast encoder")
+
+if __name__ == '__main__':
+    main()
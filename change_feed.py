@@ -0,0 +1,153 @@
+"""
+变更推送模块
+后台线程按主题（系统状态、账户、库存）每个间隔只计算一次快照，与上一次快照比较后
+把差异推送到订阅该主题的SocketIO房间；新订阅者收到当前完整快照。
+数据库读取量与打开的页面数无关，没有订阅者的主题不计算。
+多进程部署时每个worker只向本进程的订阅者推送，房间名带进程标识，经消息队列广播时不会重复投递
+"""
+import os
+import socket
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional
+from config import WebConfig
+from logger import system_logger, log_system_info
+
+def room_for(topic: str, scope: str = None) -> str:
+    """主题对应的SocketIO房间名，scope区分不同进程的推送器"""
+    return f"feed:{topic}:{scope}" if scope else f"feed:{topic}"
+
+def diff_snapshots(old: Dict[str, object], new: Dict[str, object]) -> Optional[Dict]:
+    """比较两个以键索引的快照，返回 {'upserts': {键: 新值}, 'removed': [键]}，没有变化时返回None"""
+    upserts = {key: value for key, value in new.items() if key not in old or old[key] != value}
+    removed = [key for key in old if key not in new]
+    if not upserts and not removed:
+        return None
+    return {'upserts': upserts, 'removed': removed}
+
+class ChangeFeed:
+    """变更推送：每个主题一个快照函数，返回 {键: JSON可序列化的值}"""
+
+    def __init__(self, emit: Callable[..., None], sources: Dict[str, Callable[[], Dict[str, object]]],
+                 interval: float = None):
+        self.emit = emit
+        self.sources = sources
+        self.interval = interval if interval is not None else WebConfig.CHANGE_FEED_INTERVAL
+        self.snapshots: Dict[str, Dict[str, object]] = {}
+        self.versions: Dict[str, int] = {topic: 0 for topic in sources}
+        self.subscribers: Dict[str, set] = {topic: set() for topic in sources}
+        self.refresh_count = 0
+        self.delta_count = 0
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        """推送线程是否在运行"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def room(self, topic: str) -> str:
+        """本进程推送器的主题房间（fork后按worker的进程号区分）"""
+        return room_for(topic, f"{socket.gethostname()}:{os.getpid()}")
+
+    def subscribe(self, sid: str, topic: str) -> Dict:
+        """登记订阅并返回主题的完整快照（尚未计算时立即计算一次）"""
+        if topic not in self.sources:
+            raise ValueError(f"Unknown feed topic: {topic}")
+        with self._lock:
+            self.subscribers[topic].add(sid)
+            snapshot = self.snapshots.get(topic)
+        if snapshot is None:
+            self.refresh(topic)
+        with self._lock:
+            return {'topic': topic, 'version': self.versions[topic], 'data': self.snapshots.get(topic, {})}
+
+    def unsubscribe(self, sid: str, topics: Iterable[str] = None):
+        """取消订阅，topics为None时取消该连接的全部订阅"""
+        with self._lock:
+            for topic in (topics if topics is not None else self.sources):
+                self.subscribers.get(topic, set()).discard(sid)
+
+    def notify(self, *topics: str):
+        """标记主题数据已变化，推送线程被唤醒后立即刷新（同一间隔内的多次通知合并为一次）"""
+        with self._lock:
+            self._dirty.update(topic for topic in topics if topic in self.sources)
+        self._wake.set()
+
+    def refresh(self, topic: str) -> Optional[Dict]:
+        """重新计算主题快照，有变化时向订阅房间推送差异并返回差异"""
+        snapshot = self.sources[topic]()
+        self.refresh_count += 1
+        with self._lock:
+            previous = self.snapshots.get(topic)
+            self.snapshots[topic] = snapshot
+            if previous is None:
+                return None
+            delta = diff_snapshots(previous, snapshot)
+            if delta is None:
+                return None
+            self.versions[topic] += 1
+            delta.update(topic=topic, version=self.versions[topic])
+        self.emit('feed_delta', delta, self.room(topic))
+        self.delta_count += 1
+        return delta
+
+    def refresh_subscribed(self, topics: Iterable[str] = None) -> int:
+        """刷新有订阅者的主题，没有订阅者的主题丢弃快照（重新订阅时再计算），返回刷新的主题数"""
+        refreshed = 0
+        for topic in (topics if topics is not None else list(self.sources)):
+            with self._lock:
+                if not self.subscribers[topic]:
+                    self.snapshots.pop(topic, None)
+                    continue
+            try:
+                self.refresh(topic)
+                refreshed += 1
+            except Exception as e:
+                system_logger.warning(f"Change feed refresh of {topic} failed: {e}")
+        return refreshed
+
+    def get_stats(self) -> Dict:
+        """推送统计"""
+        with self._lock:
+            return {
+                'running': self.running,
+                'interval': self.interval,
+                'subscribers': {topic: len(sids) for topic, sids in self.subscribers.items()},
+                'versions': dict(self.versions),
+                'refreshes': self.refresh_count,
+                'deltas': self.delta_count
+            }
+
+    def start(self):
+        """启动推送线程"""
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True, name='change-feed')
+        self._thread.start()
+        log_system_info("ChangeFeed", f"Change feed started (interval {self.interval}s)")
+
+    def stop(self):
+        """停止推送线程"""
+        self._stop.set()
+        self._wake.set()
+
+    def _loop(self):
+        """每个间隔刷新全部订阅主题，间隔内被通知的主题提前刷新"""
+        # 订阅时已计算快照，第一次全量刷新在一个间隔后
+        next_full = time.monotonic() + self.interval
+        while not self._stop.is_set():
+            now = time.monotonic()
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+            if now >= next_full:
+                self.refresh_subscribed()
+                next_full = now + self.interval
+            elif dirty:
+                self.refresh_subscribed(dirty)
+            self._wake.wait(max(0.0, next_full - time.monotonic()))
+            self._wake.clear()
@@ -3,6 +3,7 @@
 管理分布式数据库系统的所有配置参数
 """
 import os
+import tempfile
 from dotenv import load_dotenv
 
 # 加载环境变量
@@ -25,10 +26,58 @@ class DatabaseConfig:
     DB2_PASSWORD = os.getenv('DB2_PASSWORD', 'password')
     DB2_DATABASE = os.getenv('DB2_DATABASE', 'db2')
 
-    # 连接池配置
+    # 所有数据库节点ID（逗号分隔）；db1、db2以外的节点从<NODE>_HOST、<NODE>_PORT等变量读取配置
+    DB_NODES = [node.strip() for node in os.getenv('DB_NODES', 'db1,db2').split(',') if node.strip()]
+
+    # 只读副本：<NODE>_REPLICAS 为 "host:port,host:port"，账号和库名与主节点相同
+    # 副本选择策略 round_robin（轮询）或 least_loaded（进行中查询最少），复制延迟超过阈值（秒）的副本不参与读取
+    REPLICA_SELECTION = os.getenv('REPLICA_SELECTION', 'round_robin').lower()
+    REPLICA_MAX_LAG_SECONDS = float(os.getenv('REPLICA_MAX_LAG_SECONDS', 5))
+    # 会话写入某节点后该时长（秒）内对该节点的读取走主节点（读己之写），应不小于最大延迟加健康检查间隔
+    READ_YOUR_WRITES_WINDOW = float(os.getenv('READ_YOUR_WRITES_WINDOW', 15))
+
+    # 查询结果缓存：白名单查询的结果按TTL（秒）过期、按条目数LRU淘汰，相关写入提交后立即失效
+    QUERY_CACHE_ENABLED = os.getenv('QUERY_CACHE_ENABLED', 'True').lower() == 'true'
+    QUERY_CACHE_TTL = float(os.getenv('QUERY_CACHE_TTL', 30))
+    QUERY_CACHE_MAX_ENTRIES = int(os.getenv('QUERY_CACHE_MAX_ENTRIES', 256))
+
+    # 流式查询每次从服务端读取的行数
+    STREAM_FETCH_SIZE = int(os.getenv('STREAM_FETCH_SIZE', 500))
+
+    # 连接池配置（CONNECTION_POOL_SIZE为每个节点的最大连接数）
     CONNECTION_POOL_SIZE = int(os.getenv('CONNECTION_POOL_SIZE', 5))
+    POOL_MIN_SIZE = int(os.getenv('POOL_MIN_SIZE', 1))
+    # 连接用尽时的最长等待秒数及最大排队数
+    POOL_CHECKOUT_TIMEOUT = float(os.getenv('POOL_CHECKOUT_TIMEOUT', 5))
+    POOL_MAX_WAITERS = int(os.getenv('POOL_MAX_WAITERS', 100))
+    # 空闲回收和最大存活时间（秒，0表示不限制）
+    POOL_IDLE_TIMEOUT = int(os.getenv('POOL_IDLE_TIMEOUT', 300))
+    POOL_MAX_LIFETIME = int(os.getenv('POOL_MAX_LIFETIME', 1800))
+    # 归还连接时重置会话（清除会话变量、临时表和用户锁，同时释放服务端预编译语句）
+    POOL_RESET_SESSION = os.getenv('POOL_RESET_SESSION', 'True').lower() == 'true'
     CONNECTION_TIMEOUT = int(os.getenv('CONNECTION_TIMEOUT', 30))
 
+    # 转账、下单等热点语句使用服务端预编译语句，按池化连接缓存复用；
+    # 须同时设置POOL_RESET_SESSION=False，否则语句随每次会话重置释放，启动时记录警告
+    PREPARED_STATEMENTS = os.getenv('PREPARED_STATEMENTS', 'False').lower() == 'true'
+
+    # 借出连接时遇到失效连接的最多尝试次数
+    CONNECTION_CHECKOUT_ATTEMPTS = int(os.getenv('CONNECTION_CHECKOUT_ATTEMPTS', 2))
+
+    # 节点熔断：连续失败次数阈值、打开后的冷却秒数、半开状态放行的试探请求数
+    CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5))
+    CIRCUIT_RESET_TIMEOUT = float(os.getenv('CIRCUIT_RESET_TIMEOUT', 10))
+    CIRCUIT_HALF_OPEN_MAX_CALLS = int(os.getenv('CIRCUIT_HALF_OPEN_MAX_CALLS', 1))
+
+    # 后台健康检查：探测间隔、单次探测超时（秒）、保留的探测记录数及状态接口返回的记录数
+    HEALTH_CHECK_INTERVAL = float(os.getenv('HEALTH_CHECK_INTERVAL', 10))
+    HEALTH_CHECK_TIMEOUT = float(os.getenv('HEALTH_CHECK_TIMEOUT', 2))
+    HEALTH_HISTORY_SIZE = int(os.getenv('HEALTH_HISTORY_SIZE', 100))
+    HEALTH_HISTORY_REPORT_SIZE = int(os.getenv('HEALTH_HISTORY_REPORT_SIZE', 10))
+
+    # 连接空闲超过该秒数后借出前才做存活校验
+    CONNECTION_VALIDATION_IDLE_SECONDS = int(os.getenv('CONNECTION_VALIDATION_IDLE_SECONDS', 30))
+
     @classmethod
     def get_db1_config(cls):
         """获取数据库1配置"""
@@ -55,6 +104,45 @@ class DatabaseConfig:
             'connection_timeout': cls.CONNECTION_TIMEOUT
         }
 
+    @classmethod
+    def get_node_ids(cls):
+        """获取所有数据库节点ID"""
+        return list(cls.DB_NODES)
+
+    @classmethod
+    def get_node_config(cls, node_id: str):
+        """获取指定节点的配置"""
+        if node_id == 'db1':
+            return cls.get_db1_config()
+        if node_id == 'db2':
+            return cls.get_db2_config()
+
+        prefix = node_id.upper()
+        return {
+            'host': os.getenv(f'{prefix}_HOST', 'localhost'),
+            'port': int(os.getenv(f'{prefix}_PORT', 3306)),
+            'user': os.getenv(f'{prefix}_USER', 'root'),
+            'password': os.getenv(f'{prefix}_PASSWORD', 'password'),
+            'database': os.getenv(f'{prefix}_DATABASE', node_id),
+            'autocommit': False,
+            'connection_timeout': cls.CONNECTION_TIMEOUT
+        }
+
+    @classmethod
+    def get_replica_configs(cls, node_id: str):
+        """获取指定节点的只读副本配置列表"""
+        replicas = []
+        for endpoint in os.getenv(f'{node_id.upper()}_REPLICAS', '').split(','):
+            endpoint = endpoint.strip()
+            if not endpoint:
+                continue
+            host, _, port = endpoint.partition(':')
+            config = dict(cls.get_node_config(node_id))
+            config['host'] = host
+            config['port'] = int(port) if port else 3306
+            replicas.append(config)
+        return replicas
+
 class TransactionConfig:
     """事务配置类"""
 
@@ -64,12 +152,89 @@ class TransactionConfig:
     # 重试次数
     MAX_RETRY_ATTEMPTS = int(os.getenv('MAX_RETRY_ATTEMPTS', 3))
 
-    # 重试间隔（秒）
-    RETRY_INTERVAL = int(os.getenv('RETRY_INTERVAL', 1))
+    # 重试间隔（秒），死锁重试按指数退避并加随机抖动
+    RETRY_INTERVAL = float(os.getenv('RETRY_INTERVAL', 1))
 
     # 2PC准备阶段超时时间（秒）
     PREPARE_TIMEOUT = int(os.getenv('PREPARE_TIMEOUT', 30))
 
+    # 2PC各阶段并行下发使用的共享线程池大小
+    PARTICIPANT_WORKERS = int(os.getenv('PARTICIPANT_WORKERS', 16))
+
+    # 协调者决策日志所在节点及单次组提交的最大记录数
+    COORDINATOR_LOG_NODE = os.getenv('COORDINATOR_LOG_NODE', 'db2')
+    COORDINATOR_LOG_BATCH_SIZE = int(os.getenv('COORDINATOR_LOG_BATCH_SIZE', 500))
+
+    # 转账批处理：在时间窗口（毫秒）内或达到最大笔数时合并为一个分布式事务
+    TRANSFER_BATCHING_ENABLED = os.getenv('TRANSFER_BATCHING_ENABLED', 'False').lower() == 'true'
+    TRANSFER_BATCH_WINDOW_MS = float(os.getenv('TRANSFER_BATCH_WINDOW_MS', 2))
+    TRANSFER_BATCH_MAX_SIZE = int(os.getenv('TRANSFER_BATCH_MAX_SIZE', 50))
+
+    # 批量转账：每个分块一个分布式事务；ATOMIC为True时任一失败则全部回滚
+    BULK_TRANSFER_CHUNK_SIZE = int(os.getenv('BULK_TRANSFER_CHUNK_SIZE', 500))
+    BULK_TRANSFER_ATOMIC = os.getenv('BULK_TRANSFER_ATOMIC', 'False').lower() == 'true'
+
+    # 默认事务模式：xa（两阶段提交）或 saga（步骤逐个本地提交，失败时补偿），可按调用指定
+    TRANSACTION_MODE = os.getenv('TRANSACTION_MODE', 'xa').lower()
+
+    # saga记录与补偿操作（sagas、saga_compensations表）所在节点
+    SAGA_LOG_NODE = os.getenv('SAGA_LOG_NODE', 'db2')
+
+    # 恢复只处理开始时间早于该值（秒）的XA分支：更新的分支可能属于仍在运行的其他协调者
+    # （其他进程、主机或并行执行的迁移），默认为事务超时与准备超时之和
+    XA_RECOVERY_GRACE = int(os.getenv('XA_RECOVERY_GRACE', TRANSACTION_TIMEOUT + PREPARE_TIMEOUT))
+
+    # 启动时是否自动恢复悬挂的XA分支和未结束的saga
+    RECOVER_ON_STARTUP = os.getenv('RECOVER_ON_STARTUP', 'True').lower() == 'true'
+
+class ShardConfig:
+    """分片配置类"""
+
+    # 分片策略：range（按账户ID区间）或 hash（一致性哈希）
+    SHARD_STRATEGY = os.getenv('SHARD_STRATEGY', 'range').lower()
+
+    # 存放账户数据的节点（逗号分隔）
+    ACCOUNT_SHARD_NODES = [node.strip() for node in os.getenv('ACCOUNT_SHARD_NODES', 'db1').split(',')
+                           if node.strip()]
+
+    # range策略的区间，格式 "db1:0-100000,db3:100000-"，左闭右开，上界留空表示不限
+    ACCOUNT_SHARD_RANGES = os.getenv('ACCOUNT_SHARD_RANGES', '')
+
+    # hash策略每个节点在哈希环上的虚拟节点数
+    SHARD_VIRTUAL_NODES = int(os.getenv('SHARD_VIRTUAL_NODES', 100))
+
+    # 交易记录（transactions表）所在节点
+    TRANSACTION_LOG_NODE = os.getenv('TRANSACTION_LOG_NODE', 'db2')
+
+    # 持久化分片路由（shard_ranges表）所在节点及各进程重新加载路由的间隔（秒）
+    ROUTING_NODE = os.getenv('ROUTING_NODE', 'db2')
+    ROUTING_REFRESH_INTERVAL = float(os.getenv('ROUTING_REFRESH_INTERVAL', 5))
+
+    # 在线迁移：每批复制/删除的行数及批次间隔（毫秒）
+    REBALANCE_BATCH_SIZE = int(os.getenv('REBALANCE_BATCH_SIZE', 500))
+    REBALANCE_THROTTLE_MS = float(os.getenv('REBALANCE_THROTTLE_MS', 50))
+
+class InventoryConfig:
+    """库存配置类"""
+
+    # 热点商品的库存拆分为多个子计数器行（inventory_stripes表），格式 "111:8,112:4"（商品ID:子计数器数）
+    INVENTORY_HOT_PRODUCTS = os.getenv('INVENTORY_HOT_PRODUCTS', '')
+
+    # 后台合并并重新均分子计数器的间隔（秒）
+    INVENTORY_FOLD_INTERVAL = float(os.getenv('INVENTORY_FOLD_INTERVAL', 5))
+
+    @classmethod
+    def get_hot_products(cls):
+        """获取热点商品及其子计数器数 {product_id: stripes}"""
+        products = {}
+        for item in cls.INVENTORY_HOT_PRODUCTS.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            product_id, _, stripes = item.partition(':')
+            products[int(product_id)] = max(1, int(stripes or 1))
+        return products
+
 class WebConfig:
     """Web界面配置类"""
 
@@ -81,6 +246,35 @@ class WebConfig:
 
     # SocketIO配置
     SOCKETIO_ASYNC_MODE = os.getenv('SOCKETIO_ASYNC_MODE', 'threading')
+    # 多进程部署时SocketIO广播经消息队列分发到所有worker（如 redis://localhost:6379/0），为空时只在本进程内广播
+    SOCKETIO_MESSAGE_QUEUE = os.getenv('SOCKETIO_MESSAGE_QUEUE', '')
+
+    # 生产部署（gunicorn）：worker进程数、worker类型（gthread 或 eventlet）、
+    # gthread每个worker的线程数、eventlet每个worker的并发连接数
+    WEB_WORKERS = int(os.getenv('WEB_WORKERS', os.cpu_count() or 1))
+    WEB_WORKER_CLASS = os.getenv('WEB_WORKER_CLASS', 'gthread').lower()
+    WEB_THREADS = int(os.getenv('WEB_THREADS', 32))
+    WEB_WORKER_CONNECTIONS = int(os.getenv('WEB_WORKER_CONNECTIONS', 1000))
+    # 多worker时同一主机上持有该文件锁的worker运行后台任务，其余worker按间隔（秒）重试接替
+    WEB_LEADER_LOCK_FILE = os.getenv('WEB_LEADER_LOCK_FILE',
+                                     os.path.join(tempfile.gettempdir(), f"ddbs-web-{PORT}.lock"))
+    WEB_LEADER_RETRY_INTERVAL = float(os.getenv('WEB_LEADER_RETRY_INTERVAL', 5))
+
+    # 事务发件箱：分发间隔（毫秒，同类事件在一个间隔内合并为一次广播）、每个节点每次读取的事件数、
+    # 超过该时间（秒）仍未推送的事件直接丢弃
+    OUTBOX_DISPATCH_INTERVAL_MS = float(os.getenv('OUTBOX_DISPATCH_INTERVAL_MS', 200))
+    OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 500))
+    OUTBOX_MAX_AGE = float(os.getenv('OUTBOX_MAX_AGE', 300))
+
+    # 页面变更推送：系统状态、账户和库存快照的刷新间隔（秒），有事件提交时提前刷新
+    CHANGE_FEED_INTERVAL = float(os.getenv('CHANGE_FEED_INTERVAL', 5))
+
+    # API响应的JSON编码器：auto（安装了orjson时使用orjson）或 json（标准库）
+    JSON_ENCODER = os.getenv('JSON_ENCODER', 'auto').lower()
+
+    # 列表接口键集分页：默认页大小和最大页大小
+    API_PAGE_SIZE = int(os.getenv('API_PAGE_SIZE', 100))
+    API_MAX_PAGE_SIZE = int(os.getenv('API_MAX_PAGE_SIZE', 1000))
 
 class LogConfig:
     """日志配置类"""
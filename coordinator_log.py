@@ -0,0 +1,275 @@
+"""
+协调者决策日志模块
+将2PC提交决策以组提交方式追加写入db2的transaction_logs表，第二阶段全部完成后删除，并在启动时恢复悬挂的XA分支
+"""
+import os
+import threading
+import time
+import uuid
+from typing import Dict, Iterable, List, Optional, Tuple
+from config import TransactionConfig
+from database_manager import get_db_manager
+from logger import transaction_logger, log_system_info, log_system_error
+
+class _PendingRecord:
+    """等待写入的日志记录"""
+
+    def __init__(self, rows: List[tuple], wait: bool):
+        self.rows = rows
+        self.event = threading.Event() if wait else None
+        self.error: Optional[Exception] = None
+
+class CoordinatorLog:
+    """协调者决策日志（追加写入，组提交）"""
+
+    def __init__(self, db_manager, node_id: str = None):
+        self.db_manager = db_manager
+        self.node_id = node_id or TransactionConfig.COORDINATOR_LOG_NODE
+        self.batch_size = TransactionConfig.COORDINATOR_LOG_BATCH_SIZE
+        self._pending: List[_PendingRecord] = []
+        self._condition = threading.Condition()
+        self._closed = False
+        self.flush_count = 0
+        self.record_count = 0
+        self._writer = threading.Thread(target=self._writer_loop, daemon=True,
+                                        name='coordinator-log-writer')
+        self._writer.start()
+
+    def log_decision(self, transaction_id: str, participants: List[str], decision: str = 'COMMIT'):
+        """持久化提交决策，返回时决策已落盘"""
+        rows = [(transaction_id, participant_id, 'DECISION', decision, None)
+                for participant_id in participants]
+        record = self._enqueue(rows, wait=True)
+        record.event.wait()
+        if record.error is not None:
+            raise Exception(f"Failed to log decision for transaction {transaction_id}: {record.error}")
+
+    def log_end(self, transaction_id: str):
+        """事务的所有分支都已提交，决策不再需要：随下一次组提交删除（不等待落盘）"""
+        self._enqueue([(transaction_id, 'coordinator', 'END', 'DONE', None)], wait=False)
+
+    def get_decision_record(self, transaction_id: str) -> Optional[Tuple[str, float]]:
+        """查询事务的已持久化决策及其写入至今的秒数"""
+        result = self.db_manager.execute_query(self.node_id, """
+            SELECT status, TIMESTAMPDIFF(SECOND, timestamp, NOW()) AS age FROM transaction_logs
+            WHERE transaction_id = %s AND operation_type = 'DECISION'
+            LIMIT 1
+        """, (transaction_id,), primary=True)
+        return (result[0]['status'], float(result[0]['age'])) if result else None
+
+    def purge_decisions(self, older_than: float, keep: Iterable[str] = ()) -> int:
+        """删除写入超过older_than秒的决策（keep中的事务仍有悬挂分支，保留），返回删除的行数"""
+        keep = tuple(keep)
+        condition = f" AND transaction_id NOT IN ({', '.join(['%s'] * len(keep))})" if keep else ""
+        conn = self.db_manager.get_connection(self.node_id)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM transaction_logs WHERE operation_type = 'DECISION' "
+                           f"AND timestamp < NOW() - INTERVAL %s SECOND{condition}",
+                           (int(older_than),) + keep)
+            purged = cursor.rowcount
+            conn.commit()
+            cursor.close()
+            return purged
+        finally:
+            conn.close()
+
+    def _enqueue(self, rows: List[tuple], wait: bool) -> _PendingRecord:
+        """加入待写队列并唤醒写线程"""
+        record = _PendingRecord(rows, wait)
+        with self._condition:
+            if self._closed:
+                raise Exception("Coordinator log is closed")
+            self._pending.append(record)
+            self._condition.notify()
+        return record
+
+    def _writer_loop(self):
+        """写线程：一次写入期间到达的记录合并为下一次组提交"""
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending and self._closed:
+                    return
+
+                batch, rows = [], []
+                while self._pending and len(rows) < self.batch_size:
+                    record = self._pending.pop(0)
+                    batch.append(record)
+                    rows.extend(record.rows)
+
+            error = None
+            try:
+                self._flush(rows)
+            except Exception as e:
+                error = e
+                log_system_error("CoordinatorLog.flush", str(e))
+
+            for record in batch:
+                record.error = error
+                if record.event is not None:
+                    record.event.set()
+
+    def _flush(self, rows: List[tuple]):
+        """多行插入决策、删除已完成事务的决策，并一次提交"""
+        inserts = [row for row in rows if row[2] != 'END']
+        finished = [row[0] for row in rows if row[2] == 'END']
+        conn = self.db_manager.get_connection(self.node_id)
+        try:
+            cursor = conn.cursor()
+            if inserts:
+                cursor.executemany("""
+                    INSERT INTO transaction_logs (transaction_id, participant_id, operation_type, status, details)
+                    VALUES (%s, %s, %s, %s, %s)
+                """, inserts)
+            if finished:
+                placeholders = ', '.join(['%s'] * len(finished))
+                cursor.execute(f"DELETE FROM transaction_logs WHERE transaction_id IN ({placeholders})",
+                               tuple(finished))
+            conn.commit()
+            cursor.close()
+            self.flush_count += 1
+            self.record_count += len(rows)
+        finally:
+            conn.close()
+
+    def close(self):
+        """写完剩余记录后停止写线程"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._writer.join(timeout=5)
+
+# UUID时间戳（1582-10-15起的100纳秒数）与Unix时间的差
+_UUID_EPOCH_OFFSET = 0x01b21dd213814000
+
+def transaction_age(transaction_id: str, now: float = None) -> Optional[float]:
+    """由事务ID（uuid1）得到事务开始至今的秒数，不含时间戳的ID返回None"""
+    parsed = uuid.UUID(transaction_id)
+    if parsed.version != 1:
+        return None
+    started = (parsed.time - _UUID_EPOCH_OFFSET) / 1e7
+    return (now if now is not None else time.time()) - started
+
+def _parse_xid(xid: str) -> Optional[str]:
+    """从XA分支ID中解析本系统生成的事务ID，非本系统的分支返回None"""
+    transaction_id, _, participant_id = xid.partition('_')
+    if not participant_id:
+        return None
+    try:
+        uuid.UUID(transaction_id)
+    except ValueError:
+        return None
+    return transaction_id
+
+def _recoverable(transaction_id: str, record: Optional[Tuple[str, float]], older_than: float) -> bool:
+    """
+    分支是否可由恢复流程处理：事务开始超过older_than秒（没有决策的分支此时已不可能再被其协调者提交），
+    且决策写入已超过事务超时时间（仍在第二阶段的协调者会自行完成提交）
+    """
+    age = transaction_age(transaction_id)
+    if age is not None and age < older_than:
+        return False
+    return record is None or record[1] >= TransactionConfig.TRANSACTION_TIMEOUT
+
+def recover_in_doubt_transactions(db_manager=None, coordinator_log: CoordinatorLog = None,
+                                  older_than: float = None) -> Dict[str, int]:
+    """
+    恢复悬挂的XA分支：对每个节点执行XA RECOVER，
+    已记录COMMIT决策的分支提交，其余分支回滚（推定中止）。
+    开始不足older_than秒（默认XA_RECOVERY_GRACE）或决策刚写入的分支可能属于仍在运行的协调者
+    （其他进程、主机或迁移），跳过不处理，因此可以在其他协调者运行时执行。
+    所有节点都扫描成功时，删除已没有悬挂分支且写入超过older_than秒的决策（协调者未能删除的决策）
+    """
+    db_manager = db_manager or get_db_manager()
+    coordinator_log = coordinator_log or get_coordinator_log()
+    older_than = older_than if older_than is not None else TransactionConfig.XA_RECOVERY_GRACE
+    summary = {'committed': 0, 'rolled_back': 0, 'skipped': 0, 'failed': 0, 'purged': 0}
+    decisions: Dict[str, Optional[Tuple[str, float]]] = {}
+    unresolved = set()  # 仍有悬挂分支的事务，其决策不能删除
+    scanned = True
+
+    for node_id in db_manager.nodes:
+        conn = None
+        try:
+            conn = db_manager.get_connection(node_id)
+            cursor = conn.cursor()
+            cursor.execute("XA RECOVER")
+            xids = []
+            for row in cursor.fetchall():
+                data = row[3]
+                xids.append(data.decode() if isinstance(data, (bytes, bytearray)) else data)
+
+            for xid in xids:
+                transaction_id = _parse_xid(xid)
+                if transaction_id is None:
+                    continue
+
+                if transaction_id not in decisions:
+                    decisions[transaction_id] = coordinator_log.get_decision_record(transaction_id)
+                record = decisions[transaction_id]
+                if not _recoverable(transaction_id, record, older_than):
+                    unresolved.add(transaction_id)
+                    summary['skipped'] += 1
+                    transaction_logger.info(f"Skipped recent in-doubt branch {xid} on {node_id}")
+                    continue
+                decision = record[0] if record else None
+
+                try:
+                    if decision == 'COMMIT':
+                        cursor.execute(f"XA COMMIT '{xid}'")
+                        summary['committed'] += 1
+                    else:
+                        cursor.execute(f"XA ROLLBACK '{xid}'")
+                        summary['rolled_back'] += 1
+                    transaction_logger.info(f"Recovered in-doubt branch {xid} on {node_id}: "
+                                          f"{decision or 'ROLLBACK'}")
+                except Exception as e:
+                    unresolved.add(transaction_id)
+                    summary['failed'] += 1
+                    transaction_logger.error(f"Failed to recover branch {xid} on {node_id}: {e}")
+
+            cursor.close()
+
+        except Exception as e:
+            scanned = False
+            summary['failed'] += 1
+            log_system_error(f"Recovery.{node_id}", str(e))
+        finally:
+            if conn:
+                try:
+                    conn.close()
+                except:
+                    pass
+
+    if scanned:
+        try:
+            summary['purged'] = coordinator_log.purge_decisions(older_than, unresolved)
+        except Exception as e:
+            log_system_error("Recovery.purge", str(e))
+
+    log_system_info("Recovery", f"In-doubt transaction recovery finished: {summary}")
+    return summary
+
+# 全局协调者日志实例 - 延迟初始化
+coordinator_log = None
+_coordinator_log_lock = threading.Lock()
+
+def get_coordinator_log() -> CoordinatorLog:
+    """获取协调者日志实例（单例模式）"""
+    global coordinator_log
+    if coordinator_log is None:
+        with _coordinator_log_lock:
+            if coordinator_log is None:
+                coordinator_log = CoordinatorLog(get_db_manager())
+    return coordinator_log
+
+def _reset_after_fork():
+    """子进程丢弃继承的实例（引用父进程的数据库管理器），首次使用时重新创建"""
+    global coordinator_log, _coordinator_log_lock
+    coordinator_log = None
+    _coordinator_log_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -3,13 +3,416 @@
 管理分布式数据库连接和操作
 """
 import mysql.connector
-from mysql.connector import Error, pooling
+from mysql.connector import Error, InterfaceError, OperationalError, PoolError
+import math
+import os
 import threading
 import time
-from typing import List, Dict, Optional, Tuple
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from enum import Enum
+from typing import Callable, Iterable, Iterator, List, Dict, Optional, Tuple
 from config import DatabaseConfig
 from logger import database_logger, log_connection_event, log_database_operation
 
+class ResultSet(list):
+    """查询结果行列表，附带游标的列描述（cursor.description），供序列化按列类型转换"""
+
+    def __init__(self, rows: Iterable[Dict] = (), description=None):
+        super().__init__(rows)
+        self.description = description
+
+class StatementRegistry:
+    """
+    物理连接上的预编译语句缓存：每条SQL文本对应一个prepared游标，首次执行时在服务端预编译，
+    之后只发送参数。语句属于连接会话，会话重置或重连后必须清空
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+        # SQL文本 -> (首次使用的SQL对象, prepared游标)；游标按对象身份判断是否需要重新预编译
+        self._statements: Dict[str, Tuple[str, object]] = {}
+        self.prepares = 0
+        self.executions = 0
+
+    def __len__(self) -> int:
+        return len(self._statements)
+
+    def execute(self, sql: str, params: Tuple = ()):
+        """执行预编译语句并返回其游标（游标归注册表所有，调用方不要关闭）"""
+        statement = self._statements.get(sql)
+        if statement is None:
+            cursor = self._connection.cursor(prepared=True)
+            statement = (sql, cursor)
+            self._statements[sql] = statement
+            self.prepares += 1
+        self.executions += 1
+        canonical_sql, cursor = statement
+        cursor.execute(canonical_sql, params)
+        return cursor
+
+    def clear(self):
+        """丢弃所有语句（服务端语句已随会话重置释放）"""
+        self._statements.clear()
+
+class _PoolEntry:
+    """连接池中的物理连接及其时间信息"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.statements = StatementRegistry(connection)
+
+class PooledConnection:
+    """借出的池化连接，close()时归还连接池，其余属性透传给物理连接"""
+
+    def __init__(self, pool: 'ConnectionPool', entry: _PoolEntry):
+        self._pool = pool
+        self._entry = entry
+        self._cnx = entry.connection
+        # 借出前在池中空闲的秒数
+        self.idle_seconds = time.time() - entry.last_used
+        # 提交成功后的回调（用于记录会话写入）
+        self.on_commit = None
+
+    def __getattr__(self, name):
+        return getattr(self._cnx, name)
+
+    def commit(self):
+        """提交本地事务"""
+        self._cnx.commit()
+        if self.on_commit is not None:
+            self.on_commit()
+
+    @property
+    def keeps_statements(self) -> bool:
+        """预编译语句能否跨借出复用：重置会话会释放服务端语句，只在归还时不重置会话的连接池上缓存"""
+        return DatabaseConfig.PREPARED_STATEMENTS and not self._pool.reset_session
+
+    @property
+    def statements(self) -> StatementRegistry:
+        """该物理连接的预编译语句缓存"""
+        if self._entry is None:
+            raise PoolError("Connection has already been returned to the pool")
+        return self._entry.statements
+
+    def discard(self):
+        """丢弃该连接（连接已损坏时使用），不再放回池中"""
+        if self._entry is not None:
+            entry, self._entry = self._entry, None
+            self._pool._release(entry, discard=True)
+
+    def close(self):
+        """归还连接"""
+        if self._entry is not None:
+            entry, self._entry = self._entry, None
+            self._pool._release(entry)
+
+def execute_statement(conn, sql: str, params: Tuple = ()) -> Tuple[List[tuple], int, Optional[int]]:
+    """
+    执行一条热点语句，返回 (结果行, 影响行数, 自增ID)。
+    语句能跨借出保留的池化连接上复用该连接的服务端预编译语句，其他连接或未启用时使用普通游标
+    """
+    if isinstance(conn, PooledConnection) and conn.keeps_statements:
+        cursor = conn.statements.execute(sql, params)
+        rows = cursor.fetchall() if cursor.with_rows else []
+        return rows, cursor.rowcount, cursor.lastrowid
+
+    cursor = conn.cursor()
+    cursor.execute(sql, params)
+    rows = cursor.fetchall() if cursor.with_rows else []
+    result = (rows, cursor.rowcount, cursor.lastrowid)
+    cursor.close()
+    return result
+
+class ConnectionPool:
+    """自管理连接池：弹性大小、有界等待队列、空闲回收、最大存活时间和借出指标"""
+
+    def __init__(self, name: str, config: Dict, min_size: int = None, max_size: int = None):
+        self.name = name
+        self.config = config
+        self.min_size = DatabaseConfig.POOL_MIN_SIZE if min_size is None else min_size
+        self.max_size = max_size or DatabaseConfig.CONNECTION_POOL_SIZE
+        self.checkout_timeout = DatabaseConfig.POOL_CHECKOUT_TIMEOUT
+        self.max_waiters = DatabaseConfig.POOL_MAX_WAITERS
+        self.idle_timeout = DatabaseConfig.POOL_IDLE_TIMEOUT
+        self.max_lifetime = DatabaseConfig.POOL_MAX_LIFETIME
+        self.reset_session = DatabaseConfig.POOL_RESET_SESSION
+
+        self._idle = deque()  # 右端最近归还，左端最久未用
+        self._total = 0       # 已建立和正在建立的连接数
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+        # 指标
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.created = 0
+        self.closed = 0
+        self.total_checkout_time = 0.0
+        self.max_checkout_time = 0.0
+
+    def fill_min(self):
+        """补足最小连接数，连接失败时抛出异常"""
+        while True:
+            with self._condition:
+                if self._closed or self._total >= self.min_size:
+                    return
+                self._total += 1
+            entry = self._open_entry()
+            with self._condition:
+                entry.last_used = time.time()
+                self._idle.append(entry)
+
+    def _open_entry(self) -> _PoolEntry:
+        """建立物理连接（调用前已占用连接名额）"""
+        try:
+            connection = mysql.connector.connect(**self.config)
+        except Exception:
+            with self._condition:
+                self._total -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self.created += 1
+        return _PoolEntry(connection)
+
+    def _close_entry(self, entry: _PoolEntry):
+        """关闭物理连接（调用前已释放连接名额）"""
+        with self._condition:
+            self.closed += 1
+        try:
+            entry.connection.close()
+        except Exception:
+            pass
+
+    def _is_expired(self, entry: _PoolEntry, now: float) -> bool:
+        """连接超过最大存活时间"""
+        return self.max_lifetime > 0 and now - entry.created_at > self.max_lifetime
+
+    def _evict_locked(self, now: float) -> List[_PoolEntry]:
+        """取出空闲超时（保留min_size个）和超过存活时间的连接，调用方负责关闭"""
+        evicted = []
+        for entry in list(self._idle):
+            idle_expired = (self.idle_timeout > 0 and now - entry.last_used > self.idle_timeout
+                            and self._total - len(evicted) > self.min_size)
+            if idle_expired or self._is_expired(entry, now):
+                self._idle.remove(entry)
+                evicted.append(entry)
+        self._total -= len(evicted)
+        return evicted
+
+    def get_connection(self, timeout: float = None) -> PooledConnection:
+        """借出连接：优先复用空闲连接，未达上限时新建，否则排队等待归还"""
+        timeout = self.checkout_timeout if timeout is None else timeout
+        start = time.time()
+        deadline = start + timeout
+        entry = None
+        evicted = []
+        create = False
+        waited = False
+        exhausted = False
+
+        with self._condition:
+            if self._closed:
+                raise PoolError(f"Connection pool {self.name} is closed")
+
+            while True:
+                evicted.extend(self._evict_locked(time.time()))
+                if self._idle:
+                    entry = self._idle.pop()
+                    break
+                if self._total < self.max_size:
+                    self._total += 1
+                    create = True
+                    break
+
+                remaining = deadline - time.time()
+                if remaining <= 0 or (not waited and self._waiting >= self.max_waiters):
+                    self.timeouts += 1
+                    exhausted = True
+                    in_use, waiting = self._in_use, self._waiting
+                    break
+
+                if not waited:
+                    waited = True
+                    self.waits += 1
+                self._waiting += 1
+                try:
+                    self._condition.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+            if not exhausted:
+                self._in_use += 1
+
+        for stale in evicted:
+            self._close_entry(stale)
+
+        if exhausted:
+            raise PoolError(f"Connection pool {self.name} exhausted: "
+                            f"{in_use} in use, {waiting} waiting")
+
+        if create:
+            try:
+                entry = self._open_entry()
+            except Exception:
+                with self._condition:
+                    self._in_use -= 1
+                raise
+
+        elapsed = time.time() - start
+        with self._condition:
+            self.checkouts += 1
+            self.total_checkout_time += elapsed
+            self.max_checkout_time = max(self.max_checkout_time, elapsed)
+        return PooledConnection(self, entry)
+
+    def _release(self, entry: _PoolEntry, discard: bool = False):
+        """归还连接：重置会话失败、已过期或池已关闭时关闭连接"""
+        now = time.time()
+        if not discard:
+            try:
+                if self.reset_session:
+                    # 重置会话清除会话变量、临时表和用户锁，服务端预编译语句随之释放
+                    entry.connection.cmd_reset_connection()
+                    entry.statements.clear()
+                else:
+                    # 不重置会话时预编译语句跨借出复用，只回滚未结束的本地事务
+                    entry.connection.rollback()
+            except Exception as e:
+                database_logger.warning(f"Discarding connection from {self.name} after failed reset: {e}")
+                discard = True
+
+        with self._condition:
+            self._in_use -= 1
+            if discard or self._closed or self._is_expired(entry, now):
+                self._total -= 1
+                keep = False
+            else:
+                entry.last_used = now
+                self._idle.append(entry)
+                keep = True
+            self._condition.notify()
+
+        if not keep:
+            self._close_entry(entry)
+
+    def get_stats(self) -> Dict:
+        """连接池指标"""
+        with self._condition:
+            return {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'size': self._total,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'waiting': self._waiting,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'created': self.created,
+                'closed': self.closed,
+                'avg_checkout_ms': (self.total_checkout_time / self.checkouts * 1000
+                                    if self.checkouts else 0.0),
+                'max_checkout_ms': self.max_checkout_time * 1000
+            }
+
+    def close(self):
+        """关闭所有空闲连接，借出的连接归还时关闭"""
+        with self._condition:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._total -= len(idle)
+            self._condition.notify_all()
+        for entry in idle:
+            self._close_entry(entry)
+
+class CircuitState(Enum):
+    """熔断器状态枚举"""
+    CLOSED = "CLOSED"
+    OPEN = "OPEN"
+    HALF_OPEN = "HALF_OPEN"
+
+class CircuitBreaker:
+    """节点熔断器：连续失败达到阈值后打开并快速失败，冷却后半开放行少量试探请求"""
+
+    def __init__(self, name: str, failure_threshold: int = None, reset_timeout: float = None,
+                 half_open_max_calls: int = None):
+        self.name = name
+        self.failure_threshold = failure_threshold or DatabaseConfig.CIRCUIT_FAILURE_THRESHOLD
+        self.reset_timeout = (DatabaseConfig.CIRCUIT_RESET_TIMEOUT
+                              if reset_timeout is None else reset_timeout)
+        self.half_open_max_calls = half_open_max_calls or DatabaseConfig.CIRCUIT_HALF_OPEN_MAX_CALLS
+        self.state = CircuitState.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._half_open_calls = 0
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        """是否放行请求"""
+        with self._lock:
+            now = time.time()
+            if self.state == CircuitState.OPEN:
+                if now - self.opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self._transition(CircuitState.HALF_OPEN)
+                self.opened_at = now
+
+            if self.state == CircuitState.HALF_OPEN:
+                # 试探请求迟迟没有结果时重新放行
+                if (self._half_open_calls >= self.half_open_max_calls
+                        and now - self.opened_at < self.reset_timeout):
+                    self.rejected += 1
+                    return False
+                if self._half_open_calls >= self.half_open_max_calls:
+                    self._half_open_calls = 0
+                    self.opened_at = now
+                self._half_open_calls += 1
+
+            return True
+
+    def record_success(self):
+        """记录成功"""
+        with self._lock:
+            self.consecutive_failures = 0
+            if self.state != CircuitState.CLOSED:
+                self._transition(CircuitState.CLOSED)
+
+    def record_failure(self):
+        """记录失败"""
+        with self._lock:
+            self.consecutive_failures += 1
+            if (self.state == CircuitState.HALF_OPEN or
+                    self.consecutive_failures >= self.failure_threshold):
+                if self.state != CircuitState.OPEN:
+                    self._transition(CircuitState.OPEN)
+                self.opened_at = time.time()
+
+    def _transition(self, state: CircuitState):
+        """切换状态（调用方持有锁）"""
+        database_logger.warning(f"Circuit breaker {self.name}: {self.state.value} -> {state.value}")
+        self.state = state
+        self._half_open_calls = 0
+
+    def get_stats(self) -> Dict:
+        """熔断器状态"""
+        with self._lock:
+            return {
+                'state': self.state.value,
+                'consecutive_failures': self.consecutive_failures,
+                'rejected': self.rejected,
+                'opened_at': self.opened_at
+            }
+
 class DatabaseNode:
     """数据库节点类"""
 
@@ -20,51 +423,79 @@ class DatabaseNode:
         self.is_available = False
         self.last_check = 0
         self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.validations_performed = 0
+        self.validations_skipped = 0
+        self.breaker = CircuitBreaker(self.node_id)
+        # 最近的健康探测记录
+        self.health_history = deque(maxlen=DatabaseConfig.HEALTH_HISTORY_SIZE)
         self._create_connection_pool()
 
     def _create_connection_pool(self):
-        """创建连接池"""
+        """创建连接池并预建最小连接数（节点不可用时连接池仍然创建，按需重连）"""
+        if self.pool:
+            self.pool.close()
+        self.pool = ConnectionPool(f'pool_{self.node_id}', self.config)
+
         try:
-            pool_config = self.config.copy()
-            pool_config.update({
-                'pool_name': f'pool_{self.node_id}',
-                'pool_size': DatabaseConfig.CONNECTION_POOL_SIZE,
-                'pool_reset_session': True
-            })
-
-            self.pool = pooling.MySQLConnectionPool(**pool_config)
+            self.pool.fill_min()
             self.is_available = True
             log_connection_event(f"Connection pool created for node {self.node_id}",
                                f"{self.config['host']}:{self.config['port']}", True)
 
         except Error as e:
             self.is_available = False
+            self.breaker.record_failure()
             log_connection_event(f"Connection pool creation failed for node {self.node_id}",
                                f"{self.config['host']}:{self.config['port']}", False, str(e))
             database_logger.error(f"Failed to create connection pool for {self.node_id}: {e}")
 
     def get_connection(self):
-        """获取数据库连接"""
-        if not self.is_available:
-            raise Exception(f"Database node {self.node_id} is not available")
+        """获取数据库连接（熔断打开时快速失败）"""
+        if not self.breaker.allow_request():
+            raise Exception(f"Database node {self.node_id} is not available (circuit open)")
 
         try:
             connection = self.pool.get_connection()
             return connection
+        except PoolError:
+            # 连接池繁忙不代表节点故障，不计入熔断
+            raise
         except Error as e:
+            self.record_failure()
             log_connection_event(f"Get connection failed for node {self.node_id}",
                                f"{self.config['host']}:{self.config['port']}", False, str(e))
             raise e
 
-    def check_health(self) -> bool:
-        """检查节点健康状态"""
-        current_time = time.time()
+    def record_success(self):
+        """记录节点调用成功"""
+        self.breaker.record_success()
+        self.is_available = True
 
-        # 避免频繁检查
-        if current_time - self.last_check < 30:
-            return self.is_available
+    def record_failure(self):
+        """记录节点调用失败"""
+        self.breaker.record_failure()
+        if self.breaker.state == CircuitState.OPEN:
+            self.is_available = False
+
+    def validate_if_idle(self, connection) -> None:
+        """连接空闲超过阈值或熔断器半开（试探请求必须真正访问服务端）时用COM_PING校验，否则跳过校验"""
+        needs_validation = (self.breaker.state != CircuitState.CLOSED or
+                            getattr(connection, 'idle_seconds', None) is None or
+                            connection.idle_seconds > DatabaseConfig.CONNECTION_VALIDATION_IDLE_SECONDS)
+        with self._stats_lock:
+            if needs_validation:
+                self.validations_performed += 1
+            else:
+                self.validations_skipped += 1
 
+        if needs_validation:
+            connection.ping(reconnect=False)
+
+    def check_health(self) -> bool:
+        """立即探测节点健康状态（由后台健康检查器调用）"""
         with self._lock:
+            start = time.time()
             try:
                 conn = self.get_connection()
                 cursor = conn.cursor()
@@ -73,35 +504,316 @@ class DatabaseNode:
                 cursor.close()
                 conn.close()
 
-                self.is_available = True
-                self.last_check = current_time
+                self.record_probe(True, time.time() - start)
                 return True
 
             except Exception as e:
-                self.is_available = False
-                self.last_check = current_time
+                self.record_probe(False, time.time() - start, str(e))
                 database_logger.warning(f"Health check failed for {self.node_id}: {e}")
                 return False
 
+    def record_probe(self, ok: bool, latency: float, error: str = None):
+        """记录一次探测结果并更新缓存的可用状态"""
+        self.is_available = ok
+        self.last_check = time.time()
+        self.health_history.append({
+            'timestamp': self.last_check,
+            'ok': ok,
+            'latency_ms': round(latency * 1000, 3),
+            'error': error
+        })
+
+    def get_health_stats(self) -> Dict:
+        """探测延迟分位数和最近的探测记录"""
+        history = list(self.health_history)
+        latencies = sorted(record['latency_ms'] for record in history if record['ok'])
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[max(0, math.ceil(p * len(latencies)) - 1)]
+
+        return {
+            'probes': len(history),
+            'success_rate': (sum(1 for record in history if record['ok']) / len(history)
+                             if history else None),
+            'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'history': history[-DatabaseConfig.HEALTH_HISTORY_REPORT_SIZE:]
+        }
+
+class ReplicaNode(DatabaseNode):
+    """只读副本节点：健康检查时读取复制延迟，并统计进行中的查询数"""
+
+    def __init__(self, node_id: str, config: Dict, primary_id: str):
+        self.primary_id = primary_id
+        # 最近一次探测到的复制延迟（秒），未知时为None
+        self.lag_seconds: Optional[float] = None
+        self.active_queries = 0
+        super().__init__(node_id, config)
+
+    def check_health(self) -> bool:
+        """探测副本健康状态和复制延迟"""
+        with self._lock:
+            start = time.time()
+            try:
+                conn = self.get_connection()
+                cursor = conn.cursor(dictionary=True)
+                try:
+                    cursor.execute("SHOW REPLICA STATUS")
+                except Error:
+                    # MySQL 8.0.22之前的版本
+                    cursor.execute("SHOW SLAVE STATUS")
+                status = cursor.fetchone()
+                cursor.close()
+                conn.close()
+
+                # 复制线程停止时延迟为NULL，视为未知
+                lag = None
+                if status:
+                    lag = status.get('Seconds_Behind_Source', status.get('Seconds_Behind_Master'))
+                self.lag_seconds = None if lag is None else float(lag)
+                self.record_probe(True, time.time() - start)
+                return True
+
+            except Exception as e:
+                self.lag_seconds = None
+                self.record_probe(False, time.time() - start, str(e))
+                database_logger.warning(f"Health check failed for replica {self.node_id}: {e}")
+                return False
+
+    def is_fresh(self, max_lag: float) -> bool:
+        """副本可用且复制延迟不超过阈值"""
+        return (self.is_available and self.breaker.state != CircuitState.OPEN
+                and self.lag_seconds is not None and self.lag_seconds <= max_lag)
+
+    def track_query(self, delta: int):
+        """更新进行中的查询数"""
+        with self._stats_lock:
+            self.active_queries += delta
+
+class ReadSession:
+    """读会话：记录会话内最近写入各节点的时间，写入后的一段时间内对该节点的读取走主节点"""
+
+    def __init__(self, writes: Dict[str, float] = None):
+        self.writes: Dict[str, float] = dict(writes or {})
+
+    def record_write(self, node_id: str):
+        """记录一次写入"""
+        self.writes[node_id] = time.time()
+
+    def wrote_recently(self, node_id: str, window: float) -> bool:
+        """窗口内是否写入过该节点"""
+        return time.time() - self.writes.get(node_id, 0) <= window
+
+class HealthMonitor:
+    """后台健康检查器：单个调度线程按间隔并发探测所有节点，读取方只读缓存状态"""
+
+    def __init__(self, nodes: Dict[str, DatabaseNode], interval: float = None, timeout: float = None):
+        self.nodes = nodes
+        self.interval = interval or DatabaseConfig.HEALTH_CHECK_INTERVAL
+        self.timeout = timeout or DatabaseConfig.HEALTH_CHECK_TIMEOUT
+        self.last_round = 0.0
+        # 每轮探测结束后以 {节点ID: 探测记录} 调用（多worker时由leader广播给其他worker）
+        self.on_round: Optional[Callable[[Dict[str, Dict]], None]] = None
+        self._in_flight: Dict[str, object] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(nodes)),
+                                            thread_name_prefix='health-probe')
+        self._round_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        """调度线程是否在运行"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """启动调度线程"""
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True, name='health-monitor')
+        self._thread.start()
+        database_logger.info(f"Health monitor started (interval {self.interval}s, timeout {self.timeout}s)")
+
+    def stop(self):
+        """停止调度线程"""
+        self._stop.set()
+
+    def _loop(self):
+        """按固定间隔执行探测"""
+        while not self._stop.is_set():
+            try:
+                self.run_round()
+            except Exception as e:
+                database_logger.error(f"Health monitor round failed: {e}")
+            self._stop.wait(self.interval)
+
+    def run_round(self):
+        """并发探测所有节点，超时的节点记为不可用；上一次探测仍未返回的节点本轮跳过"""
+        with self._round_lock:
+            futures = {}
+            start = time.time()
+            for node_id, node in self.nodes.items():
+                previous = self._in_flight.get(node_id)
+                if previous is not None and not previous.done():
+                    continue
+                future = self._executor.submit(node.check_health)
+                futures[future] = node_id
+                self._in_flight[node_id] = future
+
+            _, not_done = wait(futures, timeout=self.timeout)
+            for future in not_done:
+                node_id = futures[future]
+                self.nodes[node_id].record_probe(False, time.time() - start,
+                                                 f"probe timed out after {self.timeout}s")
+                database_logger.warning(f"Health check timed out for {node_id}")
+
+            self.last_round = time.time()
+            if self.on_round is not None:
+                self.on_round({node_id: self.nodes[node_id].health_history[-1] for node_id in futures.values()})
+
+    def apply_round(self, results: Dict[str, Dict]):
+        """采用其他进程的探测结果，本进程在一个间隔内不再自行探测"""
+        for node_id, record in results.items():
+            node = self.nodes.get(node_id)
+            if node is not None:
+                node.record_probe(record['ok'], record['latency_ms'] / 1000, record['error'])
+        self.last_round = time.time()
+
+    def ensure_fresh(self):
+        """调度线程未运行且缓存过期时同步执行一轮探测（命令行等场景）"""
+        if not self.running and time.time() - self.last_round > self.interval:
+            self.run_round()
+
+class QueryCache:
+    """
+    查询结果缓存：按LRU淘汰并按TTL过期。
+    每条结果带 (节点, 表) 标签，写入提交后按标签失效；标签版本号用于丢弃与失效并发的旧结果
+    """
+
+    def __init__(self, max_entries: int = None, ttl: float = None):
+        self.max_entries = max(1, max_entries or DatabaseConfig.QUERY_CACHE_MAX_ENTRIES)
+        self.ttl = DatabaseConfig.QUERY_CACHE_TTL if ttl is None else ttl
+        # key -> (过期时间, 结果行, 标签)
+        self._entries: "OrderedDict[Tuple, Tuple[float, List[Dict], Tuple]]" = OrderedDict()
+        self._versions: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _copy(rows: List[Dict]) -> List[Dict]:
+        """复制结果行，调用方修改返回值不影响缓存"""
+        return ResultSet((dict(row) for row in rows), getattr(rows, 'description', None))
+
+    def get(self, key: Tuple) -> Optional[List[Dict]]:
+        """读取未过期的缓存结果，未命中返回None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._copy(entry[1])
+
+    def version(self, tags: Tuple) -> Tuple:
+        """标签当前的版本号，查询前读取，写入缓存时比对"""
+        with self._lock:
+            return tuple(self._versions.get(tag, 0) for tag in tags)
+
+    def put(self, key: Tuple, rows: List[Dict], tags: Tuple, version: Tuple) -> bool:
+        """写入缓存；查询期间标签已失效时放弃写入"""
+        with self._lock:
+            if tuple(self._versions.get(tag, 0) for tag in tags) != version:
+                return False
+            self._entries[key] = (time.time() + self.ttl, self._copy(rows), tags)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def invalidate(self, node_id: str, table: str) -> int:
+        """使某节点上某张表的所有缓存结果失效，返回删除的条目数"""
+        tag = (node_id, table)
+        with self._lock:
+            self._versions[tag] = self._versions.get(tag, 0) + 1
+            stale = [key for key, (_, _, tags) in self._entries.items() if tag in tags]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+            return len(stale)
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self) -> Dict:
+        """缓存统计"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
 class DatabaseManager:
     """分布式数据库管理器"""
 
     def __init__(self):
         self.nodes: Dict[str, DatabaseNode] = {}
+        self.replicas: Dict[str, List[ReplicaNode]] = {}
         self._initialize_nodes()
+        # 主节点和副本都由后台健康检查器探测
+        self.health_monitor = HealthMonitor(self._all_nodes())
+        self._round_robin: Dict[str, int] = {}
+        self._route_lock = threading.Lock()
+        self._local = threading.local()
+        self.query_cache = QueryCache() if DatabaseConfig.QUERY_CACHE_ENABLED else None
+        # 缓存失效后以 (节点ID, 表名) 调用（多worker时广播给其他worker）
+        self.on_invalidate: Optional[Callable[[str, Tuple[str, ...]], None]] = None
+
+    def _all_nodes(self) -> Dict[str, DatabaseNode]:
+        """所有主节点和副本节点"""
+        nodes = dict(self.nodes)
+        for replicas in self.replicas.values():
+            nodes.update((replica.node_id, replica) for replica in replicas)
+        return nodes
+
+    def start_health_monitor(self):
+        """启动后台健康检查"""
+        self.health_monitor.start()
 
     def _initialize_nodes(self):
         """初始化数据库节点"""
-        # 初始化数据库1
-        db1_config = DatabaseConfig.get_db1_config()
-        self.nodes['db1'] = DatabaseNode('db1', db1_config)
-
-        # 初始化数据库2
-        db2_config = DatabaseConfig.get_db2_config()
-        self.nodes['db2'] = DatabaseNode('db2', db2_config)
+        # 按配置初始化所有节点（默认db1、db2）及其只读副本
+        for node_id in DatabaseConfig.get_node_ids():
+            self.nodes[node_id] = DatabaseNode(node_id, DatabaseConfig.get_node_config(node_id))
+            self.replicas[node_id] = [
+                ReplicaNode(f"{node_id}-replica{index + 1}", config, node_id)
+                for index, config in enumerate(DatabaseConfig.get_replica_configs(node_id))
+            ]
 
         database_logger.info("Database manager initialized with nodes: " +
                            ", ".join(self.nodes.keys()))
+        if DatabaseConfig.PREPARED_STATEMENTS and DatabaseConfig.POOL_RESET_SESSION:
+            database_logger.warning("PREPARED_STATEMENTS has no effect while POOL_RESET_SESSION is enabled, "
+                                    "hot statements use the text protocol")
 
     def get_all_connections(self) -> List[mysql.connector.MySQLConnection]:
         """获取所有数据库连接"""
@@ -123,52 +835,200 @@ class DatabaseManager:
         return connections
 
     def get_connection(self, node_id: str) -> mysql.connector.MySQLConnection:
-        """获取指定节点的连接（带重连机制）"""
+        """获取指定节点的连接（失效连接单独丢弃并重连，节点故障时由熔断器快速失败）"""
         if node_id not in self.nodes:
             raise ValueError(f"Unknown database node: {node_id}")
 
-        node = self.nodes[node_id]
-        max_retries = 3
-        retry_delay = 1
+        connection = self._checkout(self.nodes[node_id])
+        # 本地事务提交后记录会话写入，保证读己之写
+        connection.on_commit = lambda: self.record_write(node_id)
+        return connection
 
-        for attempt in range(max_retries):
-            try:
-                connection = node.get_connection()
-                # 测试连接是否有效
-                cursor = connection.cursor()
-                cursor.execute("SELECT 1")
-                cursor.fetchone()
-                cursor.close()
+    def _checkout(self, node: DatabaseNode, record_success: bool = True):
+        """从节点借出一个校验过的连接；record_success为False时由调用方按后续语句的结果记录熔断成功"""
+        last_error = None
 
-                return connection
+        for attempt in range(DatabaseConfig.CONNECTION_CHECKOUT_ATTEMPTS):
+            connection = node.get_connection()
+            try:
+                # 仅校验空闲较久的连接，最近使用过的连接直接返回
+                node.validate_if_idle(connection)
             except Exception as e:
-                database_logger.warning(f"Connection attempt {attempt + 1} failed for {node_id}: {e}")
+                # 只丢弃这一个失效连接，下次尝试复用其他空闲连接或新建连接
+                connection.discard()
+                last_error = e
+                database_logger.warning(f"Connection attempt {attempt + 1} failed for {node.node_id}: {e}")
+                continue
 
-                if attempt < max_retries - 1:
-                    # 尝试重新创建连接池
-                    try:
-                        node._create_connection_pool()
-                        time.sleep(retry_delay)
-                        retry_delay *= 2  # 指数退避
-                    except Exception as recreate_error:
-                        database_logger.error(f"Failed to recreate pool for {node_id}: {recreate_error}")
-                else:
-                    # 最后一次尝试失败，抛出异常
-                    raise Exception(f"Database node {node_id} is not available")
+            if record_success:
+                node.record_success()
+            return connection
+
+        node.record_failure()
+        raise Exception(f"Database node {node.node_id} is not available: {last_error}")
+
+    def bind_session(self, session: Optional[ReadSession]) -> Optional[ReadSession]:
+        """把读会话绑定到当前线程，返回之前绑定的会话"""
+        previous = getattr(self._local, 'session', None)
+        self._local.session = session
+        return previous
+
+    def current_session(self) -> Optional[ReadSession]:
+        """当前线程绑定的读会话"""
+        return getattr(self._local, 'session', None)
+
+    def record_write(self, node_id: str):
+        """记录当前会话对节点的写入"""
+        session = self.current_session()
+        if session is not None:
+            session.record_write(node_id)
+
+    def select_replica(self, node_id: str) -> Optional[ReplicaNode]:
+        """按配置的策略选择一个延迟达标的副本，没有时返回None"""
+        candidates = [replica for replica in self.replicas.get(node_id, [])
+                      if replica.is_fresh(DatabaseConfig.REPLICA_MAX_LAG_SECONDS)]
+        if not candidates:
+            return None
+
+        if DatabaseConfig.REPLICA_SELECTION == 'least_loaded':
+            return min(candidates, key=lambda replica: replica.active_queries)
+
+        with self._route_lock:
+            index = self._round_robin.get(node_id, 0)
+            self._round_robin[node_id] = index + 1
+        return candidates[index % len(candidates)]
+
+    def _route_read(self, node_id: str, query: str) -> Optional[ReplicaNode]:
+        """只读查询且会话近期未写入该节点时选择副本"""
+        if not self.replicas.get(node_id):
+            return None
+        if not query.lstrip().upper().startswith(('SELECT', 'SHOW')) or 'FOR UPDATE' in query.upper():
+            return None
+        if self._wrote_recently(node_id):
+            return None
+        return self.select_replica(node_id)
+
+    def _wrote_recently(self, node_id: str) -> bool:
+        """当前会话是否在读己之写窗口内写入过该节点"""
+        session = self.current_session()
+        return session is not None and session.wrote_recently(node_id, DatabaseConfig.READ_YOUR_WRITES_WINDOW)
+
+    def invalidate_cache(self, node_id: str, *tables: str, broadcast: bool = True):
+        """写入提交后使节点上相关表的缓存结果失效；broadcast为False时只失效本进程（处理其他进程的通知）"""
+        if self.query_cache is not None:
+            for table in tables:
+                self.query_cache.invalidate(node_id, table)
+            if broadcast and self.on_invalidate is not None:
+                self.on_invalidate(node_id, tables)
+
+    def get_cache_stats(self) -> Optional[Dict]:
+        """查询缓存统计，未启用时返回None"""
+        return self.query_cache.get_stats() if self.query_cache is not None else None
 
     def get_available_nodes(self) -> List[str]:
-        """获取可用的数据库节点"""
-        available = []
-        for node_id, node in self.nodes.items():
-            if node.check_health():
-                available.append(node_id)
-        return available
+        """获取可用的数据库节点（读取健康检查缓存）"""
+        self.health_monitor.ensure_fresh()
+        return [node_id for node_id, node in self.nodes.items() if node.is_available]
+
+    def execute_query(self, node_id: str, query: str, params: Optional[Tuple] = None,
+                      primary: bool = False, cache_tables: Tuple[str, ...] = None) -> List:
+        """
+        在指定节点执行查询：只读查询优先路由到延迟达标的副本，副本失败时回退到主节点；
+        primary为True时强制读主节点。连接失效时换一个连接透明重试一次。
+        cache_tables列出查询读取的表时结果进入查询缓存，这些表的写入提交后失效；
+        缓存未命中时读主节点，落后的副本结果不会以失效后的版本写入缓存
+        """
+        if node_id not in self.nodes:
+            raise ValueError(f"Unknown database node: {node_id}")
+
+        # 会话刚写入该节点时绕过缓存，保证读己之写
+        if not cache_tables or self.query_cache is None or primary or self._wrote_recently(node_id):
+            return self._execute_routed(node_id, query, params, primary)
+
+        key = (node_id, query, tuple(params) if params else None)
+        rows = self.query_cache.get(key)
+        if rows is not None:
+            return rows
+
+        tags = tuple((node_id, table) for table in cache_tables)
+        version = self.query_cache.version(tags)
+        rows = self._execute_routed(node_id, query, params, primary=True)
+        self.query_cache.put(key, rows, tags, version)
+        return rows
+
+    def _execute_routed(self, node_id: str, query: str, params: Optional[Tuple], primary: bool) -> List:
+        """按读写分离规则选择副本或主节点执行查询"""
+        replica = None if primary else self._route_read(node_id, query)
+        if replica is not None:
+            replica.track_query(1)
+            try:
+                return self._execute_with_retry(replica, query, params)
+            except Exception as e:
+                database_logger.warning(f"Read on replica {replica.node_id} failed, "
+                                      f"falling back to {node_id}: {e}")
+            finally:
+                replica.track_query(-1)
+
+        return self._execute_with_retry(self.nodes[node_id], query, params)
 
-    def execute_query(self, node_id: str, query: str, params: Optional[Tuple] = None) -> List:
-        """在指定节点执行查询"""
+    def stream_query(self, node_id: str, query: str, params: Optional[Tuple] = None,
+                     fetch_size: int = None) -> Iterator[Dict]:
+        """
+        流式执行查询：用非缓冲游标按批从服务端读取结果，内存占用与结果集大小无关。
+        生成器结束前一直占用一个连接；中途停止读取时该连接被丢弃而不是放回连接池
+        """
+        if node_id not in self.nodes:
+            raise ValueError(f"Unknown database node: {node_id}")
+        fetch_size = fetch_size or DatabaseConfig.STREAM_FETCH_SIZE
+
+        replica = self._route_read(node_id, query)
+        node = replica or self.nodes[node_id]
+        try:
+            conn = self._checkout(node)
+        except Exception as e:
+            if replica is None:
+                raise
+            database_logger.warning(f"Stream on replica {replica.node_id} failed, falling back to {node_id}: {e}")
+            node = self.nodes[node_id]
+            conn = self._checkout(node)
+
+        finished = False
+        try:
+            cursor = conn.cursor(dictionary=True, buffered=False)
+            cursor.execute(query, params or ())
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                yield from rows
+            cursor.close()
+            finished = True
+            log_database_operation("SELECT", node.node_id, "stream", True)
+
+        except Exception as e:
+            log_database_operation("SELECT", node.node_id, "stream", False, str(e))
+            raise
+        finally:
+            # 未读完的结果仍留在连接上，不能复用
+            if finished:
+                conn.close()
+            else:
+                conn.discard()
+
+    def _execute_with_retry(self, node: DatabaseNode, query: str, params: Optional[Tuple]) -> List:
+        """执行查询，遇到失效连接时重试一次"""
+        try:
+            return self._execute_query_once(node, query, params)
+        except (InterfaceError, OperationalError) as e:
+            database_logger.warning(f"Query on {node.node_id} failed on a stale connection, retrying: {e}")
+            return self._execute_query_once(node, query, params)
+
+    def _execute_query_once(self, node: DatabaseNode, query: str, params: Optional[Tuple] = None) -> List:
+        """在指定节点执行一次查询"""
         conn = None
         try:
-            conn = self.get_connection(node_id)
+            # 查询成功才算节点正常：能建立连接但执行失败的节点同样会触发熔断
+            conn = self._checkout(node, record_success=False)
             cursor = conn.cursor(dictionary=True)
 
             if params:
@@ -176,38 +1036,66 @@ class DatabaseManager:
             else:
                 cursor.execute(query)
 
-            result = cursor.fetchall()
+            result = ResultSet(cursor.fetchall(), cursor.description)
             cursor.close()
 
-            log_database_operation("SELECT", node_id, "query", True)
+            node.record_success()
+            log_database_operation("SELECT", node.node_id, "query", True)
             return result
 
+        except (InterfaceError, OperationalError) as e:
+            # 连接已损坏，丢弃而不是放回连接池，并计入熔断
+            log_database_operation("SELECT", node.node_id, "query", False, str(e))
+            if conn:
+                conn.discard()
+                conn = None
+                node.record_failure()
+            raise e
         except Exception as e:
-            log_database_operation("SELECT", node_id, "query", False, str(e))
+            log_database_operation("SELECT", node.node_id, "query", False, str(e))
+            if conn:
+                # 服务端返回了SQL错误，节点本身正常
+                node.record_success()
             raise e
         finally:
             if conn:
                 conn.close()
 
     def get_node_status(self) -> Dict[str, Dict]:
-        """获取所有节点状态"""
+        """获取所有节点状态（读取健康检查缓存）"""
+        self.health_monitor.ensure_fresh()
         status = {}
         for node_id, node in self.nodes.items():
             status[node_id] = {
-                'available': node.check_health(),
+                'available': node.is_available,
                 'host': node.config['host'],
                 'port': node.config['port'],
                 'database': node.config['database'],
-                'last_check': node.last_check
+                'last_check': node.last_check,
+                'validations_performed': node.validations_performed,
+                'validations_skipped': node.validations_skipped,
+                'pool': node.pool.get_stats() if node.pool else None,
+                'circuit': node.breaker.get_stats(),
+                'health': node.get_health_stats(),
+                'replicas': [{
+                    'node_id': replica.node_id,
+                    'available': replica.is_available,
+                    'host': replica.config['host'],
+                    'port': replica.config['port'],
+                    'lag_seconds': replica.lag_seconds,
+                    'active_queries': replica.active_queries,
+                    'circuit': replica.breaker.get_stats()
+                } for replica in self.replicas.get(node_id, [])]
             }
         return status
 
     def close_all_connections(self):
         """关闭所有连接池"""
-        for node_id, node in self.nodes.items():
+        self.health_monitor.stop()
+        for node_id, node in self._all_nodes().items():
             try:
                 if node.pool:
-                    # MySQL连接池没有直接的关闭方法，让垃圾回收处理
+                    node.pool.close()
                     node.pool = None
                     log_connection_event(f"Connection pool closed for node {node_id}",
                                        f"{node.config['host']}:{node.config['port']}", True)
@@ -223,3 +1111,11 @@ def get_db_manager():
     if db_manager is None:
         db_manager = DatabaseManager()
     return db_manager
+
+def _reset_after_fork():
+    """fork出的子进程（gunicorn worker）不复用父进程的连接池和后台线程，首次使用时重新初始化"""
+    global db_manager
+    db_manager = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
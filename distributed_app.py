@@ -6,122 +6,628 @@ import mysql.connector
 from mysql.connector import Error
 import time
 import random
-from typing import Dict, List, Optional, Tuple
-from transaction_manager import EnhancedTransactionManager
-from database_manager import get_db_manager
+import threading
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from transaction_manager import EnhancedTransactionManager, TransactionState, LockConflict, is_retryable_error
+from database_manager import get_db_manager, execute_statement, ResultSet
+from coordinator_log import get_coordinator_log
+from saga_manager import SagaExecutor, compensation
+from outbox import enqueue_events
+from shard_map import get_shard_map
+from config import TransactionConfig, ShardConfig, InventoryConfig
 from logger import system_logger, log_system_info, log_system_error
 
+# 热点语句：模块级常量使每个连接上的预编译语句按同一SQL对象复用
+DEBIT_SQL = "UPDATE accounts SET balance = balance - %s WHERE id = %s AND balance >= %s"
+CREDIT_SQL = "UPDATE accounts SET balance = balance + %s WHERE id = %s"
+INSERT_TRANSACTION_SQL = """
+    INSERT INTO transactions (from_account, to_account, amount, transaction_type, timestamp)
+    VALUES (%s, %s, %s, %s, NOW())
+"""
+RESERVE_INVENTORY_SQL = "UPDATE inventory SET quantity = quantity - %s WHERE product_id = %s AND quantity >= %s"
+RESTOCK_INVENTORY_SQL = "UPDATE inventory SET quantity = quantity + %s WHERE product_id = %s"
+STRIPE_QUANTITIES_SQL = "SELECT stripe, quantity FROM inventory_stripes WHERE product_id = %s"
+RESERVE_STRIPE_SQL = """
+    UPDATE inventory_stripes SET quantity = quantity - %s
+    WHERE product_id = %s AND stripe = %s AND quantity >= %s
+"""
+CREATE_ORDER_SQL = """
+    INSERT INTO orders (product_id, quantity, customer_id, status, created_at)
+    VALUES (%s, %s, %s, 'CONFIRMED', NOW())
+"""
+
+def debit(conn, account_id, amount):
+    """扣款：余额在SQL中相对更新且要求余额充足，账户不存在或余额不足时返回False"""
+    _, updated, _ = execute_statement(conn, DEBIT_SQL, (amount, account_id, amount))
+    return updated == 1
+
+def credit(conn, account_id, amount):
+    """入账：账户不存在时返回False"""
+    _, updated, _ = execute_statement(conn, CREDIT_SQL, (amount, account_id))
+    return updated == 1
+
+def insert_transaction_log(conn, from_acc, to_acc, amount, tx_type):
+    """写入一条交易记录，返回记录ID"""
+    return execute_statement(conn, INSERT_TRANSACTION_SQL, (from_acc, to_acc, amount, tx_type))[2]
+
+def reserve_inventory(conn, prod_id, quantity):
+    """条件扣减库存：库存在SQL中相对扣减且要求库存充足，商品不存在或库存不足时返回False"""
+    _, updated, _ = execute_statement(conn, RESERVE_INVENTORY_SQL, (quantity, prod_id, quantity))
+    return updated == 1
+
+def reserve_striped_inventory(conn, prod_id, quantity):
+    """
+    从热点商品的子计数器扣减库存：先不加锁读取各子计数器，只对一个库存充足的子计数器（随机选择）条件扣减，
+    并发订单分散在不同的行锁上。没有充足的子计数器时按顺序锁定该商品全部库存行，按合计库存扣减。
+    REPEATABLE READ下条件不满足的UPDATE仍持有该行锁（回滚到保存点也不释放），扣减时被并发订单抢先则
+    抛出LockConflict，由整个事务回滚释放行锁后重试，不在持有乱序行锁的事务中再按顺序加锁
+    """
+    rows = execute_statement(conn, STRIPE_QUANTITIES_SQL, (prod_id,))[0]
+    candidates = [stripe for stripe, available in rows if available >= quantity]
+    if not candidates:
+        return _reserve_across_stripes(conn, prod_id, quantity)
+
+    stripe = random.choice(candidates)
+    _, updated, _ = execute_statement(conn, RESERVE_STRIPE_SQL, (quantity, prod_id, stripe, quantity))
+    if updated != 1:
+        raise LockConflict(f"Stripe {stripe} of product {prod_id} was drained concurrently")
+    return True
+
+def _reserve_across_stripes(conn, prod_id, quantity):
+    """锁定子计数器和主库存行，合计充足时依次扣减，返回是否扣减成功"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT stripe, quantity FROM inventory_stripes WHERE product_id = %s "
+                     "ORDER BY stripe FOR UPDATE", (prod_id,))
+        stripes = cursor.fetchall()
+        cursor.execute("SELECT quantity FROM inventory WHERE product_id = %s FOR UPDATE", (prod_id,))
+        row = cursor.fetchone()
+        if row is None or row[0] + sum(available for _, available in stripes) < quantity:
+            return False
+
+        remaining = quantity
+        for stripe, available in [(None, row[0])] + stripes:
+            take = min(available, remaining)
+            if take <= 0:
+                continue
+            if stripe is None:
+                cursor.execute("UPDATE inventory SET quantity = quantity - %s WHERE product_id = %s",
+                             (take, prod_id))
+            else:
+                cursor.execute("UPDATE inventory_stripes SET quantity = quantity - %s "
+                             "WHERE product_id = %s AND stripe = %s", (take, prod_id, stripe))
+            remaining -= take
+        return True
+    finally:
+        cursor.close()
+
+@compensation
+def adjust_balance(conn, account_id, delta):
+    """余额相对调整（不检查余额），用作镜像分片的saga步骤和转账saga的补偿；账户不存在时返回False"""
+    _, updated, _ = execute_statement(conn, CREDIT_SQL, (Decimal(str(delta)), account_id))
+    return updated == 1
+
+@compensation
+def restock_inventory(conn, prod_id, quantity):
+    """补偿：把扣减的库存加回主库存行（子计数器由后台合并重新均分）"""
+    _, updated, _ = execute_statement(conn, RESTOCK_INVENTORY_SQL, (quantity, prod_id))
+    return updated == 1
+
+def create_order(conn, prod_id, qty, cust_id):
+    """创建订单，返回订单ID"""
+    return execute_statement(conn, CREATE_ORDER_SQL, (prod_id, qty, cust_id))[2]
+
+def _log_transfer(conn, from_acc, to_acc, amount, events):
+    """写入转账记录，并在同一本地事务中写入待推送的事件"""
+    log_id = insert_transaction_log(conn, from_acc, to_acc, amount, "TRANSFER")
+    enqueue_events(conn, events)
+    return log_id
+
+def _place_order(conn, prod_id, qty, cust_id, events):
+    """创建订单，并在同一本地事务中写入待推送的事件，返回订单ID"""
+    order_id = create_order(conn, prod_id, qty, cust_id)
+    enqueue_events(conn, events)
+    return order_id
+
+def _event(publish: bool, event_type: str, **payload) -> List[Tuple[str, Dict]]:
+    """需要推送时构造一个发件箱事件"""
+    if not publish:
+        return []
+    payload['timestamp'] = datetime.now().isoformat()
+    return [(event_type, payload)]
+
+def _insert_transaction_logs(conn, rows):
+    """多行插入交易记录：rows为(from_account, to_account, amount, transaction_type)"""
+    cursor = conn.cursor()
+    cursor.executemany("""
+        INSERT INTO transactions (from_account, to_account, amount, transaction_type, timestamp)
+        VALUES (%s, %s, %s, %s, NOW())
+    """, rows)
+    cursor.close()
+    return cursor.rowcount
+
+def _lock_accounts(conn, account_ids):
+    """按ID升序锁定同一节点上的账户，返回 {id: balance}"""
+    cursor = conn.cursor()
+    placeholders = ", ".join(["%s"] * len(account_ids))
+    cursor.execute(f"SELECT id, balance FROM accounts WHERE id IN ({placeholders}) "
+                 f"ORDER BY id FOR UPDATE", tuple(sorted(account_ids)))
+    balances = {row[0]: row[1] for row in cursor.fetchall()}
+    cursor.close()
+    return balances
+
+def _apply_balance_deltas(conn, deltas):
+    """用一条CASE语句把净余额变化 {id: delta} 应用到同一节点上的账户"""
+    account_ids = sorted(deltas)
+    cases = " ".join(["WHEN %s THEN %s"] * len(account_ids))
+    placeholders = ", ".join(["%s"] * len(account_ids))
+    params = [value for acc in account_ids for value in (acc, deltas[acc])] + account_ids
+    cursor = conn.cursor()
+    cursor.execute(f"UPDATE accounts SET balance = balance + CASE id {cases} END "
+                 f"WHERE id IN ({placeholders})", tuple(params))
+    updated = cursor.rowcount
+    cursor.close()
+    return updated
+
+def _retry_lock_conflicts(operation: Callable, args: Tuple, on_retry: Callable = None):
+    """执行一个分布式事务，遇到死锁或锁等待超时时按退避整体重试"""
+    attempts = max(1, TransactionConfig.MAX_RETRY_ATTEMPTS)
+    for attempt in range(attempts):
+        try:
+            return operation(*args)
+
+        except Exception as e:
+            if not is_retryable_error(e) or attempt + 1 >= attempts:
+                raise
+            if on_retry:
+                on_retry()
+            # 指数退避加全抖动，避免冲突的事务同时重试
+            delay = random.uniform(0, TransactionConfig.RETRY_INTERVAL * (2 ** attempt))
+            system_logger.warning(f"{operation.__name__} hit lock conflict, retrying in "
+                                f"{delay:.3f}s ({attempt + 1}/{attempts - 1}): {e}")
+            time.sleep(delay)
+
+def _transaction_mode(mode: Optional[str]) -> str:
+    """解析事务模式，未指定时取配置"""
+    mode = (mode or TransactionConfig.TRANSACTION_MODE).lower()
+    if mode not in ('xa', 'saga'):
+        raise ValueError(f"Unknown transaction mode: {mode}")
+    return mode
+
+def _keyset_condition(column: str, after_id: Optional[int], descending: bool = False) -> Tuple[str, Tuple]:
+    """键集分页条件：升序取键大于游标的行，降序取键小于游标的行"""
+    if after_id is None:
+        return "1 = 1", ()
+    return f"{column} {'<' if descending else '>'} %s", (after_id,)
+
+def _keyset_page(rows: List[Dict], limit: int, key: str) -> Tuple[List[Dict], Optional[int]]:
+    """截取一页（查询时多取一行用于判断是否还有下一页），返回该页和下一页游标"""
+    page = ResultSet(rows[:limit], getattr(rows, 'description', None))
+    return page, (page[-1][key] if len(rows) > limit else None)
+
+def _parse_amount(amount) -> Decimal:
+    """金额统一按Decimal计算，避免浮点误差；不是有限正数时抛出ValueError"""
+    try:
+        value = Decimal(str(amount))
+    except InvalidOperation:
+        raise ValueError(f"Invalid amount: {amount}")
+    if not value.is_finite() or value <= 0:
+        raise ValueError(f"Transfer amount must be positive, got {amount}")
+    return value
+
+def _plan_transfers(items, balances):
+    """
+    按顺序校验转账并计算净余额变化，无效转账跳过且不影响后续转账可见的余额。
+    items为(index, from_account, to_account, amount)，返回 ({index: 原因}, {id: 非零delta})
+    """
+    balances = dict(balances)
+    problems = {}
+    deltas = {}
+    for index, from_acc, to_acc, amount in items:
+        if amount <= 0:
+            problems[index] = f"Transfer amount must be positive, got {amount}"
+        elif from_acc == to_acc:
+            problems[index] = "Source and target account are the same"
+        elif from_acc not in balances:
+            problems[index] = f"Account {from_acc} not found"
+        elif to_acc not in balances:
+            problems[index] = f"Account {to_acc} not found"
+        elif balances[from_acc] < amount:
+            problems[index] = f"Insufficient balance in account {from_acc}"
+        else:
+            balances[from_acc] -= amount
+            balances[to_acc] += amount
+            deltas[from_acc] = deltas.get(from_acc, Decimal(0)) - amount
+            deltas[to_acc] = deltas.get(to_acc, Decimal(0)) + amount
+
+    return problems, {acc: delta for acc, delta in deltas.items() if delta != 0}
+
 class BankingService:
     """银行业务服务类"""
 
     def __init__(self):
         self.db_manager = get_db_manager()
+        # 账户按分片映射路由到节点，交易记录写入固定节点
+        self.shard_map = get_shard_map()
+        self.log_node = ShardConfig.TRANSACTION_LOG_NODE
+        # 为True时提交的转账和开户在同一事务中写入发件箱事件，由Web服务推送
+        self.publish_events = False
+        # 因死锁或锁等待超时而整体重试的次数
+        self.retry_count = 0
+        self._retry_lock = threading.Lock()
+
+    def transfer_money(self, from_account: int, to_account: int, amount: float, mode: str = None) -> bool:
+        """
+        转账操作 - 分布式事务示例，遇到死锁或锁等待超时时整体重试。
+        mode为xa（两阶段提交）或saga（各步骤本地提交，失败时补偿），默认取配置
+        """
+        try:
+            amount = _parse_amount(amount)
+            transfer = self._transfer_saga if _transaction_mode(mode) == 'saga' else self._transfer_once
+            self._with_lock_retry(transfer, from_account, to_account, amount)
+            self._invalidate_accounts((from_account, to_account))
+            log_system_info("BankingService",
+                          f"Transfer successful: {from_account} -> {to_account}, Amount: {amount}")
+            return True
 
-    def transfer_money(self, from_account: int, to_account: int, amount: float) -> bool:
-        """转账操作 - 分布式事务示例"""
-        connections = None
+        except Exception as e:
+            log_system_error("BankingService.transfer_money", str(e))
+            return False
+
+    def _invalidate_accounts(self, account_ids: Iterable[int]):
+        """提交后使账户所在分片（含镜像分片）的账户查询缓存失效"""
+        nodes = set()
+        for account_id in account_ids:
+            nodes.update(node_id for node_id in self.shard_map.route(account_id) if node_id is not None)
+        for node_id in sorted(nodes):
+            self.db_manager.invalidate_cache(node_id, 'accounts')
+
+    def record_transfer_writes(self, from_account: int, to_account: int):
+        """把一笔转账写入的节点记入当前读会话"""
+        for account_id in (from_account, to_account):
+            for node_id in self.shard_map.route(account_id):
+                if node_id is not None:
+                    self.db_manager.record_write(node_id)
+        self.db_manager.record_write(self.log_node)
+
+    def _with_lock_retry(self, operation: Callable, *args):
+        """执行一个分布式事务，遇到死锁或锁等待超时时按退避整体重试"""
+        return _retry_lock_conflicts(operation, args, self._count_retry)
+
+    def _count_retry(self):
+        """记录一次整体重试"""
+        with self._retry_lock:
+            self.retry_count += 1
+
+    def _transfer_once(self, from_account: int, to_account: int, amount: Decimal):
+        """在一个分布式事务中执行一次转账，失败时回滚并抛出异常"""
         tm = None
 
         try:
-            # 获取数据库连接
-            connections = self.db_manager.get_all_connections()
-            tm = EnhancedTransactionManager(connections)
+            # 参与者在首次操作时才借用连接并加入事务
+            tm = EnhancedTransactionManager(db_manager=self.db_manager,
+                                            coordinator_log=get_coordinator_log())
 
             # 开始事务
             tm.begin_transaction()
 
-            # 定义数据库操作函数
-            def check_balance(conn, account_id):
-                cursor = conn.cursor(dictionary=True)
-                cursor.execute("SELECT balance FROM accounts WHERE id = %s", (account_id,))
-                result = cursor.fetchone()
-                cursor.close()
-                return result['balance'] if result else 0
+            # 余额在SQL中相对更新，并发转账不会丢失更新；
+            # 按(节点, 账户ID)升序加行锁：A->B与B->A的并发转账以相同顺序加锁，不会互相死锁；
+            # 只有转账涉及的分片会加入事务
+            steps = [(*self.shard_map.route(from_account), from_account, debit, -amount),
+                     (*self.shard_map.route(to_account), to_account, credit, amount)]
+            steps.sort(key=lambda step: (step[0], step[2]))
+            for node_id, mirror, account_id, operation, delta in steps:
+                if not tm.execute_operation(node_id, operation, account_id, amount):
+                    if operation is debit:
+                        # 扣款：源账户不存在或余额不足时不更新任何行
+                        raise Exception(f"Insufficient balance or account {from_account} not found. "
+                                      f"Required: {amount}")
+                    # 入账：目标账户不存在时回滚整个事务
+                    raise Exception(f"Target account {to_account} not found")
+
+                # 区间迁移期间同步写入镜像分片
+                if mirror is not None:
+                    tm.execute_operation(mirror, _apply_balance_deltas, {account_id: delta})
+
+            # 记录交易日志和待推送的事件
+            tm.execute_operation(self.log_node, _log_transfer, from_account, to_account, amount,
+                               self._transfer_event(from_account, to_account, amount))
 
-            def update_balance(conn, account_id, new_balance):
-                cursor = conn.cursor()
-                cursor.execute("UPDATE accounts SET balance = %s WHERE id = %s",
-                             (new_balance, account_id))
-                cursor.close()
-                return cursor.rowcount > 0
+            # 准备提交
+            tm.prepare()
 
-            def insert_transaction_log(conn, from_acc, to_acc, amount, tx_type):
-                cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT INTO transactions (from_account, to_account, amount, transaction_type, timestamp)
-                    VALUES (%s, %s, %s, %s, NOW())
-                """, (from_acc, to_acc, amount, tx_type))
-                cursor.close()
-                return cursor.lastrowid
+            # 提交事务
+            tm.commit()
+
+        except Exception:
+            if tm:
+                tm.rollback()
+            raise
+        finally:
+            if tm:
+                tm.cleanup()
 
-            # 检查源账户余额
-            from_balance = tm.execute_operation("participant_1", check_balance, from_account)
-            if from_balance < amount:
-                raise Exception(f"Insufficient balance. Available: {from_balance}, Required: {amount}")
+    def _transfer_saga(self, from_account: int, to_account: int, amount: Decimal):
+        """
+        以saga执行一次转账：扣款、入账（及镜像分片的同步写入）各自本地提交并登记补偿，
+        交易记录是最后一个不可补偿的步骤；失败时补偿已提交的步骤并抛出异常
+        """
+        saga = SagaExecutor('transfer', db_manager=self.db_manager)
 
-            # 检查目标账户是否存在
-            to_balance = tm.execute_operation("participant_1", check_balance, to_account)
+        try:
+            # 先扣款：余额不足时不产生需要补偿的修改；每个步骤只在本地事务内持有行锁
+            for account_id, operation, delta in ((from_account, debit, -amount), (to_account, credit, amount)):
+                node_id, mirror = self.shard_map.route(account_id)
+                if not saga.execute_step(node_id, operation, account_id, amount,
+                                         compensation=adjust_balance, compensation_args=(account_id, -delta)):
+                    if operation is debit:
+                        raise Exception(f"Insufficient balance or account {from_account} not found. "
+                                      f"Required: {amount}")
+                    raise Exception(f"Target account {to_account} not found")
+
+                # 区间迁移期间同步写入镜像分片
+                if mirror is not None:
+                    saga.execute_step(mirror, adjust_balance, account_id, delta,
+                                      compensation=adjust_balance, compensation_args=(account_id, -delta))
+
+            saga.execute_step(self.log_node, _log_transfer, from_account, to_account, amount,
+                              self._transfer_event(from_account, to_account, amount))
+            saga.complete()
+
+        except Exception:
+            saga.compensate()
+            # 中间状态可能已被读取并缓存
+            self._invalidate_accounts((from_account, to_account))
+            raise
+
+    def _transfer_event(self, from_account: int, to_account: int, amount: Decimal) -> List[Tuple[str, Dict]]:
+        """转账完成事件"""
+        return _event(self.publish_events, 'transfer_completed',
+                      from_account=from_account, to_account=to_account, amount=float(amount))
+
+    def transfer_many(self, transfers: List[Tuple[int, int, float]], atomic: bool = None,
+                      chunk_size: int = None) -> Dict:
+        """
+        批量转账：每个分块在一个分布式事务中集合式更新余额并批量写入交易记录。
+        atomic为True时所有分块在同一事务中，任一转账无效则全部回滚；否则按分块提交或回滚。
+        返回整体结果及每笔转账的状态（committed / rejected / aborted）
+        """
+        atomic = TransactionConfig.BULK_TRANSFER_ATOMIC if atomic is None else atomic
+        chunk_size = max(1, chunk_size or TransactionConfig.BULK_TRANSFER_CHUNK_SIZE)
+        results = [{'index': index, 'status': 'aborted', 'error': None}
+                   for index in range(len(transfers))]
+
+        # 先在本地校验金额，含无效金额的分块（原子模式下为整批）不会进入数据库
+        items, rejected = [], {}
+        for index, (from_acc, to_acc, amount) in enumerate(transfers):
+            try:
+                amount = _parse_amount(amount)
+            except ValueError as e:
+                rejected[index] = str(e)
+            items.append((index, from_acc, to_acc, amount))
+
+        chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+        if atomic:
+            groups = [] if rejected else [chunks]
+        else:
+            groups = [[chunk] for chunk in chunks]
+
+        for group in groups:
+            indexes = [item[0] for chunk in group for item in chunk]
+            if not any(index in rejected for index in indexes):
+                try:
+                    self._with_lock_retry(self._transfer_chunks_once, group, rejected)
+                    for index in indexes:
+                        results[index]['status'] = 'committed'
+                    continue
+                except Exception as e:
+                    log_system_error("BankingService.transfer_many", str(e))
+                    reason = str(e)
+            else:
+                reason = "Rejected transfer in the same chunk"
+
+            for index in indexes:
+                if index not in rejected:
+                    results[index]['error'] = reason
+
+        if atomic and rejected:
+            for result in results:
+                if result['index'] not in rejected:
+                    result['error'] = "Rejected transfer in the same batch"
+        for index, reason in rejected.items():
+            results[index].update(status='rejected', error=reason)
+
+        committed = sum(1 for result in results if result['status'] == 'committed')
+        if committed:
+            self._invalidate_accounts(account for result, (from_acc, to_acc, _) in zip(results, transfers)
+                                      if result['status'] == 'committed' for account in (from_acc, to_acc))
+        log_system_info("BankingService",
+                      f"Bulk transfer finished: {committed}/{len(transfers)} committed "
+                      f"({'atomic' if atomic else f'chunks of {chunk_size}'})")
+        return {
+            'success': committed == len(transfers),
+            'atomic': atomic,
+            'committed': committed,
+            'failed': len(transfers) - committed,
+            'results': results
+        }
+
+    def _transfer_chunks_once(self, chunks: List[List[Tuple]], rejected: Dict[int, str]):
+        """在一个分布式事务中执行若干分块的转账，有无效转账时记录原因并回滚"""
+        tm = None
 
-            # 更新账户余额
-            tm.execute_operation("participant_1", update_balance, from_account, float(from_balance) - amount)
-            tm.execute_operation("participant_1", update_balance, to_account, float(to_balance) + amount)
+        try:
+            tm = EnhancedTransactionManager(db_manager=self.db_manager,
+                                            coordinator_log=get_coordinator_log())
+            tm.begin_transaction()
 
-            # 记录交易日志
-            tm.execute_operation("participant_2", insert_transaction_log,
-                               from_account, to_account, amount, "TRANSFER")
+            for chunk in chunks:
+                balances = self._lock_balances(tm, chunk)
+                problems, deltas = _plan_transfers(chunk, balances)
+                if problems:
+                    rejected.update(problems)
+                    raise Exception(f"{len(problems)} transfer(s) rejected")
+
+                self._apply_deltas(tm, deltas)
+                tm.execute_operation(self.log_node, _insert_transaction_logs,
+                                   [(from_acc, to_acc, amount, "TRANSFER")
+                                    for _, from_acc, to_acc, amount in chunk])
+                if self.publish_events:
+                    tm.execute_operation(self.log_node, enqueue_events,
+                                       _event(True, 'transfers_completed', count=len(chunk)))
 
-            # 准备提交
             tm.prepare()
-
-            # 提交事务
             tm.commit()
 
-            log_system_info("BankingService",
-                          f"Transfer successful: {from_account} -> {to_account}, Amount: {amount}")
-            return True
-
-        except Exception as e:
-            log_system_error("BankingService.transfer_money", str(e))
+        except Exception:
             if tm:
                 tm.rollback()
-            return False
+            raise
         finally:
             if tm:
                 tm.cleanup()
 
-    def delete_account(self, account_id: int) -> bool:
-        """删除账户"""
-        conn = None
+    def _lock_balances(self, tm: EnhancedTransactionManager, items: List[Tuple]) -> Dict:
+        """在事务中按(节点, 账户ID)顺序锁定转账涉及的账户，返回各账户余额"""
+        account_ids = {acc for _, from_acc, to_acc, _ in items for acc in (from_acc, to_acc)}
+        balances = {}
+        for node_id, node_accounts in sorted(self.shard_map.group_by_node(account_ids).items()):
+            balances.update(tm.execute_operation(node_id, _lock_accounts, node_accounts))
+        return balances
+
+    def _apply_deltas(self, tm: EnhancedTransactionManager, deltas: Dict):
+        """在事务中把净余额变化按分片写入，每个分片一条语句；迁移中的区间随后写入镜像分片"""
+        routes = {acc: self.shard_map.route(acc) for acc in deltas}
+        for position in (0, 1):
+            groups: Dict[str, Dict] = {}
+            for acc in sorted(deltas):
+                node_id = routes[acc][position]
+                if node_id is not None:
+                    groups.setdefault(node_id, {})[acc] = deltas[acc]
+            for node_id, node_deltas in sorted(groups.items()):
+                tm.execute_operation(node_id, _apply_balance_deltas, node_deltas)
+
+    def _apply_transfer_batch(self, transfers: List[Tuple[int, int, float]]) -> Optional[List[bool]]:
+        """
+        在一个分布式事务中执行一批转账，返回每笔转账是否生效；事务确定已回滚时抛出异常，
+        提交结果未知时返回None
+        """
+        tm = None
+
         try:
-            conn = self.db_manager.get_connection('db1')
+            tm = EnhancedTransactionManager(db_manager=self.db_manager,
+                                            coordinator_log=get_coordinator_log())
+            tm.begin_transaction()
+
+            # 源账户余额充足且目标账户存在时才生效，同批次后续转账可见前面的修改
+            items, invalid = [], {}
+            for index, (from_acc, to_acc, amount) in enumerate(transfers):
+                try:
+                    items.append((index, from_acc, to_acc, _parse_amount(amount)))
+                except ValueError as e:
+                    invalid[index] = str(e)
+            balances = self._lock_balances(tm, items)
+            problems, deltas = _plan_transfers(items, balances)
+            problems.update(invalid)
+            self._apply_deltas(tm, deltas)
+
+            applied = [index not in problems for index in range(len(transfers))]
+            rows = [(from_acc, to_acc, amount, "TRANSFER")
+                    for (from_acc, to_acc, amount), ok in zip(transfers, applied) if ok]
+            if rows:
+                tm.execute_operation(self.log_node, _insert_transaction_logs, rows)
+                if self.publish_events:
+                    tm.execute_operation(self.log_node, enqueue_events,
+                                       [event for from_acc, to_acc, amount, _ in rows
+                                        for event in self._transfer_event(from_acc, to_acc, amount)])
+
+            tm.prepare()
+            tm.commit()
+
+        except Exception as e:
+            log_system_error("BankingService._apply_transfer_batch", str(e))
+            if tm is None or tm.state not in (TransactionState.COMMITTING, TransactionState.COMMITTED):
+                if tm:
+                    tm.rollback()
+                    if not tm.is_rolled_back():
+                        # 提交决策写入失败且有分支未能回滚，恢复流程可能提交这些分支
+                        return None
+                raise
+            # 提交决策已持久化后的错误不改变结果：批次以提交为准，未完成的分支由恢复流程提交
+        finally:
+            if tm:
+                tm.cleanup()
+
+        self._invalidate_accounts(account for (from_acc, to_acc, _), ok in zip(transfers, applied)
+                                  if ok for account in (from_acc, to_acc))
+        log_system_info("BankingService",
+                      f"Transfer batch committed: {len(rows)}/{len(transfers)} applied")
+        return applied
+
+    def _write_account(self, account_id: int, sql: str, params: Tuple, events: List[Tuple[str, Dict]] = ()):
+        """
+        在账户所在分片执行一条写语句并提交，events在同一事务中写入该分片的发件箱；
+        区间迁移期间通过分布式事务同时写入镜像分片
+        """
+        node_id, mirror = self.shard_map.route(account_id)
+        if mirror is None:
+            conn = self.db_manager.get_connection(node_id)
+            try:
+                cursor = conn.cursor()
+                cursor.execute(sql, params)
+                enqueue_events(conn, events)
+                conn.commit()
+                cursor.close()
+            finally:
+                conn.close()
+            self.db_manager.invalidate_cache(node_id, 'accounts')
+            return
+
+        def write(conn):
             cursor = conn.cursor()
-            cursor.execute("DELETE FROM accounts WHERE id = %s", (account_id,))
-            conn.commit()
+            cursor.execute(sql, params)
             cursor.close()
 
+        tm = EnhancedTransactionManager(db_manager=self.db_manager,
+                                        coordinator_log=get_coordinator_log())
+        try:
+            tm.begin_transaction()
+            tm.execute_operation(node_id, write)
+            if events:
+                tm.execute_operation(node_id, enqueue_events, events)
+            tm.execute_operation(mirror, write)
+            tm.prepare()
+            tm.commit()
+            self._invalidate_accounts((account_id,))
+        except Exception:
+            tm.rollback()
+            raise
+        finally:
+            tm.cleanup()
+
+    def delete_account(self, account_id: int) -> bool:
+        """删除账户"""
+        try:
+            self._write_account(account_id, "DELETE FROM accounts WHERE id = %s", (account_id,))
+
             log_system_info("BankingService", f"Account {account_id} deleted")
             return True
 
         except Exception as e:
             log_system_error("BankingService.delete_account", f"Database error: {str(e)}")
             return False
-        finally:
-            if conn:
-                try:
-                    conn.close()
-                except:
-                    pass
     def create_account(self, account_id: int, initial_balance: float = 0) -> bool:
         """创建账户"""
-        conn = None
         try:
-            conn = self.db_manager.get_connection('db1')
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO accounts (id, balance) VALUES (%s, %s)",
-                         (account_id, initial_balance))
-            # cursor.execute("UPDATE accounts SET balance = (%s) where account_id = (%s)", (initial_balance, account_id))
-            conn.commit()
-            cursor.close()
+            self._write_account(account_id, "INSERT INTO accounts (id, balance) VALUES (%s, %s)",
+                               (account_id, initial_balance),
+                               _event(self.publish_events, 'account_created',
+                                      account_id=account_id, balance=initial_balance))
 
             log_system_info("BankingService", f"Account {account_id} created with balance {initial_balance}")
             return True
@@ -129,17 +635,11 @@ class BankingService:
         except Exception as e:
             log_system_error("BankingService.create_account", f"Database error: {str(e)}")
             return False
-        finally:
-            if conn:
-                try:
-                    conn.close()
-                except:
-                    pass
 
     def get_account_balance(self, account_id: int) -> Optional[float]:
         """获取账户余额"""
         try:
-            result = self.db_manager.execute_query('db1',
+            result = self.db_manager.execute_query(self.shard_map.node_for(account_id),
                 "SELECT balance FROM accounts WHERE id = %s", (account_id,))
             return result[0]['balance'] if result else None
 
@@ -147,89 +647,443 @@ class BankingService:
             log_system_error("BankingService.get_account_balance", str(e))
             return None
 
+    def get_all_accounts(self) -> List[Dict]:
+        """从所有分片读取账户并按ID排序（结果可能来自查询缓存）"""
+        return self._merge_shards("SELECT * FROM accounts ORDER BY id", ())[0]
+
+    def _owned(self, node_id: str, rows: Iterable[Dict]) -> Iterator[Dict]:
+        """只保留路由到该节点的账户：迁移切换路由后、清理源节点前，迁移区间的账户同时存在于源和目标节点"""
+        return (row for row in rows if self.shard_map.node_for(row['id']) == node_id)
+
+    def _merge_shards(self, query: str, params: Tuple, node_limit: Optional[int] = None) -> Tuple[ResultSet, Optional[int]]:
+        """
+        在所有账户分片上执行同一查询，合并各节点拥有的账户并按ID排序。
+        node_limit为每个节点的查询行数上限：某节点返回满node_limit行时，其最后一行之后可能还有未读到的自有账户，
+        结果截断到所有满额节点最后一行ID的最小值，返回 (结果, 截断边界或None)
+        """
+        accounts = ResultSet()
+        bound = None
+        for node_id in self.shard_map.nodes:
+            rows = self.db_manager.execute_query(node_id, query, params=params or None,
+                                                 cache_tables=('accounts',))
+            if node_limit is not None and len(rows) >= node_limit:
+                bound = rows[-1]['id'] if bound is None else min(bound, rows[-1]['id'])
+            accounts.extend(self._owned(node_id, rows))
+            accounts.description = accounts.description or getattr(rows, 'description', None)
+        if bound is not None:
+            accounts[:] = [account for account in accounts if account['id'] <= bound]
+        accounts.sort(key=lambda account: account['id'])
+        return accounts, bound
+
+    def get_accounts_page(self, after_id: Optional[int] = None, limit: int = 100) -> Tuple[List[Dict], Optional[int]]:
+        """键集分页读取账户：返回ID大于after_id的至多limit个账户和下一页游标"""
+        condition, params = _keyset_condition('id', after_id)
+        rows, bound = self._merge_shards(f"SELECT * FROM accounts WHERE {condition} ORDER BY id LIMIT %s",
+                                         params + (limit + 1,), node_limit=limit + 1)
+        page, next_after_id = _keyset_page(rows, limit, 'id')
+        if next_after_id is None and bound is not None:
+            # 满额节点中迁移副本占了名额，本页不足limit个账户，但边界之后还有数据
+            next_after_id = bound
+        return page, next_after_id
+
+    def iter_accounts(self, after_id: Optional[int] = None) -> Iterator[Dict]:
+        """按ID顺序流式读取所有分片上ID大于after_id的账户"""
+        condition, params = _keyset_condition('id', after_id)
+        query = f"SELECT * FROM accounts WHERE {condition} ORDER BY id"
+        streams = [self._owned(node_id, self.db_manager.stream_query(node_id, query, params))
+                   for node_id in self.shard_map.nodes]
+        return heapq.merge(*streams, key=lambda account: account['id'])
+
+    def _history_query(self, after_id: Optional[int], limit: Optional[int]) -> Tuple[str, Tuple]:
+        """账户交易历史查询（按ID倒序，after_id为上一页最后一条记录的ID）"""
+        condition, params = _keyset_condition('id', after_id, descending=True)
+        query = f"""
+            SELECT * FROM transactions
+            WHERE (from_account = %s OR to_account = %s) AND {condition}
+            ORDER BY id DESC
+        """
+        if limit is not None:
+            query += " LIMIT %s"
+            params += (limit + 1,)
+        return query, params
+
+    def get_transaction_history_page(self, account_id: int, after_id: Optional[int] = None,
+                                     limit: int = 10) -> Tuple[List[Dict], Optional[int]]:
+        """键集分页读取账户交易历史，返回该页和下一页游标"""
+        query, params = self._history_query(after_id, limit)
+        rows = self.db_manager.execute_query(self.log_node, query, (account_id, account_id) + params)
+        return _keyset_page(rows, limit, 'id')
+
+    def iter_transaction_history(self, account_id: int, after_id: Optional[int] = None) -> Iterator[Dict]:
+        """流式读取账户的全部交易历史"""
+        query, params = self._history_query(after_id, None)
+        return self.db_manager.stream_query(self.log_node, query, (account_id, account_id) + params)
+
     def get_transaction_history(self, account_id: int) -> List[Dict]:
-        """获取交易历史"""
+        """获取交易历史（最近10条）"""
         try:
-            result = self.db_manager.execute_query('db2', """
-                SELECT * FROM transactions
-                WHERE from_account = %s OR to_account = %s
-                ORDER BY timestamp DESC LIMIT 10
-            """, (account_id, account_id))
-            return result
+            return self.get_transaction_history_page(account_id)[0]
 
         except Exception as e:
             log_system_error("BankingService.get_transaction_history", str(e))
             return []
 
+class _BatchedTransfer:
+    """等待批处理的转账请求"""
+
+    def __init__(self, from_account: int, to_account: int, amount: float):
+        self.transfer = (from_account, to_account, amount)
+        self.result: Optional[bool] = None
+        self.done = threading.Event()
+
+class TransferBatcher:
+    """转账批处理协调器：将短时间窗口内到达的并发转账合并为一个分布式事务"""
+
+    def __init__(self, banking_service: BankingService,
+                 window_ms: float = None, max_size: int = None):
+        self.banking_service = banking_service
+        self.window = (window_ms if window_ms is not None
+                       else TransactionConfig.TRANSFER_BATCH_WINDOW_MS) / 1000.0
+        self.max_size = max_size or TransactionConfig.TRANSFER_BATCH_MAX_SIZE
+        self._queue: List[_BatchedTransfer] = []
+        self._condition = threading.Condition()
+        self.batch_count = 0
+        self.retry_count = 0
+        # 批内未生效的转账在独立线程池中单笔重试，不阻塞后续批次；
+        # 不使用共享的参与者线程池，单笔转账自身还要向其中提交2PC命令
+        self._retry_executor = ThreadPoolExecutor(max_workers=self.max_size,
+                                                  thread_name_prefix='transfer-retry')
+        self._worker = threading.Thread(target=self._worker_loop, daemon=True,
+                                        name='transfer-batcher')
+        self._worker.start()
+
+    def submit(self, from_account: int, to_account: int, amount: float) -> Optional[bool]:
+        """提交一笔转账并等待其结果：True已生效，False未生效，None结果未知（批次仍可能提交）"""
+        item = _BatchedTransfer(from_account, to_account, amount)
+        with self._condition:
+            self._queue.append(item)
+            self._condition.notify()
+
+        if not item.done.wait(TransactionConfig.TRANSACTION_TIMEOUT):
+            log_system_error("TransferBatcher.submit",
+                           f"Transfer {from_account} -> {to_account} timed out waiting for batch, outcome unknown")
+            return None
+        if item.result:
+            # 批处理线程没有绑定请求的读会话，在提交方线程中补记写入
+            self.banking_service.record_transfer_writes(from_account, to_account)
+        return item.result
+
+    def _next_batch(self) -> List[_BatchedTransfer]:
+        """等待第一笔请求，再在时间窗口内收集至多max_size笔"""
+        with self._condition:
+            while not self._queue:
+                self._condition.wait()
+
+            deadline = time.time() + self.window
+            while len(self._queue) < self.max_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            batch = self._queue[:self.max_size]
+            del self._queue[:self.max_size]
+            return batch
+
+    def _worker_loop(self):
+        """批处理线程"""
+        while True:
+            batch = self._next_batch()
+            self.batch_count += 1
+
+            try:
+                applied = self.banking_service._apply_transfer_batch([item.transfer for item in batch])
+            except Exception:
+                # 整批确定已回滚：每笔转账单独重试
+                applied = [False] * len(batch)
+
+            for item, ok in zip(batch, applied if applied is not None else [None] * len(batch)):
+                if ok is None:
+                    # 批次提交结果未知，重做可能重复转账
+                    item.result = None
+                elif ok:
+                    item.result = True
+                else:
+                    # 批内未生效的转账单独重试，以单笔执行的结果为准
+                    self.retry_count += 1
+                    self._retry_executor.submit(self._retry_alone, item)
+                    continue
+                item.done.set()
+
+    def _retry_alone(self, item: _BatchedTransfer):
+        """单笔重试批内未生效的转账"""
+        try:
+            item.result = self.banking_service.transfer_money(*item.transfer)
+        except Exception as e:
+            log_system_error("TransferBatcher.retry", f"Transfer {item.transfer} failed on retry: {e}")
+            item.result = False
+        finally:
+            item.done.set()
+
 class InventoryService:
     """库存管理服务类"""
 
     def __init__(self):
         self.db_manager = get_db_manager()
-
-    def process_order(self, product_id: int, quantity: int, customer_id: int) -> bool:
-        """处理订单 - 分布式事务示例"""
-        connections = None
-        tm = None
+        # 热点商品的库存拆分在多个子计数器行中 {product_id: stripes}
+        self.hot_products = InventoryConfig.get_hot_products()
+        # 为True时提交的订单在同一事务中写入发件箱事件，由Web服务推送
+        self.publish_events = False
+        # 因死锁或锁等待超时而整体重试的次数
+        self.retry_count = 0
+        self._retry_lock = threading.Lock()
+
+    def _striped_stock(self) -> Dict[int, int]:
+        """热点商品子计数器中的库存合计 {product_id: quantity}"""
+        if not self.hot_products:
+            return {}
+        rows = self.db_manager.execute_query(
+            "db1", "SELECT product_id, SUM(quantity) AS quantity FROM inventory_stripes GROUP BY product_id",
+            cache_tables=('inventory',))
+        return {row['product_id']: int(row['quantity']) for row in rows}
+
+    @staticmethod
+    def _add_striped_stock(row: Dict, striped: Dict[int, int]) -> Dict:
+        """把子计数器中的库存计入商品的quantity"""
+        if row['product_id'] in striped:
+            row['quantity'] += striped[row['product_id']]
+        return row
+
+    def _with_striped_stock(self, rows: List[Dict]) -> List[Dict]:
+        """为结果集中的热点商品补上子计数器中的库存"""
+        striped = self._striped_stock()
+        for row in rows:
+            self._add_striped_stock(row, striped)
+        return rows
+
+    def get_inventory(self) -> List[Dict]:
+        """读取全部库存（结果可能来自查询缓存）"""
+        return self._with_striped_stock(self.db_manager.execute_query(
+            "db1", "SELECT * FROM inventory ORDER BY product_id", cache_tables=('inventory',)))
+
+    def get_inventory_page(self, after_id: Optional[int] = None, limit: int = 100) -> Tuple[List[Dict], Optional[int]]:
+        """键集分页读取库存：返回商品ID大于after_id的至多limit条记录和下一页游标"""
+        condition, params = _keyset_condition('product_id', after_id)
+        rows = self.db_manager.execute_query(
+            "db1", f"SELECT * FROM inventory WHERE {condition} ORDER BY product_id LIMIT %s",
+            params + (limit + 1,), cache_tables=('inventory',))
+        page, next_after_id = _keyset_page(rows, limit, 'product_id')
+        return self._with_striped_stock(page), next_after_id
+
+    def iter_inventory(self, after_id: Optional[int] = None) -> Iterator[Dict]:
+        """按商品ID顺序流式读取库存"""
+        condition, params = _keyset_condition('product_id', after_id)
+        striped = self._striped_stock()
+        rows = self.db_manager.stream_query("db1", f"SELECT * FROM inventory WHERE {condition} ORDER BY product_id",
+                                            params)
+        return (self._add_striped_stock(row, striped) for row in rows) if striped else rows
+
+    def process_order(self, product_id: int, quantity: int, customer_id: int, mode: str = None) -> bool:
+        """
+        处理订单 - 分布式事务示例，遇到死锁或锁等待超时时整体重试。
+        mode为xa（两阶段提交）或saga（扣减库存后立即提交，创建订单失败时补回库存），默认取配置
+        """
+        if quantity <= 0:
+            log_system_error("InventoryService.process_order",
+                           f"Order quantity must be positive, got {quantity}")
+            return False
 
         try:
-            connections = self.db_manager.get_all_connections()
-            tm = EnhancedTransactionManager(connections)
+            order = self._order_saga if _transaction_mode(mode) == 'saga' else self._order_once
+            order_id = _retry_lock_conflicts(order, (product_id, quantity, customer_id), self._count_retry)
+            self.db_manager.invalidate_cache("db1", 'inventory')
 
-            tm.begin_transaction()
+            log_system_info("InventoryService",
+                          f"Order processed: Product {product_id}, Quantity {quantity}, Order ID {order_id}")
+            return True
 
-            def check_inventory(conn, prod_id):
-                cursor = conn.cursor(dictionary=True)
-                cursor.execute("SELECT quantity FROM inventory WHERE product_id = %s", (prod_id,))
-                result = cursor.fetchone()
-                cursor.close()
-                return result['quantity'] if result else 0
+        except Exception as e:
+            log_system_error("InventoryService.process_order", str(e))
+            return False
 
-            def update_inventory(conn, prod_id, new_quantity):
-                cursor = conn.cursor()
-                cursor.execute("UPDATE inventory SET quantity = %s WHERE product_id = %s",
-                             (new_quantity, prod_id))
-                cursor.close()
-                return cursor.rowcount > 0
+    def _count_retry(self):
+        """记录一次整体重试"""
+        with self._retry_lock:
+            self.retry_count += 1
 
-            def create_order(conn, prod_id, qty, cust_id):
-                cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT INTO orders (product_id, quantity, customer_id, status, created_at)
-                    VALUES (%s, %s, %s, 'CONFIRMED', NOW())
-                """, (prod_id, qty, cust_id))
-                cursor.close()
-                return cursor.lastrowid
+    def _order_once(self, product_id: int, quantity: int, customer_id: int) -> int:
+        """在一个分布式事务中扣减库存并创建订单，返回订单ID，失败时回滚并抛出异常"""
+        tm = None
+
+        try:
+            tm = EnhancedTransactionManager(db_manager=self.db_manager,
+                                            coordinator_log=get_coordinator_log())
 
-            # 检查库存
-            current_stock = tm.execute_operation("participant_1", check_inventory, product_id)
-            if current_stock < quantity:
-                raise Exception(f"Insufficient stock. Available: {current_stock}, Required: {quantity}")
+            tm.begin_transaction()
 
-            # 更新库存
-            tm.execute_operation("participant_1", update_inventory, product_id, current_stock - quantity)
+            # 库存在SQL中条件扣减，并发订单不会丢失更新
+            reserve, args = self._reserve_operation(product_id, quantity)
+            if not tm.execute_operation("db1", reserve, *args):
+                raise Exception(f"Insufficient stock or product {product_id} not found. Required: {quantity}")
 
-            # 创建订单
-            order_id = tm.execute_operation("participant_2", create_order,
-                                          product_id, quantity, customer_id)
+            # 创建订单并写入待推送的事件
+            order_id = tm.execute_operation("db2", _place_order, product_id, quantity, customer_id,
+                                          self._order_event(product_id, quantity, customer_id))
 
             # 准备和提交
             tm.prepare()
             tm.commit()
+            return order_id
 
-            log_system_info("InventoryService",
-                          f"Order processed: Product {product_id}, Quantity {quantity}, Order ID {order_id}")
-            return True
-
-        except Exception as e:
-            log_system_error("InventoryService.process_order", str(e))
+        except Exception:
             if tm:
                 tm.rollback()
-            return False
+            raise
         finally:
             if tm:
                 tm.cleanup()
 
+    def _order_saga(self, product_id: int, quantity: int, customer_id: int) -> int:
+        """以saga处理订单：扣减库存后立即提交并登记补回库存，创建订单是最后一个不可补偿的步骤"""
+        saga = SagaExecutor('order', db_manager=self.db_manager)
+
+        try:
+            reserve, args = self._reserve_operation(product_id, quantity)
+            if not saga.execute_step("db1", reserve, *args,
+                                     compensation=restock_inventory, compensation_args=(product_id, quantity)):
+                raise Exception(f"Insufficient stock or product {product_id} not found. Required: {quantity}")
+
+            order_id = saga.execute_step("db2", _place_order, product_id, quantity, customer_id,
+                                         self._order_event(product_id, quantity, customer_id))
+            saga.complete()
+            return order_id
+
+        except Exception:
+            saga.compensate()
+            self.db_manager.invalidate_cache("db1", 'inventory')
+            raise
+
+    def _order_event(self, product_id: int, quantity: int, customer_id: int) -> List[Tuple[str, Dict]]:
+        """订单完成事件"""
+        return _event(self.publish_events, 'order_processed',
+                      product_id=product_id, quantity=quantity, customer_id=customer_id)
+
+    def _reserve_operation(self, product_id: int, quantity: int) -> Tuple[Callable, Tuple]:
+        """选择扣减库存的操作及参数：热点商品从随机子计数器扣减"""
+        stripes = self.hot_products.get(product_id)
+        if stripes:
+            return reserve_striped_inventory, (product_id, quantity)
+        return reserve_inventory, (product_id, quantity)
+
+class InventoryStripeFolder:
+    """后台定期把热点商品的子计数器合并后重新均分，使剩余库存不会零散地留在个别子计数器中"""
+
+    def __init__(self, db_manager, hot_products: Dict[int, int] = None, interval: float = None):
+        self.db_manager = db_manager
+        self.hot_products = (hot_products if hot_products is not None
+                             else InventoryConfig.get_hot_products())
+        self.interval = interval or InventoryConfig.INVENTORY_FOLD_INTERVAL
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        """合并线程是否在运行"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def fold(self, product_id: int, stripes: int) -> bool:
+        """
+        在本地事务中合并一个商品的子计数器并均分到stripes行，余数留在主库存行；
+        stripes为0时全部并回主库存行。分布有变化时返回True
+        """
+        conn = self.db_manager.get_connection('db1')
+        cursor = conn.cursor()
+        try:
+            # 与下单相同，先锁子计数器再锁主库存行
+            cursor.execute("SELECT stripe, quantity FROM inventory_stripes WHERE product_id = %s "
+                         "ORDER BY stripe FOR UPDATE", (product_id,))
+            current = dict(cursor.fetchall())
+            cursor.execute("SELECT quantity FROM inventory WHERE product_id = %s FOR UPDATE", (product_id,))
+            row = cursor.fetchone()
+            if row is None:
+                # 商品已删除
+                cursor.execute("DELETE FROM inventory_stripes WHERE product_id = %s", (product_id,))
+                conn.commit()
+                return bool(current)
+
+            total = row[0] + sum(current.values())
+            share, remainder = divmod(total, stripes) if stripes else (0, total)
+            target = {stripe: share for stripe in range(stripes)}
+            if current == target and row[0] == remainder:
+                conn.commit()
+                return False
+
+            cursor.execute("UPDATE inventory SET quantity = %s WHERE product_id = %s", (remainder, product_id))
+            cursor.execute("DELETE FROM inventory_stripes WHERE product_id = %s AND stripe >= %s",
+                         (product_id, stripes))
+            if target:
+                cursor.executemany("""
+                    INSERT INTO inventory_stripes (product_id, stripe, quantity) VALUES (%s, %s, %s)
+                    ON DUPLICATE KEY UPDATE quantity = VALUES(quantity)
+                """, [(product_id, stripe, share) for stripe in sorted(target)])
+            conn.commit()
+            return True
+
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+
+    def fold_all(self) -> int:
+        """合并所有热点商品，已不再配置为热点的商品全部并回主库存行；返回分布有变化的商品数"""
+        products = dict(self.hot_products)
+        for row in self.db_manager.execute_query(
+                'db1', "SELECT DISTINCT product_id FROM inventory_stripes", primary=True):
+            products.setdefault(row['product_id'], 0)
+
+        changed = sum(self.fold(product_id, stripes) for product_id, stripes in sorted(products.items()))
+        if changed:
+            # 合计库存不变，但主库存行和子计数器的缓存结果须一起失效
+            self.db_manager.invalidate_cache('db1', 'inventory')
+        return changed
+
+    def start(self):
+        """启动合并线程"""
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True, name='inventory-stripe-fold')
+        self._thread.start()
+
+    def stop(self):
+        """停止合并线程"""
+        self._stop.set()
+
+    def _loop(self):
+        """按固定间隔合并；没有热点商品时只运行一次，把遗留的子计数器并回主库存行"""
+        while not self._stop.is_set():
+            try:
+                self.fold_all()
+            except Exception as e:
+                system_logger.warning(f"Inventory stripe fold failed: {e}")
+            if not self.hot_products:
+                break
+            self._stop.wait(self.interval)
+
+inventory_folder = None
+_inventory_folder_lock = threading.Lock()
+
+def start_inventory_folding():
+    """启动后台子计数器合并"""
+    global inventory_folder
+    with _inventory_folder_lock:
+        if inventory_folder is None:
+            inventory_folder = InventoryStripeFolder(get_db_manager())
+    inventory_folder.start()
+    return inventory_folder
+
 class DistributedApplication:
     """分布式应用程序主类"""
 
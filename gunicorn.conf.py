@@ -0,0 +1,41 @@
+"""
+gunicorn配置（生产部署）：python main.py serve 或 gunicorn -c gunicorn.conf.py wsgi:app
+主进程在fork之前执行一次启动恢复；应用不预加载，每个worker在fork之后导入应用，
+建立自己的数据库连接池；后台任务只在leader worker中运行（见worker_sync）
+"""
+from config import WebConfig, TransactionConfig
+from logger import log_system_info
+
+bind = f"{WebConfig.HOST}:{WebConfig.PORT}"
+worker_class = WebConfig.WEB_WORKER_CLASS
+workers = WebConfig.WEB_WORKERS
+threads = WebConfig.WEB_THREADS
+worker_connections = WebConfig.WEB_WORKER_CONNECTIONS
+preload_app = False
+
+if workers > 1 and not WebConfig.SOCKETIO_MESSAGE_QUEUE:
+    # 没有消息队列时广播只能到达本进程的客户端
+    print("SOCKETIO_MESSAGE_QUEUE is not set, starting a single worker")
+    workers = 1
+# worker由主进程fork，据此决定是否需要worker间同步
+WebConfig.WEB_WORKERS = workers
+
+# SocketIO的异步模式须与worker类型一致（worker由主进程fork，继承此设置）
+WebConfig.SOCKETIO_ASYNC_MODE = 'eventlet' if worker_class == 'eventlet' else 'threading'
+
+def on_starting(server):
+    """主进程启动时恢复一次悬挂的XA分支和saga，然后关闭主进程的连接池，worker不继承这些连接"""
+    if not TransactionConfig.RECOVER_ON_STARTUP:
+        return
+    from main import recover_transactions
+    import database_manager
+    try:
+        recover_transactions()
+    finally:
+        if database_manager.db_manager is not None:
+            database_manager.db_manager.close_all_connections()
+            database_manager.db_manager = None
+
+def post_fork(server, worker):
+    """worker进程在首次使用时初始化自己的数据库管理器（见database_manager中的fork处理）"""
+    log_system_info("Gunicorn", f"Worker {worker.pid} started ({worker_class}, {workers} workers)")
@@ -7,8 +7,55 @@ from mysql.connector import Error
 import sys
 import time
 from config import DatabaseConfig
+from shard_map import get_shard_map
 from logger import system_logger, log_system_info, log_system_error
 
+ACCOUNTS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS accounts (
+    id INT PRIMARY KEY,
+    balance DECIMAL(10, 2) NOT NULL DEFAULT 0.00,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    INDEX idx_balance (balance)
+)
+"""
+
+# saga步骤的生效标记：与步骤在同一本地事务中写入，补偿时删除（每个节点一张）
+SAGA_APPLIED_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS saga_applied (
+    saga_id VARCHAR(36) NOT NULL,
+    step_no INT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (saga_id, step_no),
+    INDEX idx_created_at (created_at)
+)
+"""
+
+# 事务发件箱：待推送的事件与业务写入在同一事务中提交（每个节点一张）
+OUTBOX_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS event_outbox (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    event_type VARCHAR(50) NOT NULL,
+    payload TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+SAMPLE_ACCOUNTS = [
+    (1001, 5000.00),
+    (1002, 3000.00),
+    (1003, 1000.00),
+    (1004, 2500.00),
+    (1005, 4000.00)
+]
+
+def insert_sample_accounts(cursor, node_id):
+    """插入分片映射路由到该节点的示例账户"""
+    shard_map = get_shard_map()
+    rows = [account for account in SAMPLE_ACCOUNTS if shard_map.node_for(account[0]) == node_id]
+    if rows:
+        cursor.executemany("INSERT IGNORE INTO accounts (id, balance) VALUES (%s, %s)", rows)
+
 def wait_for_database(host, port, user, password, max_retries=30, retry_interval=2):
     """等待数据库服务启动"""
     for attempt in range(max_retries):
@@ -56,15 +103,7 @@ def setup_database_1():
         cursor.execute(f"USE {DatabaseConfig.DB1_DATABASE}")
 
         # 创建账户表
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS accounts (
-            id INT PRIMARY KEY,
-            balance DECIMAL(10, 2) NOT NULL DEFAULT 0.00,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-            INDEX idx_balance (balance)
-        )
-        """)
+        cursor.execute(ACCOUNTS_TABLE_SQL)
 
         # 创建库存表
         cursor.execute("""
@@ -80,16 +119,22 @@ def setup_database_1():
         )
         """)
 
-        # 插入示例数据
+        # 创建热点商品库存子计数器表（订单从随机子计数器扣减，后台定期合并均分）
         cursor.execute("""
-        INSERT IGNORE INTO accounts (id, balance) VALUES
-        (1001, 5000.00),
-        (1002, 3000.00),
-        (1003, 1000.00),
-        (1004, 2500.00),
-        (1005, 4000.00)
+        CREATE TABLE IF NOT EXISTS inventory_stripes (
+            product_id INT NOT NULL,
+            stripe INT NOT NULL,
+            quantity INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (product_id, stripe)
+        )
         """)
 
+        cursor.execute(SAGA_APPLIED_TABLE_SQL)
+        cursor.execute(OUTBOX_TABLE_SQL)
+
+        # 插入示例数据（账户只写入路由到本节点的部分）
+        insert_sample_accounts(cursor, 'db1')
+
         cursor.execute("""
         INSERT IGNORE INTO inventory (product_id, product_name, quantity, price) VALUES
         (101, 'Laptop', 50, 999.99),
@@ -166,6 +211,31 @@ def setup_database_2():
         )
         """)
 
+        # 创建saga记录表和补偿操作表
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sagas (
+            saga_id VARCHAR(36) PRIMARY KEY,
+            name VARCHAR(50) NOT NULL,
+            status VARCHAR(20) NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            INDEX idx_status_updated (status, updated_at)
+        )
+        """)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS saga_compensations (
+            saga_id VARCHAR(36) NOT NULL,
+            step_no INT NOT NULL,
+            node_id VARCHAR(50) NOT NULL,
+            compensation VARCHAR(100),
+            args TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (saga_id, step_no)
+        )
+        """)
+        cursor.execute(SAGA_APPLIED_TABLE_SQL)
+        cursor.execute(OUTBOX_TABLE_SQL)
+
         # 创建事务日志表
         cursor.execute("""
         CREATE TABLE IF NOT EXISTS transaction_logs (
@@ -193,6 +263,45 @@ def setup_database_2():
         log_system_error("DatabaseInit", f"Failed to setup database 2: {e}")
         return False
 
+def setup_account_shards():
+    """设置db1以外的账户分片节点（账户表和示例数据）"""
+    for node_id in get_shard_map().nodes:
+        if node_id == 'db1':
+            continue
+
+        config = DatabaseConfig.get_node_config(node_id)
+        try:
+            if not wait_for_database(config['host'], config['port'],
+                                    config['user'], config['password']):
+                return False
+
+            conn = mysql.connector.connect(
+                host=config['host'],
+                port=config['port'],
+                user=config['user'],
+                password=config['password']
+            )
+            cursor = conn.cursor()
+
+            cursor.execute(f"CREATE DATABASE IF NOT EXISTS {config['database']}")
+            cursor.execute(f"USE {config['database']}")
+            cursor.execute(ACCOUNTS_TABLE_SQL)
+            cursor.execute(SAGA_APPLIED_TABLE_SQL)
+            cursor.execute(OUTBOX_TABLE_SQL)
+            insert_sample_accounts(cursor, node_id)
+
+            conn.commit()
+            cursor.close()
+            conn.close()
+
+            log_system_info("DatabaseInit", f"Account shard {node_id} setup completed")
+
+        except Error as e:
+            log_system_error("DatabaseInit", f"Failed to setup account shard {node_id}: {e}")
+            return False
+
+    return True
+
 def verify_setup():
     """验证数据库设置"""
     try:
@@ -202,7 +311,7 @@ def verify_setup():
 
         cursor1.execute("SHOW TABLES")
         tables1 = [table[0] for table in cursor1.fetchall()]
-        expected_tables1 = ['accounts', 'inventory']
+        expected_tables1 = ['accounts', 'inventory', 'inventory_stripes']
 
         for table in expected_tables1:
             if table not in tables1:
@@ -264,6 +373,15 @@ def setup_databases():
     else:
         print("数据库2设置成功")
 
+    # 设置其余账户分片
+    if get_shard_map().nodes != ['db1']:
+        print("设置账户分片...")
+        if not setup_account_shards():
+            print("账户分片设置失败")
+            success = False
+        else:
+            print("账户分片设置成功")
+
     # 验证设置
     if success:
         print("验证数据库设置...")
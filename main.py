@@ -137,9 +137,13 @@ def start_web_interface():
     """启动Web界面"""
     print("启动Web管理界面...")
     try:
-        from web_interface import app, socketio
+        from web_interface import app, socketio, run_startup_recovery, start_background_monitor
         from config import WebConfig
 
+        # 处理新请求前恢复悬挂的XA分支
+        run_startup_recovery()
+        start_background_monitor()
+
         print(f"Web界面将在 http://{WebConfig.HOST}:{WebConfig.PORT} 启动")
 
         # 尝试启动SocketIO服务器
@@ -165,6 +169,25 @@ def start_web_interface():
         print("3. 尝试运行: pip install --upgrade eventlet")
         return False
 
+def serve_web_interface():
+    """以gunicorn多进程方式启动Web界面（生产部署）"""
+    print("以生产模式启动Web管理界面...")
+    if os.name == 'nt':
+        print("gunicorn不支持Windows，请使用: python main.py web")
+        return False
+    try:
+        import gunicorn
+    except ImportError:
+        print("缺少gunicorn，请运行: pip install -r requirements.txt")
+        return False
+
+    from config import WebConfig
+    print(f"Web界面将在 http://{WebConfig.HOST}:{WebConfig.PORT} 启动"
+          f"（{WebConfig.WEB_WORKERS} 个 {WebConfig.WEB_WORKER_CLASS} worker）")
+    # 以gunicorn替换当前进程，配置见gunicorn.conf.py
+    os.chdir(Path(__file__).resolve().parent)
+    os.execvp(sys.executable, [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'])
+
 def run_demo():
     """运行演示程序"""
     print("运行分布式数据库演示...")
@@ -176,6 +199,40 @@ def run_demo():
         print(f"演示程序运行失败: {e}")
         return False
 
+def recover_transactions():
+    """恢复悬挂的XA分支和未结束的saga"""
+    print("恢复悬挂的分布式事务...")
+    try:
+        from coordinator_log import recover_in_doubt_transactions
+        summary = recover_in_doubt_transactions()
+        print(f"提交: {summary['committed']}, 回滚: {summary['rolled_back']}, "
+              f"跳过（可能仍在运行）: {summary['skipped']}, 失败: {summary['failed']}, "
+              f"清理决策: {summary['purged']}")
+
+        # 导入业务模块以注册saga补偿操作
+        import distributed_app
+        from saga_manager import recover_sagas
+        saga_summary = recover_sagas()
+        print(f"Saga完成: {saga_summary['completed']}, 补偿: {saga_summary['compensated']}, "
+              f"失败: {saga_summary['failed']}")
+        return summary['failed'] == 0 and saga_summary['failed'] == 0
+    except Exception as e:
+        print(f"事务恢复失败: {e}")
+        return False
+
+def rebalance_shard(start, end, target):
+    """在线迁移账户区间到目标节点"""
+    print(f"迁移账户区间 [{start}, {end if end is not None else '∞'}) 到 {target}...")
+    try:
+        from rebalancer import ShardRebalancer
+        summary = ShardRebalancer().move_range(start, end, target)
+        print(f"复制: {summary['copied']} 行 ({summary['batches']} 批), "
+              f"清理: {summary['deleted']} 行, 校验和: {summary['checksum']}")
+        return True
+    except Exception as e:
+        print(f"分片迁移失败: {e}")
+        return False
+
 def show_status():
     """显示系统状态"""
     print("=== 分布式数据库系统状态 ===")
@@ -209,8 +266,11 @@ def main():
     parser = argparse.ArgumentParser(description='分布式数据库系统管理工具')
     parser.add_argument('command', choices=[
         'setup', 'start-db', 'stop-db', 'remove-db', 'init-db',
-        'test', 'web', 'demo', 'status', 'all'
+        'test', 'web', 'serve', 'demo', 'status', 'recover', 'rebalance', 'all'
     ], help='要执行的命令')
+    parser.add_argument('--start', type=int, help='rebalance: 迁移区间起始账户ID（包含）')
+    parser.add_argument('--end', type=int, help='rebalance: 迁移区间结束账户ID（不包含，省略表示不限）')
+    parser.add_argument('--target', help='rebalance: 目标节点ID')
 
     args = parser.parse_args()
 
@@ -259,6 +319,12 @@ def main():
             sys.exit(1)
         start_web_interface()
 
+    elif args.command == 'serve':
+        if not check_dependencies():
+            sys.exit(1)
+        if not serve_web_interface():
+            sys.exit(1)
+
     elif args.command == 'demo':
         if not check_dependencies():
             sys.exit(1)
@@ -268,6 +334,16 @@ def main():
     elif args.command == 'status':
         show_status()
 
+    elif args.command == 'recover':
+        if not recover_transactions():
+            sys.exit(1)
+
+    elif args.command == 'rebalance':
+        if args.start is None or not args.target:
+            parser.error("rebalance requires --start and --target")
+        if not rebalance_shard(args.start, args.end, args.target):
+            sys.exit(1)
+
     elif args.command == 'all':
         print("执行完整流程...")
         if not check_dependencies():
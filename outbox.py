@@ -0,0 +1,142 @@
+"""
+事务发件箱模块
+业务事务在同一（分布式或本地）事务中把待推送的事件写入所在节点的event_outbox表，
+后台分发线程分批读取，每个间隔按事件类型合并为一次SocketIO广播，广播后删除（至少一次投递）
+"""
+import json
+import threading
+from typing import Callable, Dict, List, Tuple
+from config import WebConfig
+from database_manager import get_db_manager
+from logger import system_logger, log_system_info
+
+def enqueue_events(conn, events: List[Tuple[str, Dict]]) -> int:
+    """在调用方的事务中写入事件 [(event_type, payload)]，随事务一起提交或回滚"""
+    if not events:
+        return 0
+    cursor = conn.cursor()
+    cursor.executemany("INSERT INTO event_outbox (event_type, payload) VALUES (%s, %s)",
+                       [(event_type, json.dumps(payload, default=str)) for event_type, payload in events])
+    cursor.close()
+    return len(events)
+
+def enqueue_event(conn, event_type: str, payload: Dict) -> int:
+    """在调用方的事务中写入一个事件"""
+    return enqueue_events(conn, [(event_type, payload)])
+
+class OutboxDispatcher:
+    """发件箱分发器：每个间隔读取各节点的一批事件，同类事件合并为一次广播"""
+
+    def __init__(self, emit: Callable[[str, Dict], None], db_manager=None,
+                 interval_ms: float = None, batch_size: int = None, max_age: float = None):
+        self.emit = emit
+        self.db_manager = db_manager or get_db_manager()
+        self.interval = (interval_ms if interval_ms is not None
+                         else WebConfig.OUTBOX_DISPATCH_INTERVAL_MS) / 1000.0
+        self.batch_size = batch_size or WebConfig.OUTBOX_BATCH_SIZE
+        self.max_age = max_age if max_age is not None else WebConfig.OUTBOX_MAX_AGE
+        self.dispatched_count = 0
+        self.broadcast_count = 0
+        self.expired_count = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        """分发线程是否在运行"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def _claim(self, node_id: str):
+        """锁定节点上最早的一批事件（跳过其他分发器已锁定的行），返回 (连接, 事件行)"""
+        conn = self.db_manager.get_connection(node_id)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, event_type, payload, created_at < NOW() - INTERVAL %s SECOND AS expired
+                FROM event_outbox ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED
+            """, (self.max_age, self.batch_size))
+            rows = cursor.fetchall()
+            cursor.close()
+            return conn, rows
+        except Exception:
+            conn.rollback()
+            conn.close()
+            raise
+
+    def dispatch_once(self) -> int:
+        """分发一批事件：广播成功后删除，广播失败时回滚由下次重试；返回分发的事件数"""
+        claimed = []
+        events: Dict[str, List[Dict]] = {}
+        try:
+            for node_id in self.db_manager.nodes:
+                try:
+                    conn, rows = self._claim(node_id)
+                except Exception as e:
+                    system_logger.warning(f"Outbox read failed on {node_id}: {e}")
+                    continue
+                claimed.append((conn, [row[0] for row in rows]))
+                for _, event_type, payload, expired in rows:
+                    if expired:
+                        # 进程长时间未运行时遗留的事件不再推送
+                        self.expired_count += 1
+                    else:
+                        events.setdefault(event_type, []).append(json.loads(payload))
+
+            # 同类事件合并为一次广播
+            for event_type, payloads in events.items():
+                self.emit(event_type, {'count': len(payloads), 'events': payloads})
+                self.broadcast_count += 1
+
+            dispatched = 0
+            for conn, ids in claimed:
+                if ids:
+                    cursor = conn.cursor()
+                    cursor.execute(f"DELETE FROM event_outbox WHERE id IN ({', '.join(['%s'] * len(ids))})",
+                                 tuple(ids))
+                    cursor.close()
+                conn.commit()
+                dispatched += len(ids)
+            self.dispatched_count += dispatched
+            return dispatched
+
+        except Exception:
+            for conn, _ in claimed:
+                try:
+                    conn.rollback()
+                except:
+                    pass
+            raise
+        finally:
+            for conn, _ in claimed:
+                conn.close()
+
+    def get_stats(self) -> Dict:
+        """分发统计"""
+        return {
+            'running': self.running,
+            'dispatched': self.dispatched_count,
+            'broadcasts': self.broadcast_count,
+            'expired': self.expired_count
+        }
+
+    def start(self):
+        """启动分发线程"""
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True, name='outbox-dispatcher')
+        self._thread.start()
+        log_system_info("OutboxDispatcher", f"Outbox dispatcher started (interval {self.interval * 1000:.0f} ms)")
+
+    def stop(self):
+        """停止分发线程"""
+        self._stop.set()
+
+    def _loop(self):
+        """按固定间隔分发"""
+        while not self._stop.is_set():
+            try:
+                self.dispatch_once()
+            except Exception as e:
+                system_logger.warning(f"Outbox dispatch failed: {e}")
+            self._stop.wait(self.interval)
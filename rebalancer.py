@@ -0,0 +1,278 @@
+"""
+在线分片迁移模块
+将账户ID区间从源分片在线迁移到目标分片：开启双写 -> 分批复制 -> 校验并原子切换路由 -> 结束双写并清理源数据
+"""
+import time
+from typing import Dict, List, Optional, Tuple
+from config import ShardConfig
+from database_manager import get_db_manager
+from coordinator_log import get_coordinator_log
+from transaction_manager import EnhancedTransactionManager
+from shard_map import RangeShardMap, get_shard_map, load_routing, save_routing, ROUTING_TABLE_SQL
+from init_databases import ACCOUNTS_TABLE_SQL
+from logger import system_logger, log_system_info, log_system_error
+
+def _range_clause(start: int, end: Optional[int]) -> Tuple[str, Tuple]:
+    """区间 [start, end) 的WHERE条件，end为None表示不限"""
+    if end is None:
+        return "id >= %s", (start,)
+    return "id >= %s AND id < %s", (start, end)
+
+def _range_checksum(conn, start: int, end: Optional[int]) -> Tuple:
+    """区间内账户的行数、余额总和与逐行校验和；加共享锁，使两端在同一时刻读取"""
+    clause, params = _range_clause(start, end)
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT COUNT(*), COALESCE(SUM(balance), 0), BIT_XOR(CRC32(CONCAT_WS(':', id, balance)))
+        FROM accounts WHERE {clause} FOR SHARE
+    """, params)
+    count, total, checksum = cursor.fetchone()
+    cursor.close()
+    return int(count), total, int(checksum)
+
+def _read_batch(conn, lower: int, end: Optional[int], limit: int) -> List[Tuple]:
+    """锁定并读取源分片上从lower开始的一批账户"""
+    clause, params = _range_clause(lower, end)
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT id, balance FROM accounts WHERE {clause} ORDER BY id LIMIT %s FOR UPDATE",
+                 params + (limit,))
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+def _upsert_accounts(conn, rows: List[Tuple]):
+    """把一批账户写入目标分片，已存在的行以源分片为准"""
+    cursor = conn.cursor()
+    cursor.executemany("""
+        INSERT INTO accounts (id, balance) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE balance = VALUES(balance)
+    """, rows)
+    cursor.close()
+    return len(rows)
+
+def split_range(ranges: List[Tuple[int, Optional[int], str]], start: int, end: Optional[int],
+                node: str) -> List[Tuple[int, Optional[int], str]]:
+    """把 [start, end) 从所在区间中切分出来并分配给node，要求它完整落在一个现有区间内"""
+    for index, (lower, upper, owner) in enumerate(ranges):
+        if lower <= start and (upper is None or (end is not None and end <= upper)):
+            pieces = []
+            if lower < start:
+                pieces.append((lower, start, owner))
+            pieces.append((start, end, node))
+            if end != upper:
+                pieces.append((end, upper, owner))
+            return ranges[:index] + pieces + ranges[index + 1:]
+    raise ValueError(f"Range {start}-{end} does not fit inside a single shard range")
+
+def merge_ranges(ranges: List[Tuple[int, Optional[int], str]]) -> List[Tuple[int, Optional[int], str]]:
+    """合并相邻且属于同一节点的区间"""
+    merged: List[Tuple[int, Optional[int], str]] = []
+    for lower, upper, node in sorted(ranges, key=lambda r: r[0]):
+        if merged and merged[-1][1] == lower and merged[-1][2] == node:
+            merged[-1] = (merged[-1][0], upper, node)
+        else:
+            merged.append((lower, upper, node))
+    return merged
+
+class ShardRebalancer:
+    """在线区间迁移器"""
+
+    def __init__(self, db_manager=None, shard_map: RangeShardMap = None, coordinator_log=None,
+                 batch_size: int = None, throttle_ms: float = None, propagation_delay: float = None):
+        self.db_manager = db_manager or get_db_manager()
+        self.shard_map = shard_map or get_shard_map()
+        self.coordinator_log = coordinator_log or get_coordinator_log()
+        self.batch_size = max(1, batch_size or ShardConfig.REBALANCE_BATCH_SIZE)
+        throttle_ms = ShardConfig.REBALANCE_THROTTLE_MS if throttle_ms is None else throttle_ms
+        self.throttle = throttle_ms / 1000.0
+        # 路由变更后等待其他进程重新加载的时间
+        self.propagation_delay = (ShardConfig.ROUTING_REFRESH_INTERVAL * 2
+                                  if propagation_delay is None else propagation_delay)
+        self.routing_node = ShardConfig.ROUTING_NODE
+
+    def move_range(self, start: int, end: Optional[int], target: str) -> Dict:
+        """把账户区间 [start, end) 在线迁移到target节点，返回迁移摘要"""
+        if not isinstance(self.shard_map, RangeShardMap):
+            raise Exception("Online rebalancing requires the range shard strategy")
+        if target not in self.db_manager.nodes:
+            raise ValueError(f"Unknown database node: {target}")
+        if end is not None and end <= start:
+            raise ValueError(f"Invalid range {start}-{end}")
+
+        self._load_routing()
+        source, resuming = self._check_source(start, end, target)
+        log_system_info("Rebalancer", f"Moving accounts {start}-{end} from {source} to {target}"
+                                      f"{' (resuming)' if resuming else ''}")
+
+        # 1. 清空目标区间并开启双写，等待所有进程开始双写
+        if not resuming:
+            self._prepare_target(target, start, end)
+            self._publish(split_range(self.shard_map.ranges, start, end, source), {start: target})
+            self._wait_for_propagation()
+
+        # 2. 分批复制，每批在一个分布式事务中锁定源行并写入目标
+        copied, batches = self._copy(source, target, start, end)
+
+        # 3. 校验两端校验和，一致时在同一事务中切换路由（源分片继续作为镜像）
+        checksum = self._verify_and_flip(source, target, start, end)
+        self._wait_for_propagation()
+
+        # 4. 结束双写，等待所有进程只写目标分片后清理源数据
+        self._publish(merge_ranges(self.shard_map.ranges), {})
+        self._wait_for_propagation()
+        deleted = self._purge(source, start, end)
+
+        summary = {
+            'range': [start, end],
+            'source': source,
+            'target': target,
+            'copied': copied,
+            'batches': batches,
+            'deleted': deleted,
+            'rows': checksum[0],
+            'checksum': checksum[2]
+        }
+        log_system_info("Rebalancer", f"Range move finished: {summary}")
+        return summary
+
+    def _load_routing(self):
+        """确保路由表存在并加载；尚未持久化时写入当前路由"""
+        conn = self.db_manager.get_connection(self.routing_node)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(ROUTING_TABLE_SQL)
+            cursor.close()
+            conn.commit()
+        finally:
+            conn.close()
+
+        routing = load_routing(self.db_manager)
+        if routing is None:
+            self._publish(self.shard_map.ranges, self.shard_map.mirrors)
+        else:
+            self.shard_map.replace(*routing)
+
+    def _check_source(self, start: int, end: Optional[int], target: str) -> Tuple[str, bool]:
+        """确定源节点；同一区间到同一目标的未完成迁移可以继续"""
+        mirrors = self.shard_map.mirrors
+        for lower, upper, node in self.shard_map.ranges:
+            if (lower, upper) == (start, end) and mirrors.get(lower) == target:
+                return node, True
+
+        if mirrors:
+            raise Exception(f"Another range migration is in progress: {mirrors}")
+        source = self.shard_map.node_for(start)
+        if source == target:
+            raise ValueError(f"Range {start}-{end} is already on {target}")
+        split_range(self.shard_map.ranges, start, end, target)
+        return source, False
+
+    def _prepare_target(self, target: str, start: int, end: Optional[int]):
+        """在目标节点建表并清除区间内的残留数据"""
+        clause, params = _range_clause(start, end)
+        conn = self.db_manager.get_connection(target)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(ACCOUNTS_TABLE_SQL)
+            cursor.execute(f"DELETE FROM accounts WHERE {clause}", params)
+            cursor.close()
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _publish(self, ranges: List[Tuple[int, Optional[int], str]], mirrors: Dict[int, str]):
+        """持久化路由并在本进程立即生效"""
+        conn = self.db_manager.get_connection(self.routing_node)
+        try:
+            save_routing(conn, ranges, mirrors)
+            conn.commit()
+        finally:
+            conn.close()
+        self.shard_map.replace(ranges, mirrors)
+        system_logger.info(f"Shard routing published: {self.shard_map.describe()}")
+
+    def _wait_for_propagation(self):
+        """等待其他进程的路由刷新线程加载最新路由"""
+        if self.propagation_delay > 0:
+            time.sleep(self.propagation_delay)
+
+    def _new_transaction(self) -> EnhancedTransactionManager:
+        """创建迁移使用的分布式事务"""
+        tm = EnhancedTransactionManager(db_manager=self.db_manager, coordinator_log=self.coordinator_log)
+        tm.begin_transaction()
+        return tm
+
+    def _copy(self, source: str, target: str, start: int, end: Optional[int]) -> Tuple[int, int]:
+        """按ID顺序分批复制，批次之间限速；返回复制行数和批次数"""
+        copied, batches, lower = 0, 0, start
+        while True:
+            tm = self._new_transaction()
+            try:
+                rows = tm.execute_operation(source, _read_batch, lower, end, self.batch_size)
+                if rows:
+                    tm.execute_operation(target, _upsert_accounts, rows)
+                tm.prepare()
+                tm.commit()
+            except Exception:
+                tm.rollback()
+                raise
+            finally:
+                tm.cleanup()
+
+            if not rows:
+                break
+            copied += len(rows)
+            batches += 1
+            lower = rows[-1][0] + 1
+            if len(rows) < self.batch_size:
+                break
+            time.sleep(self.throttle)
+
+        return copied, batches
+
+    def _verify_and_flip(self, source: str, target: str, start: int, end: Optional[int]) -> Tuple:
+        """在一个分布式事务中比较两端校验和并切换路由，不一致时保持双写并抛出异常"""
+        tm = self._new_transaction()
+        try:
+            expected = tm.execute_operation(source, _range_checksum, start, end)
+            actual = tm.execute_operation(target, _range_checksum, start, end)
+            if expected != actual:
+                raise Exception(f"Checksum mismatch for range {start}-{end}: "
+                              f"{source}={expected}, {target}={actual}")
+
+            ranges = split_range(self.shard_map.ranges, start, end, target)
+            mirrors = {start: source}
+            tm.execute_operation(self.routing_node, save_routing, ranges, mirrors)
+            tm.prepare()
+            tm.commit()
+
+        except Exception as e:
+            log_system_error("Rebalancer.verify", str(e))
+            tm.rollback()
+            raise
+        finally:
+            tm.cleanup()
+
+        self.shard_map.replace(ranges, mirrors)
+        system_logger.info(f"Shard routing flipped: {self.shard_map.describe()}")
+        return expected
+
+    def _purge(self, source: str, start: int, end: Optional[int]) -> int:
+        """分批删除源分片上已迁走的账户"""
+        clause, params = _range_clause(start, end)
+        deleted = 0
+        while True:
+            conn = self.db_manager.get_connection(source)
+            try:
+                cursor = conn.cursor()
+                cursor.execute(f"DELETE FROM accounts WHERE {clause} LIMIT %s", params + (self.batch_size,))
+                count = cursor.rowcount
+                cursor.close()
+                conn.commit()
+            finally:
+                conn.close()
+
+            deleted += count
+            if count < self.batch_size:
+                return deleted
+            time.sleep(self.throttle)
@@ -0,0 +1,278 @@
+"""
+Saga事务管理器
+每个步骤作为本地事务立即提交并登记补偿操作，失败时按相反顺序执行补偿。
+补偿记录持久化在db2，进程崩溃后由恢复流程继续完成或补偿。
+与XA相比不提供隔离性（中间状态对其他事务可见），但行锁只在单个步骤的本地事务内持有
+"""
+import json
+import time
+import uuid
+from enum import Enum
+from typing import Any, Callable, Dict, List
+from config import TransactionConfig
+from database_manager import get_db_manager
+from logger import transaction_logger, log_system_info, log_system_error
+
+class SagaState(Enum):
+    """Saga状态枚举"""
+    RUNNING = "RUNNING"
+    COMPLETED = "COMPLETED"
+    COMPENSATING = "COMPENSATING"
+    COMPENSATED = "COMPENSATED"
+    FAILED = "FAILED"  # 补偿失败，等待恢复流程重试
+
+# 已注册的补偿操作：按名称持久化，恢复时按名称查找
+_COMPENSATIONS: Dict[str, Callable] = {}
+
+# 清理生效标记时每批查询的saga数量
+MARKER_PURGE_BATCH = 500
+
+def compensation(func: Callable) -> Callable:
+    """注册补偿操作：签名为func(conn, *args)，参数须可JSON序列化（Decimal按字符串保存）"""
+    _COMPENSATIONS[func.__name__] = func
+    return func
+
+def _mark_applied(conn, saga_id: str, step_no: int):
+    """在步骤的本地事务中写入生效标记，标记与步骤一起提交或回滚"""
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO saga_applied (saga_id, step_no) VALUES (%s, %s)", (saga_id, step_no))
+    cursor.close()
+
+def _unmark_applied(conn, saga_id: str, step_no: int) -> bool:
+    """在补偿的本地事务中删除生效标记，标记存在（步骤已生效且未补偿）时返回True"""
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM saga_applied WHERE saga_id = %s AND step_no = %s", (saga_id, step_no))
+    removed = cursor.rowcount == 1
+    cursor.close()
+    return removed
+
+def _is_applied(db_manager, node_id: str, saga_id: str, step_no: int) -> bool:
+    """查询步骤是否已在节点上生效"""
+    rows = db_manager.execute_query(node_id, "SELECT 1 FROM saga_applied WHERE saga_id = %s AND step_no = %s",
+                                    (saga_id, step_no), primary=True)
+    return bool(rows)
+
+def _execute_write(db_manager, node_id: str, sql: str, params: tuple) -> int:
+    """在节点上执行一条写语句并提交，返回影响行数"""
+    conn = db_manager.get_connection(node_id)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        updated = cursor.rowcount
+        conn.commit()
+        cursor.close()
+        return updated
+    finally:
+        conn.close()
+
+def _set_status(db_manager, log_node: str, saga_id: str, state: SagaState):
+    """更新saga状态"""
+    _execute_write(db_manager, log_node, "UPDATE sagas SET status = %s WHERE saga_id = %s",
+                   (state.value, saga_id))
+
+def _run_compensations(db_manager, saga_id: str, steps: List[Dict]) -> SagaState:
+    """
+    按相反顺序补偿已生效的步骤，每个补偿与删除生效标记在同一本地事务中提交，重复执行不会重复补偿。
+    不可补偿的关键步骤已生效时saga应向前完成，不做补偿
+    """
+    for step in steps:
+        if step['compensation'] is None and _is_applied(db_manager, step['node_id'], saga_id, step['step_no']):
+            return SagaState.COMPLETED
+
+    for step in reversed(steps):
+        if step['compensation'] is None:
+            continue
+        conn = db_manager.get_connection(step['node_id'])
+        try:
+            if _unmark_applied(conn, saga_id, step['step_no']):
+                step['compensation'](conn, *step['args'])
+                transaction_logger.info(f"Saga {saga_id} compensated step {step['step_no']} on "
+                                      f"{step['node_id']}: {step['compensation'].__name__}")
+            conn.commit()
+        except Exception:
+            try:
+                conn.rollback()
+            except:
+                pass
+            raise
+        finally:
+            conn.close()
+    return SagaState.COMPENSATED
+
+class SagaExecutor:
+    """Saga执行器：步骤逐个本地提交，失败时按相反顺序补偿"""
+
+    def __init__(self, name: str, db_manager=None, log_node: str = None):
+        self.saga_id = str(uuid.uuid4())
+        self.name = name
+        self.db_manager = db_manager or get_db_manager()
+        self.log_node = log_node or TransactionConfig.SAGA_LOG_NODE
+        self.state = SagaState.RUNNING
+        self.start_time = time.time()
+        self.steps: List[Dict] = []
+
+    def _record_step(self, step: Dict):
+        """在执行步骤前持久化其补偿操作，第一个步骤同时写入saga记录"""
+        conn = self.db_manager.get_connection(self.log_node)
+        try:
+            cursor = conn.cursor()
+            if step['step_no'] == 1:
+                cursor.execute("INSERT INTO sagas (saga_id, name, status) VALUES (%s, %s, %s)",
+                             (self.saga_id, self.name, SagaState.RUNNING.value))
+            compensation_name = step['compensation'].__name__ if step['compensation'] else None
+            cursor.execute("""
+                INSERT INTO saga_compensations (saga_id, step_no, node_id, compensation, args)
+                VALUES (%s, %s, %s, %s, %s)
+            """, (self.saga_id, step['step_no'], step['node_id'], compensation_name,
+                  json.dumps(list(step['args']), default=str)))
+            conn.commit()
+            cursor.close()
+        finally:
+            conn.close()
+
+    def execute_step(self, node_id: str, operation: Callable, *args,
+                     compensation: Callable = None, compensation_args: tuple = ()) -> Any:
+        """
+        在node_id上以本地事务执行operation(conn, *args)并立即提交，返回操作结果。
+        compensation为已注册的补偿操作，saga失败时以compensation_args调用；
+        为None的步骤是不可补偿的关键步骤，必须是最后一步。
+        operation返回False时回滚本地事务并返回False，该步骤无需补偿
+        """
+        if self.state != SagaState.RUNNING:
+            raise Exception(f"Saga {self.saga_id} is not running")
+        if compensation is not None and _COMPENSATIONS.get(compensation.__name__) is not compensation:
+            raise ValueError(f"Compensation {compensation.__name__} is not registered")
+
+        step = {'step_no': len(self.steps) + 1, 'node_id': node_id,
+                'compensation': compensation, 'args': tuple(compensation_args)}
+        self._record_step(step)
+        self.steps.append(step)
+
+        conn = self.db_manager.get_connection(node_id)
+        try:
+            result = operation(conn, *args)
+            if result is False:
+                conn.rollback()
+                return False
+            _mark_applied(conn, self.saga_id, step['step_no'])
+            conn.commit()
+            self.db_manager.record_write(node_id)
+            transaction_logger.debug(f"Saga {self.saga_id} step {step['step_no']} committed on {node_id}: "
+                                   f"{getattr(operation, '__name__', operation)}")
+            return result
+
+        except Exception as e:
+            try:
+                conn.rollback()
+            except:
+                pass
+            log_system_error(f"SagaExecutor.execute_step.{node_id}", str(e))
+            raise Exception(f"Saga step {step['step_no']} failed on {node_id}: {e}")
+        finally:
+            conn.close()
+
+    def complete(self):
+        """标记saga完成；状态写入失败不影响结果，恢复流程会根据关键步骤的生效标记补记"""
+        self.state = SagaState.COMPLETED
+        if not self.steps:
+            return
+        try:
+            _set_status(self.db_manager, self.log_node, self.saga_id, SagaState.COMPLETED)
+        except Exception as e:
+            log_system_error("SagaExecutor.complete", f"Failed to record completion of saga {self.saga_id}: {e}")
+
+    def compensate(self) -> SagaState:
+        """按相反顺序补偿已提交的步骤；补偿失败时saga标记为FAILED，由恢复流程重试"""
+        if self.state != SagaState.RUNNING:
+            return self.state
+        self.state = SagaState.COMPENSATING
+        if not self.steps:
+            self.state = SagaState.COMPENSATED
+            return self.state
+
+        try:
+            _set_status(self.db_manager, self.log_node, self.saga_id, SagaState.COMPENSATING)
+            self.state = _run_compensations(self.db_manager, self.saga_id, self.steps)
+        except Exception as e:
+            self.state = SagaState.FAILED
+            log_system_error("SagaExecutor.compensate", f"Saga {self.saga_id} compensation failed: {e}")
+
+        try:
+            _set_status(self.db_manager, self.log_node, self.saga_id, self.state)
+        except Exception as e:
+            log_system_error("SagaExecutor.compensate", f"Failed to record state of saga {self.saga_id}: {e}")
+        transaction_logger.info(f"Saga {self.saga_id} ({self.name}) finished compensation: {self.state.value}")
+        return self.state
+
+def recover_sagas(db_manager=None, log_node: str = None, older_than: float = None) -> Dict[str, int]:
+    """
+    完成或补偿超过older_than秒（默认事务超时时间）仍未结束的saga（进程崩溃遗留或补偿失败），
+    然后清理已完成或已补偿saga的生效标记
+    """
+    db_manager = db_manager or get_db_manager()
+    log_node = log_node or TransactionConfig.SAGA_LOG_NODE
+    older_than = older_than if older_than is not None else TransactionConfig.TRANSACTION_TIMEOUT
+    summary = {'completed': 0, 'compensated': 0, 'failed': 0}
+
+    rows = db_manager.execute_query(log_node, """
+        SELECT c.saga_id, c.step_no, c.node_id, c.compensation, c.args
+        FROM sagas s JOIN saga_compensations c ON c.saga_id = s.saga_id
+        WHERE s.status IN ('RUNNING', 'COMPENSATING', 'FAILED')
+          AND s.updated_at < NOW() - INTERVAL %s SECOND
+        ORDER BY c.saga_id, c.step_no
+    """, (older_than,), primary=True)
+
+    sagas: Dict[str, List[Dict]] = {}
+    for row in rows:
+        sagas.setdefault(row['saga_id'], []).append(row)
+
+    unfinished = []
+    for saga_id, saga_rows in sagas.items():
+        try:
+            steps = []
+            for row in saga_rows:
+                compensation_func = None
+                if row['compensation'] is not None:
+                    compensation_func = _COMPENSATIONS.get(row['compensation'])
+                    if compensation_func is None:
+                        raise Exception(f"Unknown compensation {row['compensation']}")
+                steps.append({'step_no': row['step_no'], 'node_id': row['node_id'],
+                              'compensation': compensation_func, 'args': tuple(json.loads(row['args']))})
+
+            state = _run_compensations(db_manager, saga_id, steps)
+            _set_status(db_manager, log_node, saga_id, state)
+            summary['completed' if state == SagaState.COMPLETED else 'compensated'] += 1
+            transaction_logger.info(f"Recovered saga {saga_id}: {state.value}")
+
+        except Exception as e:
+            summary['failed'] += 1
+            unfinished.append(saga_id)
+            log_system_error(f"SagaRecovery.{saga_id}", str(e))
+            try:
+                _set_status(db_manager, log_node, saga_id, SagaState.FAILED)
+            except Exception:
+                pass
+
+    # 只清理已完成或已补偿的saga的生效标记；sagas表在日志节点上，无法与各节点联表，按ID分批过滤
+    for node_id in db_manager.nodes:
+        try:
+            marked = db_manager.execute_query(node_id, """
+                SELECT DISTINCT saga_id FROM saga_applied WHERE created_at < NOW() - INTERVAL %s SECOND
+            """, (older_than,), primary=True)
+            saga_ids = [row['saga_id'] for row in marked]
+            for i in range(0, len(saga_ids), MARKER_PURGE_BATCH):
+                chunk = saga_ids[i:i + MARKER_PURGE_BATCH]
+                placeholders = ', '.join(['%s'] * len(chunk))
+                finished = [row['saga_id'] for row in db_manager.execute_query(log_node, f"""
+                    SELECT saga_id FROM sagas
+                    WHERE status IN ('COMPLETED', 'COMPENSATED') AND saga_id IN ({placeholders})
+                """, tuple(chunk), primary=True)]
+                if finished:
+                    _execute_write(db_manager, node_id,
+                                   f"DELETE FROM saga_applied WHERE saga_id IN ({', '.join(['%s'] * len(finished))})",
+                                   tuple(finished))
+        except Exception as e:
+            log_system_error(f"SagaRecovery.{node_id}", f"Failed to purge applied markers: {e}")
+
+    log_system_info("SagaRecovery", f"Saga recovery finished: {summary}")
+    return summary
@@ -0,0 +1,132 @@
+"""
+结果集序列化模块
+按列类型为整个结果集一次性选定转换函数，把Decimal、日期时间等值转换为JSON可序列化的类型；
+安装orjson时提供更快的JSON编码器
+"""
+import json
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+from mysql.connector import FieldType
+from config import WebConfig
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _to_float(value):
+    """Decimal转换为float"""
+    return None if value is None else float(value)
+
+def _to_isoformat(value):
+    """日期时间转换为ISO 8601字符串"""
+    return None if value is None else value.isoformat()
+
+def _to_str(value):
+    """TIME列（timedelta）转换为字符串"""
+    return None if value is None else str(value)
+
+def _convert_any(value):
+    """类型未知的列逐值判断（只用于首行为NULL且没有列描述的列）"""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, timedelta):
+        return str(value)
+    return value
+
+# 需要转换的MySQL列类型
+_TYPE_CONVERTERS: Dict[int, Callable] = {
+    FieldType.DECIMAL: _to_float,
+    FieldType.NEWDECIMAL: _to_float,
+    FieldType.DATE: _to_isoformat,
+    FieldType.DATETIME: _to_isoformat,
+    FieldType.TIMESTAMP: _to_isoformat,
+    FieldType.TIME: _to_str,
+}
+
+def converters_from_description(description: Sequence[tuple]) -> Dict[str, Callable]:
+    """根据游标的列描述选出需要转换的列及其转换函数"""
+    return {column[0]: _TYPE_CONVERTERS[column[1]]
+            for column in description if column[1] in _TYPE_CONVERTERS}
+
+def converters_from_row(row: Dict) -> Dict[str, Callable]:
+    """没有列描述时按首行的值类型推断转换函数"""
+    converters = {}
+    for name, value in row.items():
+        if value is None:
+            converters[name] = _convert_any
+        elif isinstance(value, Decimal):
+            converters[name] = _to_float
+        elif isinstance(value, (datetime, date)):
+            converters[name] = _to_isoformat
+        elif isinstance(value, timedelta):
+            converters[name] = _to_str
+    return converters
+
+def serialize_rows(rows: List[Dict], description: Optional[Sequence[tuple]] = None) -> List[Dict]:
+    """
+    原地转换结果集并返回：每列只确定一次转换函数，只访问需要转换的列。
+    description默认取结果集自带的列描述（DatabaseManager返回的ResultSet）
+    """
+    if not rows:
+        return rows
+
+    description = description if description is not None else getattr(rows, 'description', None)
+    converters = (converters_from_description(description) if description
+                  else converters_from_row(rows[0]))
+    columns = list(converters.items())
+    if not columns:
+        return rows
+
+    for row in rows:
+        for name, convert in columns:
+            if name in row:
+                row[name] = convert(row[name])
+    return rows
+
+class RowSerializer:
+    """逐行转换器：用于流式结果，首行或列描述确定转换函数后复用"""
+
+    def __init__(self, description: Optional[Sequence[tuple]] = None):
+        self._columns = (list(converters_from_description(description).items())
+                         if description else None)
+
+    def __call__(self, row: Dict) -> Dict:
+        if self._columns is None:
+            self._columns = list(converters_from_row(row).items())
+        for name, convert in self._columns:
+            if name in row:
+                row[name] = convert(row[name])
+        return row
+
+    def serialize_all(self, rows: Iterable[Dict]) -> Iterable[Dict]:
+        """逐行转换一个可迭代的结果流"""
+        for row in rows:
+            yield self(row)
+
+def _json_default(value):
+    """编码器遇到未转换的值时的兜底转换"""
+    converted = _convert_any(value)
+    if converted is value:
+        raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+    return converted
+
+def fast_json_available() -> bool:
+    """是否使用orjson编码（已安装且配置未禁用）"""
+    return orjson is not None and WebConfig.JSON_ENCODER != 'json'
+
+def dumps(obj, fast: bool = None) -> str:
+    """编码为JSON字符串；fast默认取配置，可用时使用orjson"""
+    fast = fast_json_available() if fast is None else fast and orjson is not None
+    if fast:
+        return orjson.dumps(obj, default=_json_default).decode()
+    return json.dumps(obj, default=_json_default, ensure_ascii=False)
+
+def loads(data):
+    """解析JSON"""
+    if fast_json_available():
+        return orjson.loads(data)
+    return json.loads(data)
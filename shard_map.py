@@ -0,0 +1,323 @@
+"""
+分片映射模块
+将账户ID路由到所在的数据库节点，支持按ID区间和一致性哈希两种策略
+"""
+import bisect
+import hashlib
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from config import ShardConfig
+from logger import system_logger
+
+class ShardMap:
+    """分片映射基类"""
+
+    strategy = None
+
+    @property
+    def nodes(self) -> List[str]:
+        """存放账户数据的所有节点"""
+        raise NotImplementedError
+
+    def node_for(self, key: int) -> str:
+        """获取键所在的节点"""
+        raise NotImplementedError
+
+    def mirror_for(self, key: int) -> Optional[str]:
+        """获取键在迁移期间需要同步写入的镜像节点，没有则返回None"""
+        return None
+
+    def route(self, key: int) -> Tuple[str, Optional[str]]:
+        """同时获取键所在节点和镜像节点（取自同一版本的路由）"""
+        return self.node_for(key), self.mirror_for(key)
+
+    def group_by_node(self, keys: Iterable[int]) -> Dict[str, List[int]]:
+        """按节点分组，组内键升序"""
+        groups: Dict[str, List[int]] = {}
+        for key in sorted(set(keys)):
+            groups.setdefault(self.node_for(key), []).append(key)
+        return groups
+
+    def group_by_mirror(self, keys: Iterable[int]) -> Dict[str, List[int]]:
+        """按镜像节点分组，只包含正在双写的键"""
+        groups: Dict[str, List[int]] = {}
+        for key in sorted(set(keys)):
+            mirror = self.mirror_for(key)
+            if mirror is not None:
+                groups.setdefault(mirror, []).append(key)
+        return groups
+
+    def describe(self) -> Dict:
+        """分片映射的描述信息"""
+        return {'strategy': self.strategy, 'nodes': self.nodes}
+
+class RangeShardMap(ShardMap):
+    """
+    按ID区间分片：每个区间 [lower, upper) 对应一个节点，upper为None表示不限。
+    迁移期间区间可带镜像节点，写入同时应用到镜像节点（双写）
+    """
+
+    strategy = 'range'
+
+    def __init__(self, ranges: List[Tuple[int, Optional[int], str]], mirrors: Dict[int, str] = None):
+        self.replace(ranges, mirrors)
+
+    @staticmethod
+    def _validate(ranges: List[Tuple[int, Optional[int], str]]) -> List[Tuple[int, Optional[int], str]]:
+        """排序并校验区间不重叠"""
+        if not ranges:
+            raise ValueError("Range shard map requires at least one range")
+
+        ranges = sorted(ranges, key=lambda r: r[0])
+        for (lower, upper, node), (next_lower, _, _) in zip(ranges, ranges[1:]):
+            if upper is None or upper > next_lower:
+                raise ValueError(f"Shard range {lower}-{upper} on {node} overlaps with range starting at {next_lower}")
+        for lower, upper, node in ranges:
+            if upper is not None and upper <= lower:
+                raise ValueError(f"Invalid shard range {lower}-{upper} on {node}")
+        return ranges
+
+    def replace(self, ranges: List[Tuple[int, Optional[int], str]], mirrors: Dict[int, str] = None):
+        """原子替换路由：读取方要么看到旧路由，要么看到新路由"""
+        ranges = self._validate(ranges)
+        mirrors = {lower: node for lower, node in (mirrors or {}).items() if node}
+        self._table = (ranges, [r[0] for r in ranges], mirrors)
+
+    @property
+    def ranges(self) -> List[Tuple[int, Optional[int], str]]:
+        return list(self._table[0])
+
+    @property
+    def mirrors(self) -> Dict[int, str]:
+        """正在双写的区间 {区间下界: 镜像节点}"""
+        return dict(self._table[2])
+
+    @property
+    def nodes(self) -> List[str]:
+        return list(dict.fromkeys(node for _, _, node in self._table[0]))
+
+    def _lookup(self, key: int) -> Tuple[int, str, Optional[str]]:
+        """返回键所在区间的下界、节点和镜像节点"""
+        ranges, lowers, mirrors = self._table
+        index = bisect.bisect_right(lowers, key) - 1
+        if index >= 0:
+            lower, upper, node = ranges[index]
+            if upper is None or key < upper:
+                return lower, node, mirrors.get(lower)
+        raise ValueError(f"No shard range covers key {key}")
+
+    def node_for(self, key: int) -> str:
+        return self._lookup(key)[1]
+
+    def mirror_for(self, key: int) -> Optional[str]:
+        return self._lookup(key)[2]
+
+    def route(self, key: int) -> Tuple[str, Optional[str]]:
+        return self._lookup(key)[1:]
+
+    def describe(self) -> Dict:
+        info = super().describe()
+        mirrors = self._table[2]
+        info['ranges'] = [{'node': node, 'lower': lower, 'upper': upper, 'mirror': mirrors.get(lower)}
+                          for lower, upper, node in self._table[0]]
+        return info
+
+class HashShardMap(ShardMap):
+    """一致性哈希分片：每个节点在哈希环上放置若干虚拟节点，增删节点只迁移相邻区段的键"""
+
+    strategy = 'hash'
+
+    def __init__(self, nodes: List[str], virtual_nodes: int = None):
+        if not nodes:
+            raise ValueError("Hash shard map requires at least one node")
+
+        self._nodes = list(dict.fromkeys(nodes))
+        self.virtual_nodes = max(1, virtual_nodes or ShardConfig.SHARD_VIRTUAL_NODES)
+        ring = sorted((self._hash(f"{node}#{i}"), node)
+                      for node in self._nodes for i in range(self.virtual_nodes))
+        self._points = [point for point, _ in ring]
+        self._owners = [node for _, node in ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        """稳定的64位哈希，各进程结果一致"""
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+    @property
+    def nodes(self) -> List[str]:
+        return list(self._nodes)
+
+    def node_for(self, key: int) -> str:
+        index = bisect.bisect_right(self._points, self._hash(str(key)))
+        return self._owners[index % len(self._owners)]
+
+    def describe(self) -> Dict:
+        info = super().describe()
+        info['virtual_nodes'] = self.virtual_nodes
+        return info
+
+def parse_ranges(spec: str) -> List[Tuple[int, Optional[int], str]]:
+    """解析区间配置，格式 "db1:0-100000,db3:100000-" """
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            node, _, bounds = part.partition(':')
+            lower, _, upper = bounds.partition('-')
+            ranges.append((int(lower), int(upper) if upper.strip() else None, node.strip()))
+        except ValueError:
+            raise ValueError(f"Invalid shard range '{part}', expected node:lower-upper")
+    return ranges
+
+def load_shard_map() -> ShardMap:
+    """根据配置创建分片映射"""
+    nodes = ShardConfig.ACCOUNT_SHARD_NODES
+    if ShardConfig.SHARD_STRATEGY == 'hash':
+        return HashShardMap(nodes, ShardConfig.SHARD_VIRTUAL_NODES)
+
+    if ShardConfig.SHARD_STRATEGY != 'range':
+        raise ValueError(f"Unknown shard strategy: {ShardConfig.SHARD_STRATEGY}")
+
+    ranges = parse_ranges(ShardConfig.ACCOUNT_SHARD_RANGES)
+    if not ranges:
+        if len(nodes) > 1:
+            raise ValueError("ACCOUNT_SHARD_RANGES is required when accounts span multiple nodes")
+        # 未配置区间时所有账户都在第一个节点上
+        ranges = [(-2 ** 63, None, nodes[0])]
+    return RangeShardMap(ranges)
+
+ROUTING_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS shard_ranges (
+    range_start BIGINT PRIMARY KEY,
+    range_end BIGINT NULL,
+    node_id VARCHAR(50) NOT NULL,
+    mirror_node VARCHAR(50) NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+)
+"""
+
+def load_routing(db_manager) -> Optional[Tuple[List[Tuple[int, Optional[int], str]], Dict[int, str]]]:
+    """从路由节点读取持久化的分片区间，未持久化时返回None"""
+    rows = db_manager.execute_query(ShardConfig.ROUTING_NODE, """
+        SELECT range_start, range_end, node_id, mirror_node FROM shard_ranges ORDER BY range_start
+    """, primary=True)
+    if not rows:
+        return None
+    ranges = [(row['range_start'], row['range_end'], row['node_id']) for row in rows]
+    mirrors = {row['range_start']: row['mirror_node'] for row in rows if row['mirror_node']}
+    return ranges, mirrors
+
+def save_routing(conn, ranges: List[Tuple[int, Optional[int], str]], mirrors: Dict[int, str]):
+    """整体替换持久化的分片区间（由调用方提交，可作为分布式事务中的一个操作）"""
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM shard_ranges")
+    cursor.executemany("""
+        INSERT INTO shard_ranges (range_start, range_end, node_id, mirror_node)
+        VALUES (%s, %s, %s, %s)
+    """, [(lower, upper, node, mirrors.get(lower)) for lower, upper, node in ranges])
+    cursor.close()
+    return len(ranges)
+
+class RoutingRefresher:
+    """后台定期从路由表重新加载区间分片，使其他进程的迁移和路由切换在一个刷新间隔内生效"""
+
+    def __init__(self, shard_map: ShardMap, db_manager, interval: float = None):
+        self.shard_map = shard_map
+        self.db_manager = db_manager
+        self.interval = interval or ShardConfig.ROUTING_REFRESH_INTERVAL
+        self.last_refresh = 0.0
+        # 路由变化后调用（多worker时通知其他worker重新加载）
+        self.on_change: Optional[Callable[[], None]] = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        """刷新线程是否在运行"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def refresh(self) -> bool:
+        """立即重新加载一次，路由有变化时返回True"""
+        routing = load_routing(self.db_manager)
+        self.last_refresh = time.time()
+        if routing is None:
+            return False
+
+        ranges, mirrors = routing
+        if ranges == self.shard_map.ranges and mirrors == self.shard_map.mirrors:
+            return False
+        self.shard_map.replace(ranges, mirrors)
+        # 账户可能已在节点间移动，缓存的账户查询结果全部失效（其他worker收到路由通知后各自失效）
+        for node_id in self.db_manager.nodes:
+            self.db_manager.invalidate_cache(node_id, 'accounts', broadcast=False)
+        system_logger.info(f"Shard routing reloaded: {self.shard_map.describe()}")
+        if self.on_change is not None:
+            self.on_change()
+        return True
+
+    def start(self):
+        """启动刷新线程"""
+        if self.running or not isinstance(self.shard_map, RangeShardMap):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True, name='shard-routing-refresh')
+        self._thread.start()
+
+    def stop(self):
+        """停止刷新线程"""
+        self._stop.set()
+
+    def _loop(self):
+        """按固定间隔重新加载"""
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                system_logger.warning(f"Shard routing refresh failed: {e}")
+            self._stop.wait(self.interval)
+
+# 全局分片映射实例 - 延迟初始化
+shard_map = None
+_shard_map_lock = threading.Lock()
+
+def get_shard_map() -> ShardMap:
+    """获取分片映射实例（单例模式）"""
+    global shard_map
+    if shard_map is None:
+        with _shard_map_lock:
+            if shard_map is None:
+                shard_map = load_shard_map()
+                system_logger.info(f"Shard map loaded: {shard_map.describe()}")
+    return shard_map
+
+routing_refresher = None
+
+def get_routing_refresher() -> RoutingRefresher:
+    """获取路由刷新器（延迟初始化，不启动刷新线程）"""
+    global routing_refresher
+    current = get_shard_map()
+    with _shard_map_lock:
+        if routing_refresher is None:
+            from database_manager import get_db_manager
+            routing_refresher = RoutingRefresher(current, get_db_manager())
+    return routing_refresher
+
+def start_routing_refresh():
+    """启动后台路由刷新（区间分片时生效）"""
+    refresher = get_routing_refresher()
+    refresher.start()
+    return refresher
+
+def _reset_after_fork():
+    """子进程不继承父进程的路由刷新线程，丢弃继承的实例后在首次使用时重新加载"""
+    global shard_map, routing_refresher, _shard_map_lock
+    shard_map = None
+    routing_refresher = None
+    _shard_map_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
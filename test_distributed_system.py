@@ -6,17 +6,37 @@ import pytest
 import mysql.connector
 import time
 import threading
-from unittest.mock import Mock, patch, MagicMock
+import asyncio
+import json
+import uuid
+from decimal import Decimal
+from unittest.mock import Mock, AsyncMock, patch, MagicMock, call
 import sys
 import os
 
 # 添加项目根目录到Python路径
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from transaction_manager import EnhancedTransactionManager, TransactionState, ParticipantState
-from database_manager import DatabaseManager, DatabaseNode
-from distributed_app import BankingService, InventoryService
-from config import DatabaseConfig, TransactionConfig
+from transaction_manager import (EnhancedTransactionManager, TransactionState, ParticipantState,
+                                 read_only_operation, is_retryable_error, LockConflict)
+from database_manager import (DatabaseManager, DatabaseNode, ConnectionPool,
+                              CircuitBreaker, CircuitState, HealthMonitor, ReadSession, QueryCache,
+                              ResultSet, execute_statement)
+from mysql.connector import PoolError, OperationalError
+from distributed_app import (BankingService, InventoryService, TransferBatcher, InventoryStripeFolder,
+                             reserve_striped_inventory)
+from config import DatabaseConfig, TransactionConfig, ShardConfig
+from shard_map import RangeShardMap, HashShardMap, parse_ranges, load_shard_map
+from rebalancer import ShardRebalancer, split_range, merge_ranges
+from coordinator_log import CoordinatorLog, recover_in_doubt_transactions, transaction_age
+from async_transaction_manager import AsyncTransactionManager
+from serialization import serialize_rows, RowSerializer, dumps
+from saga_manager import SagaExecutor, SagaState, compensation, recover_sagas
+from outbox import OutboxDispatcher
+from change_feed import ChangeFeed, diff_snapshots
+from worker_sync import WorkerSync
+from mysql.connector import FieldType
+from datetime import datetime
 
 class TestTransactionManager:
     """事务管理器测试类"""
@@ -69,6 +89,8 @@ class TestTransactionManager:
         self.tm.state = TransactionState.ACTIVE
         for participant in self.tm.participants.values():
             participant.xa_id = f"test_xa_{participant.participant_id}"
+            participant.touched = True
+            participant.read_only = False
         
         # 模拟成功的准备阶段
         for conn in self.mock_connections:
@@ -88,6 +110,8 @@ class TestTransactionManager:
         self.tm.state = TransactionState.ACTIVE
         for participant in self.tm.participants.values():
             participant.xa_id = f"test_xa_{participant.participant_id}"
+            participant.touched = True
+            participant.read_only = False
         
         # 模拟准备失败
         self.mock_connections[0].cursor.return_value.execute.side_effect = Exception("Prepare failed")
@@ -153,21 +177,462 @@ class TestTransactionManager:
         
         assert "timed out" in str(exc_info.value)
 
+    def test_prepare_runs_participants_in_parallel(self):
+        """测试准备阶段并行下发到所有参与者"""
+        self.tm.state = TransactionState.ACTIVE
+        for participant in self.tm.participants.values():
+            participant.xa_id = f"test_xa_{participant.participant_id}"
+            participant.touched = True
+            participant.read_only = False
+
+        # 每个参与者的XA命令耗时0.2秒
+        for conn in self.mock_connections:
+            conn.cursor.return_value.execute.side_effect = lambda sql: time.sleep(0.1)
+
+        start_time = time.time()
+        assert self.tm.prepare() is True
+        elapsed = time.time() - start_time
+
+        # 串行需要0.4秒，并行约0.2秒
+        assert elapsed < 0.35
+        for participant in self.tm.participants.values():
+            assert participant.state == ParticipantState.PREPARED
+
+    def test_prepare_timeout_covers_wall_clock(self):
+        """测试准备阶段超时按墙钟时间生效"""
+        self.tm.state = TransactionState.ACTIVE
+        self.tm.prepare_timeout = 0.1
+        for participant in self.tm.participants.values():
+            participant.xa_id = f"test_xa_{participant.participant_id}"
+            participant.touched = True
+            participant.read_only = False
+
+        self.mock_connections[0].cursor.return_value.execute.side_effect = lambda sql: time.sleep(0.3)
+
+        with pytest.raises(Exception) as exc_info:
+            self.tm.prepare()
+
+        assert "Prepare phase failed" in str(exc_info.value)
+        assert self.tm.state == TransactionState.ABORTED
+        assert self.tm.participants['participant_1'].detached is True
+
+        # 等待超时参与者完成延迟回滚
+        self.tm.participants['participant_1'].pending.result()
+        time.sleep(0.05)
+
+    def test_single_participant_prepare_times_out(self):
+        """测试只有一个参与者时准备阶段超时同样生效"""
+        tm = EnhancedTransactionManager(self.mock_connections[:1])
+        tm.prepare_timeout = 0.1
+        participant = tm.participants['participant_1']
+        release = threading.Event()
+
+        start = time.time()
+        errors = tm._fan_out(lambda pid, p: release.wait(), tm.participants, timeout=tm.prepare_timeout)
+        elapsed = time.time() - start
+        release.set()
+
+        assert isinstance(errors['participant_1'], TimeoutError)
+        assert elapsed < 0.3
+        assert participant.pending is not None
+
+    def test_queue_wait_not_counted_against_timeout(self):
+        """测试在线程池中排队的时间不计入参与者超时"""
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            with patch('transaction_manager.get_participant_executor', return_value=executor):
+                errors = self.tm._fan_out(lambda pid, p: time.sleep(0.15), self.tm.participants, timeout=0.25)
+        finally:
+            executor.shutdown()
+
+        assert errors == {'participant_1': None, 'participant_2': None}
+
+    def test_single_writer_uses_one_phase_commit(self):
+        """测试只有一个参与者写入时使用一阶段提交并跳过未使用的参与者"""
+        self.tm.begin_transaction()
+        self.tm.execute_operation("participant_1", lambda conn: None)
+
+        self.tm.prepare()
+        self.tm.commit()
+
+        assert self.tm.one_phase is True
+        assert self.tm.state == TransactionState.COMMITTED
+        assert self.tm.participants['participant_1'].state == ParticipantState.COMMITTED
+        assert self.tm.participants['participant_2'].state == ParticipantState.SKIPPED
+
+        xa_1 = self.tm.participants['participant_1'].xa_id
+        xa_2 = self.tm.participants['participant_2'].xa_id
+        sql_1 = [c.args[0] for c in self.mock_connections[0].cursor.return_value.execute.call_args_list]
+        sql_2 = [c.args[0] for c in self.mock_connections[1].cursor.return_value.execute.call_args_list]
+        assert f"XA COMMIT '{xa_1}' ONE PHASE" in sql_1
+        assert f"XA PREPARE '{xa_1}'" not in sql_1
+        assert sql_2 == [f"XA START '{xa_2}'", f"XA END '{xa_2}'", f"XA ROLLBACK '{xa_2}'"]
+
+    def test_multiple_writers_use_two_phase_commit(self):
+        """测试多个参与者写入时仍使用完整2PC"""
+        self.tm.begin_transaction()
+        self.tm.execute_operation("participant_1", lambda conn: None)
+        self.tm.execute_operation("participant_2", lambda conn: None)
+
+        self.tm.prepare()
+
+        assert self.tm.one_phase is False
+        for participant in self.tm.participants.values():
+            assert participant.state == ParticipantState.PREPARED
+
+class TestLazyEnlistment:
+    """延迟加入参与者测试类"""
+
+    def setup_method(self):
+        """测试前的设置"""
+        self.connections = {'db1': Mock(), 'db2': Mock()}
+        self.mock_db_manager = Mock()
+        self.mock_db_manager.get_connection.side_effect = lambda node_id: self.connections[node_id]
+        self.tm = EnhancedTransactionManager(db_manager=self.mock_db_manager)
+
+    def test_begin_does_not_borrow_connections(self):
+        """测试开始事务时不借用连接"""
+        self.tm.begin_transaction()
+
+        assert self.tm.state == TransactionState.ACTIVE
+        assert self.tm.participants == {}
+        self.mock_db_manager.get_connection.assert_not_called()
+
+    def test_first_operation_enlists_participant(self):
+        """测试首次操作时借用连接并开启XA分支"""
+        self.tm.begin_transaction()
+        self.tm.execute_operation("db1", lambda conn: None)
+        self.tm.execute_operation("db1", lambda conn: None)
+
+        assert list(self.tm.participants.keys()) == ['db1']
+        self.mock_db_manager.get_connection.assert_called_once_with('db1')
+        xa_id = self.tm.participants['db1'].xa_id
+        self.connections['db1'].cursor.return_value.execute.assert_any_call(f"XA START '{xa_id}'")
+
+    def test_read_only_participant_skips_phase_two(self):
+        """测试只读参与者投只读票并跳过第二阶段"""
+        @read_only_operation
+        def read_op(conn):
+            return 1
+
+        tm = self.tm
+        tm.begin_transaction()
+        tm.execute_operation("db1", lambda conn: None)
+        tm.execute_operation("db2", read_op)
+        tm.prepare()
+        tm.commit()
+
+        xa_id = tm.participants['db2'].xa_id
+        sql = [c.args[0] for c in self.connections['db2'].cursor.return_value.execute.call_args_list]
+        assert tm.participants['db2'].state == ParticipantState.READ_ONLY
+        assert f"XA COMMIT '{xa_id}' ONE PHASE" in sql
+        assert f"XA PREPARE '{xa_id}'" not in sql
+        assert tm.participants['db1'].state == ParticipantState.COMMITTED
+
+class TestCoordinatorLog:
+    """协调者决策日志测试类"""
+
+    def setup_method(self):
+        """测试前的设置"""
+        self.mock_db_manager = Mock()
+        self.mock_conn = Mock()
+        self.mock_db_manager.get_connection.return_value = self.mock_conn
+        self.log = CoordinatorLog(self.mock_db_manager, node_id='db2')
+
+    def teardown_method(self):
+        """测试后的清理"""
+        self.log.close()
+
+    def test_concurrent_decisions_are_group_committed(self):
+        """测试并发决策合并为少量组提交"""
+        # 第一次写入较慢，期间到达的决策合并到下一次提交
+        self.mock_conn.cursor.return_value.executemany.side_effect = lambda sql, rows: time.sleep(0.05)
+
+        threads = [threading.Thread(target=self.log.log_decision, args=(f"tx{i}", ['db1', 'db2']))
+                   for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert self.log.record_count == 20
+        assert self.log.flush_count < 10
+        assert self.mock_conn.commit.call_count == self.log.flush_count
+
+    def test_decision_failure_is_raised(self):
+        """测试决策写入失败时抛出异常"""
+        self.mock_conn.cursor.return_value.executemany.side_effect = Exception("disk full")
+
+        with pytest.raises(Exception) as exc_info:
+            self.log.log_decision("tx1", ['db1'])
+
+        assert "Failed to log decision" in str(exc_info.value)
+
+    def test_end_deletes_decision(self):
+        """测试事务完成后随组提交删除其决策，不再追加END记录"""
+        self.log.log_decision("tx1", ['db1', 'db2'])
+        self.log.log_end("tx1")
+        self.log.close()
+
+        cursor = self.mock_conn.cursor.return_value
+        assert cursor.executemany.call_count == 1
+        cursor.execute.assert_called_once_with("DELETE FROM transaction_logs WHERE transaction_id IN (%s)",
+                                               ("tx1",))
+
+    def test_purge_keeps_unresolved_decisions(self):
+        """测试清理旧决策时保留仍有悬挂分支的事务"""
+        cursor = self.mock_conn.cursor.return_value
+        cursor.rowcount = 3
+
+        assert self.log.purge_decisions(300, ['tx1', 'tx2']) == 3
+        sql, params = cursor.execute.call_args.args
+        assert "operation_type = 'DECISION'" in sql and "NOT IN (%s, %s)" in sql
+        assert params == (300, 'tx1', 'tx2')
+
+    def test_commit_logs_decision_before_xa_commit(self):
+        """测试两阶段提交在XA COMMIT之前持久化决策"""
+        connections = [Mock(), Mock()]
+        tm = EnhancedTransactionManager(connections, coordinator_log=Mock())
+        tm.begin_transaction()
+        tm.execute_operation("participant_1", lambda conn: None)
+        tm.execute_operation("participant_2", lambda conn: None)
+        tm.prepare()
+        tm.commit()
+
+        tm.coordinator_log.log_decision.assert_called_once_with(
+            tm.transaction_id, ['participant_1', 'participant_2'])
+        tm.coordinator_log.log_end.assert_called_once_with(tm.transaction_id)
+
+    def test_failed_branch_commit_keeps_decision(self):
+        """测试有分支提交失败时不删除决策，留给恢复流程"""
+        connections = [Mock(), Mock()]
+        tm = EnhancedTransactionManager(connections, coordinator_log=Mock())
+        tm.begin_transaction()
+        tm.execute_operation("participant_1", lambda conn: None)
+        tm.execute_operation("participant_2", lambda conn: None)
+        tm.prepare()
+        connections[1].cursor.return_value.execute.side_effect = Exception("connection lost")
+
+        assert tm.commit() is True
+        tm.coordinator_log.log_decision.assert_called_once()
+        tm.coordinator_log.log_end.assert_not_called()
+
+    def test_commit_aborts_when_decision_not_durable(self):
+        """测试决策无法持久化时回滚事务"""
+        connections = [Mock(), Mock()]
+        coordinator_log = Mock()
+        coordinator_log.log_decision.side_effect = Exception("log unavailable")
+        tm = EnhancedTransactionManager(connections, coordinator_log=coordinator_log)
+        tm.begin_transaction()
+        tm.execute_operation("participant_1", lambda conn: None)
+        tm.execute_operation("participant_2", lambda conn: None)
+        tm.prepare()
+
+        with pytest.raises(Exception):
+            tm.commit()
+
+        assert tm.state == TransactionState.ABORTED
+        for conn, participant in zip(connections, tm.participants.values()):
+            conn.cursor.return_value.execute.assert_any_call(f"XA ROLLBACK '{participant.xa_id}'")
+        assert tm.is_rolled_back() is True
+
+    def test_failed_decision_with_stuck_branch_is_not_rolled_back(self):
+        """测试决策写入失败且分支未能回滚时，事务结果不视为已回滚"""
+        connections = [Mock(), Mock()]
+        coordinator_log = Mock()
+        coordinator_log.log_decision.side_effect = Exception("log unavailable")
+        tm = EnhancedTransactionManager(connections, coordinator_log=coordinator_log)
+        tm.begin_transaction()
+        tm.execute_operation("participant_1", lambda conn: None)
+        tm.execute_operation("participant_2", lambda conn: None)
+        tm.prepare()
+        connections[1].cursor.return_value.execute.side_effect = Exception("connection lost")
+
+        with pytest.raises(Exception):
+            tm.commit()
+
+        assert tm.state == TransactionState.ABORTED
+        assert tm.is_rolled_back() is False
+
+    @staticmethod
+    def _transaction_id(started_ago: float) -> str:
+        """生成started_ago秒前开始的事务ID（uuid1）"""
+        ticks = int((time.time() - started_ago) * 1e7) + 0x01b21dd213814000
+        return str(uuid.UUID(fields=(ticks & 0xffffffff, (ticks >> 32) & 0xffff,
+                                     ((ticks >> 48) & 0x0fff) | 0x1000, 0x80, 0, 1)))
+
+    def _recover(self, xids, decisions, older_than=300):
+        """对db1上给定的悬挂分支执行恢复，decisions为 {事务ID: (决策, 写入秒数)}"""
+        cursor = Mock()
+        cursor.fetchall.return_value = [(1, len(xid), 0, xid.encode()) for xid in xids]
+        conn = Mock()
+        conn.cursor.return_value = cursor
+        db_manager = Mock()
+        db_manager.nodes = {'db1': Mock()}
+        db_manager.get_connection.return_value = conn
+        coordinator_log = Mock()
+        coordinator_log.get_decision_record.side_effect = decisions.get
+        coordinator_log.purge_decisions.return_value = 0
+        self.coordinator_log = coordinator_log
+        return recover_in_doubt_transactions(db_manager, coordinator_log, older_than=older_than), cursor
+
+    def test_recovery_commits_or_rolls_back_by_decision(self):
+        """测试恢复流程按决策提交或回滚悬挂分支"""
+        committed_tx = self._transaction_id(3600)
+        aborted_tx = self._transaction_id(3600)
+
+        summary, cursor = self._recover([f"{committed_tx}_db1", f"{aborted_tx}_db1", "foreign"],
+                                        {committed_tx: ('COMMIT', 3600)})
+
+        assert summary == {'committed': 1, 'rolled_back': 1, 'skipped': 0, 'failed': 0, 'purged': 0}
+        self.coordinator_log.purge_decisions.assert_called_once_with(300, set())
+        cursor.execute.assert_any_call(f"XA COMMIT '{committed_tx}_db1'")
+        cursor.execute.assert_any_call(f"XA ROLLBACK '{aborted_tx}_db1'")
+
+    def test_recovery_skips_live_branches(self):
+        """测试恢复跳过可能属于其他仍在运行的协调者的分支：事务开始不久或决策刚写入"""
+        running_tx = self._transaction_id(5)
+        committing_tx = self._transaction_id(3600)
+
+        summary, cursor = self._recover([f"{running_tx}_db1", f"{committing_tx}_db1"],
+                                        {committing_tx: ('COMMIT', 1)})
+
+        assert summary == {'committed': 0, 'rolled_back': 0, 'skipped': 2, 'failed': 0, 'purged': 0}
+        executed = [c.args[0] for c in cursor.execute.call_args_list]
+        assert executed == ["XA RECOVER"]
+        # 跳过的事务仍有悬挂分支，其决策不清理
+        self.coordinator_log.purge_decisions.assert_called_once_with(300, {running_tx, committing_tx})
+
+    def test_transaction_ids_carry_start_time(self):
+        """测试事务ID包含开始时间，恢复据此判断分支年龄"""
+        tm = EnhancedTransactionManager(db_manager=Mock())
+        assert 0 <= transaction_age(tm.transaction_id) < 5
+        assert transaction_age(str(uuid.uuid4())) is None
+
+class TestAsyncTransactionManager:
+    """异步事务管理器测试类"""
+
+    def setup_method(self):
+        """测试前的设置"""
+        self.executed = {'db1': [], 'db2': []}
+        self.delay = 0
+        self.hang_on = None
+
+        def make_connection(node_id):
+            async def execute(sql, params=None):
+                await asyncio.sleep(self.delay)
+                if self.hang_on == (node_id, sql.split(" '")[0]):
+                    await asyncio.sleep(10)
+                self.executed[node_id].append(sql)
+
+            cursor = Mock()
+            cursor.execute = AsyncMock(side_effect=execute)
+            cursor.close = AsyncMock()
+            conn = Mock()
+            conn.cursor = AsyncMock(return_value=cursor)
+            conn.close = AsyncMock()
+            conn.discard = AsyncMock()
+            return conn
+
+        self.connections = {node_id: make_connection(node_id) for node_id in self.executed}
+        self.db_manager = Mock()
+        self.db_manager.get_connection = AsyncMock(side_effect=lambda node_id: self.connections[node_id])
+
+    async def _write(self, conn):
+        cursor = await conn.cursor()
+        await cursor.execute("UPDATE accounts SET balance = balance")
+        await cursor.close()
+
+    def test_two_phase_commit(self):
+        """测试异步两阶段提交"""
+        async def run():
+            tm = AsyncTransactionManager(self.db_manager)
+            await tm.begin_transaction()
+            await tm.execute_operation('db1', self._write)
+            await tm.execute_operation('db2', self._write)
+            await tm.prepare()
+            await tm.commit()
+            await tm.cleanup()
+            return tm
+
+        tm = asyncio.run(run())
+
+        assert tm.state == TransactionState.COMMITTED
+        for node_id, participant in tm.participants.items():
+            assert participant.state == ParticipantState.COMMITTED
+            assert f"XA PREPARE '{participant.xa_id}'" in self.executed[node_id]
+            self.connections[node_id].close.assert_awaited_once()
+
+    def test_prepare_fans_out_concurrently(self):
+        """测试准备阶段并发下发"""
+        async def run():
+            tm = AsyncTransactionManager(self.db_manager)
+            await tm.begin_transaction()
+            await tm.execute_operation('db1', self._write)
+            await tm.execute_operation('db2', self._write)
+            self.delay = 0.1
+            start_time = time.time()
+            await tm.prepare()
+            return time.time() - start_time
+
+        # 每个参与者XA END + XA PREPARE共0.2秒，串行需要0.4秒
+        assert asyncio.run(run()) < 0.35
+
+    def test_prepare_timeout_discards_cancelled_connection(self):
+        """测试准备超时时被取消的参与者丢弃连接，不在其上回滚，其余参与者正常回滚"""
+        async def run():
+            tm = AsyncTransactionManager(self.db_manager)
+            tm.prepare_timeout = 0.1
+            await tm.begin_transaction()
+            await tm.execute_operation('db1', self._write)
+            await tm.execute_operation('db2', self._write)
+            self.hang_on = ('db1', 'XA PREPARE')
+            with pytest.raises(Exception, match="did not finish"):
+                await tm.prepare()
+            await tm.cleanup()
+            return tm
+
+        tm = asyncio.run(run())
+
+        assert tm.state == TransactionState.ABORTED
+        self.connections['db1'].discard.assert_awaited_once()
+        assert not any(sql.startswith("XA ROLLBACK") for sql in self.executed['db1'])
+        assert f"XA ROLLBACK '{tm.participants['db2'].xa_id}'" in self.executed['db2']
+        self.connections['db2'].discard.assert_not_awaited()
+
+    def test_single_writer_one_phase(self):
+        """测试只有一个写入者时使用一阶段提交"""
+        async def run():
+            tm = AsyncTransactionManager(self.db_manager)
+            await tm.begin_transaction()
+            await tm.execute_operation('db1', self._write)
+            await tm.prepare()
+            await tm.commit()
+            return tm
+
+        tm = asyncio.run(run())
+
+        assert tm.one_phase is True
+        assert list(tm.participants.keys()) == ['db1']
+        assert f"XA COMMIT '{tm.participants['db1'].xa_id}' ONE PHASE" in self.executed['db1']
+
 class TestDatabaseManager:
     """数据库管理器测试类"""
     
     def setup_method(self):
         """测试前的设置"""
         # 使用模拟配置
-        with patch('database_manager.DatabaseConfig') as mock_config:
-            mock_config.get_db1_config.return_value = {
+        with patch.object(DatabaseConfig, 'get_db1_config') as get_db1_config, \
+                patch.object(DatabaseConfig, 'get_db2_config') as get_db2_config:
+            get_db1_config.return_value = {
                 'host': 'localhost',
                 'port': 3306,
                 'user': 'test',
                 'password': 'test',
                 'database': 'test_db1'
             }
-            mock_config.get_db2_config.return_value = {
+            get_db2_config.return_value = {
                 'host': 'localhost',
                 'port': 3307,
                 'user': 'test',
@@ -175,7 +640,7 @@ class TestDatabaseManager:
                 'database': 'test_db2'
             }
             
-            with patch('database_manager.pooling.MySQLConnectionPool'):
+            with patch('database_manager.mysql.connector.connect'):
                 self.db_manager = DatabaseManager()
     
     def test_initialization(self):
@@ -184,21 +649,21 @@ class TestDatabaseManager:
         assert 'db2' in self.db_manager.nodes
         assert len(self.db_manager.nodes) == 2
     
-    @patch('database_manager.pooling.MySQLConnectionPool')
-    def test_get_connection(self, mock_pool):
+    @patch('database_manager.mysql.connector.connect')
+    def test_get_connection(self, mock_connect):
         """测试获取连接"""
         mock_connection = Mock()
-        mock_pool.return_value.get_connection.return_value = mock_connection
+        mock_connect.return_value = mock_connection
         
-        # 重新创建节点以使用模拟的连接池
+        # 重新创建节点以使用模拟的连接
         node = DatabaseNode('test', {'host': 'localhost', 'port': 3306, 'user': 'test', 'password': 'test', 'database': 'test'})
         
         conn = node.get_connection()
-        assert conn == mock_connection
+        assert conn._cnx == mock_connection
     
     def test_node_health_check(self):
         """测试节点健康检查"""
-        with patch('database_manager.pooling.MySQLConnectionPool'):
+        with patch('database_manager.mysql.connector.connect'):
             node = DatabaseNode('test', {'host': 'localhost', 'port': 3306, 'user': 'test', 'password': 'test', 'database': 'test'})
             
             # 模拟健康检查成功
@@ -211,6 +676,1061 @@ class TestDatabaseManager:
                 assert result is True
                 assert node.is_available is True
 
+class TestConnectionValidation:
+    """连接校验测试类"""
+
+    def setup_method(self):
+        """测试前的设置"""
+        self.raw_connection = Mock()
+        with patch('database_manager.mysql.connector.connect', return_value=self.raw_connection):
+            self.db_manager = DatabaseManager()
+        self.node = self.db_manager.nodes['db1']
+
+    def test_recently_used_connection_is_not_validated(self):
+        """测试最近使用过的连接不再校验"""
+        for _ in range(3):
+            self.db_manager.get_connection('db1').close()
+
+        assert self.raw_connection.ping.call_count == 0
+        assert self.node.validations_performed == 0
+        assert self.node.validations_skipped == 3
+        self.raw_connection.cursor.assert_not_called()
+
+    def test_idle_connection_is_validated(self):
+        """测试空闲超过阈值的连接借出前校验"""
+        for entry in self.node.pool._idle:
+            entry.last_used -= DatabaseConfig.CONNECTION_VALIDATION_IDLE_SECONDS + 1
+
+        self.db_manager.get_connection('db1')
+
+        assert self.raw_connection.ping.call_count == 1
+        assert self.node.validations_performed == 1
+
+    def test_execute_query_retries_on_stale_connection(self):
+        """测试查询遇到失效连接时透明重试"""
+        from mysql.connector import OperationalError
+        cursor = Mock()
+        cursor.execute.side_effect = [OperationalError("Lost connection to MySQL server"), None]
+        cursor.fetchall.return_value = [{'id': 1}]
+        self.raw_connection.cursor.return_value = cursor
+
+        with patch('database_manager.mysql.connector.connect', return_value=self.raw_connection) as connect:
+            result = self.db_manager.execute_query('db1', "SELECT id FROM accounts")
+
+        assert result == [{'id': 1}]
+        assert cursor.execute.call_count == 2
+        # 失效连接被丢弃并重新建立
+        connect.assert_called_once()
+        assert self.node.pool.get_stats()['closed'] == 1
+
+    def test_half_open_trial_pings_recent_connection(self):
+        """测试熔断半开时试探请求即使借到最近使用过的连接也先ping服务端"""
+        self.db_manager.get_connection('db1').close()
+        self.node.breaker.state = CircuitState.HALF_OPEN
+        self.raw_connection.ping.side_effect = OperationalError("server has gone away")
+
+        with patch('database_manager.mysql.connector.connect', return_value=self.raw_connection):
+            with pytest.raises(Exception):
+                self.db_manager.get_connection('db1')
+
+        assert self.raw_connection.ping.called
+        assert self.node.breaker.state == CircuitState.OPEN
+
+    def test_failing_queries_trip_breaker(self):
+        """测试能借出连接但查询因连接错误失败的节点同样触发熔断"""
+        cursor = Mock()
+        cursor.execute.side_effect = OperationalError("Lost connection to MySQL server during query")
+        self.raw_connection.cursor.return_value = cursor
+
+        with patch('database_manager.mysql.connector.connect', return_value=self.raw_connection):
+            for _ in range(DatabaseConfig.CIRCUIT_FAILURE_THRESHOLD):
+                with pytest.raises(Exception):
+                    self.db_manager.execute_query('db1', "SELECT id FROM accounts")
+
+        assert self.node.breaker.state == CircuitState.OPEN
+
+class TestConnectionPool:
+    """自管理连接池测试类"""
+
+    def setup_method(self):
+        """测试前的设置"""
+        self.patcher = patch('database_manager.mysql.connector.connect', side_effect=lambda **kw: Mock())
+        self.mock_connect = self.patcher.start()
+
+    def teardown_method(self):
+        """测试后的清理"""
+        self.patcher.stop()
+
+    def test_min_size_prefill_and_reuse(self):
+        """测试预建最小连接数并复用归还的连接"""
+        pool = ConnectionPool('test', {}, min_size=2, max_size=4)
+        pool.fill_min()
+        assert pool.get_stats()['size'] == 2
+
+        conn = pool.get_connection()
+        raw = conn._cnx
+        conn.close()
+        assert pool.get_connection()._cnx is raw
+        assert self.mock_connect.call_count == 2
+
+    def test_checkout_waits_for_returned_connection(self):
+        """测试连接用尽时排队等待而不是立即失败"""
+        pool = ConnectionPool('test', {}, min_size=0, max_size=1)
+        conn = pool.get_connection()
+        threading.Timer(0.1, conn.close).start()
+
+        second = pool.get_connection(timeout=2)
+
+        assert second._cnx is conn._cnx
+        stats = pool.get_stats()
+        assert stats['waits'] == 1
+        assert stats['in_use'] == 1
+        assert stats['max_checkout_ms'] >= 50
+
+    def test_checkout_timeout(self):
+        """测试等待超时后抛出PoolError"""
+        pool = ConnectionPool('test', {}, min_size=0, max_size=1)
+        pool.get_connection()
+
+        with pytest.raises(PoolError):
+            pool.get_connection(timeout=0.05)
+
+        assert pool.get_stats()['timeouts'] == 1
+
+    def test_wait_queue_is_bounded(self):
+        """测试排队数达到上限时立即失败"""
+        pool = ConnectionPool('test', {}, min_size=0, max_size=1)
+        pool.max_waiters = 0
+        pool.get_connection()
+
+        start_time = time.time()
+        with pytest.raises(PoolError):
+            pool.get_connection(timeout=5)
+        assert time.time() - start_time < 1
+
+    def test_idle_and_expired_connections_are_evicted(self):
+        """测试回收空闲超时和超过存活时间的连接"""
+        pool = ConnectionPool('test', {}, min_size=1, max_size=4)
+        pool.fill_min()
+        conns = [pool.get_connection() for _ in range(3)]
+        for conn in conns:
+            conn.close()
+        assert pool.get_stats()['idle'] == 3
+
+        for entry in pool._idle:
+            entry.last_used -= pool.idle_timeout + 1
+        pool.get_connection().close()
+
+        # 保留min_size个连接
+        stats = pool.get_stats()
+        assert stats['size'] == 1
+        assert stats['closed'] == 2
+
+        pool._idle[0].created_at -= pool.max_lifetime + 1
+        pool.get_connection()
+        assert pool.get_stats()['closed'] == 3
+
+    def test_broken_connection_is_discarded_on_reset_failure(self):
+        """测试归还时重置失败的连接被丢弃"""
+        pool = ConnectionPool('test', {}, min_size=0, max_size=2)
+        conn = pool.get_connection()
+        conn._cnx.cmd_reset_connection.side_effect = Exception("XA transaction still active")
+        conn.close()
+
+        stats = pool.get_stats()
+        assert stats['size'] == 0
+        assert stats['closed'] == 1
+
+class TestPreparedStatements:
+    """预编译语句缓存测试类"""
+
+    def setup_method(self):
+        """测试前的设置"""
+        self.patcher = patch('database_manager.mysql.connector.connect', side_effect=lambda **kw: Mock())
+        self.patcher.start()
+        self.config_patcher = patch.object(DatabaseConfig, 'PREPARED_STATEMENTS', True)
+        self.config_patcher.start()
+        self.pool = ConnectionPool('test', {}, min_size=0, max_size=1)
+        self.pool.reset_session = False
+
+    def teardown_method(self):
+        """测试后的清理"""
+        self.config_patcher.stop()
+        self.patcher.stop()
+
+    def test_statements_survive_checkouts(self):
+        """测试同一物理连接上的语句跨借出复用，每条SQL只预编译一次"""
+        for account_id in (1, 2):
+            conn = self.pool.get_connection()
+            execute_statement(conn, "UPDATE accounts SET balance = balance + %s WHERE id = %s", (1, account_id))
+            execute_statement(conn, "SELECT 1 FROM accounts WHERE id = %s", (account_id,))
+            conn.close()
+
+        conn = self.pool.get_connection()
+        assert conn.statements.prepares == 2
+        assert conn.statements.executions == 4
+        assert conn._cnx.cursor.call_args_list == [call(prepared=True)] * 2
+        # 不重置会话的连接池归还时只回滚
+        conn._cnx.rollback.assert_called()
+        conn._cnx.cmd_reset_connection.assert_not_called()
+
+    def test_session_reset_on_every_release(self):
+        """测试重置会话的连接池每次归还都重置会话，会话状态不会留给下一个借用者，热点语句使用普通游标"""
+        self.pool.reset_session = True
+        for account_id in (1, 2):
+            conn = self.pool.get_connection()
+            execute_statement(conn, "UPDATE accounts SET balance = balance + %s WHERE id = %s", (1, account_id))
+            conn.close()
+
+        conn = self.pool.get_connection()
+        assert conn._cnx.cmd_reset_connection.call_count == 2
+        assert len(conn.statements) == 0
+        assert call(prepared=True) not in conn._cnx.cursor.call_args_list
+
+    def test_session_reset_clears_registry(self):
+        """测试会话重置后清空语句缓存（服务端语句已随会话释放）"""
+        conn = self.pool.get_connection()
+        execute_statement(conn, "SELECT 1", ())
+        assert len(conn.statements) == 1
+        self.pool.reset_session = True
+        conn.close()
+
+        conn = self.pool.get_connection()
+        conn._cnx.cmd_reset_connection.assert_called_once()
+        assert len(conn.statements) == 0
+
+    def test_plain_connection_uses_text_cursor(self):
+        """测试非池化连接使用普通游标并关闭"""
+        conn = Mock()
+        conn.cursor.return_value.rowcount = 1
+
+        rows, updated, _ = execute_statement(conn, "UPDATE accounts SET balance = 0 WHERE id = %s", (1,))
+
+        assert updated == 1
+        conn.cursor.assert_called_once_with()
+        conn.cursor.return_value.close.assert_called_once()
+
+@compensation
+def _undo_step(conn, name):
+    """测试用补偿操作"""
+    conn.undone.append(name)
+
+class TestSagaExecutor:
+    """Saga执行器测试类"""
+
+    def setup_method(self):
+        """测试前准备：每个节点一个模拟连接，记录执行的语句"""
+        self.connections = {}
+        self.marker_rows = 1
+
+        def get_connection(node_id):
+            if node_id not in self.connections:
+                conn = Mock()
+                conn.undone = []
+                conn.statements = []
+                conn.markers = set()
+                cursor = Mock()
+
+                def execute(sql, params=None, conn=conn, cursor=cursor):
+                    conn.statements.append(sql.strip())
+                    cursor.rowcount = 1
+                    if sql.startswith("INSERT INTO saga_applied"):
+                        conn.markers.add(params)
+                    elif sql.startswith("DELETE FROM saga_applied"):
+                        cursor.rowcount = int(params in conn.markers and bool(self.marker_rows))
+                        conn.markers.discard(params)
+                cursor.execute.side_effect = execute
+                conn.cursor.return_value = cursor
+                self.connections[node_id] = conn
+            return self.connections[node_id]
+
+        self.db_manager = Mock()
+        self.db_manager.nodes = ['db1', 'db2']
+        self.db_manager.get_connection.side_effect = get_connection
+        self.db_manager.execute_query.return_value = []
+
+    def test_steps_commit_locally_and_log_compensations(self):
+        """测试每个步骤单独提交并写入生效标记，补偿操作先于步骤持久化"""
+        saga = SagaExecutor('test', db_manager=self.db_manager, log_node='db2')
+        assert saga.execute_step('db1', lambda conn, value: value, 7,
+                                 compensation=_undo_step, compensation_args=('first',)) == 7
+        saga.execute_step('db2', lambda conn: 'done')
+        saga.complete()
+
+        db1, db2 = self.connections['db1'], self.connections['db2']
+        assert db1.statements == ["INSERT INTO saga_applied (saga_id, step_no) VALUES (%s, %s)"]
+        assert db1.commit.call_count == 1
+        assert db2.statements[0].startswith("INSERT INTO sagas")
+        assert sum(sql.startswith("INSERT INTO saga_compensations") for sql in db2.statements) == 2
+        assert db2.statements[-1].startswith("UPDATE sagas SET status")
+        assert saga.state == SagaState.COMPLETED
+        self.db_manager.record_write.assert_any_call('db1')
+
+    def test_failure_compensates_in_reverse(self):
+        """测试步骤失败时按相反顺序补偿已生效的步骤"""
+        saga = SagaExecutor('test', db_manager=self.db_manager, log_node='db2')
+        saga.execute_step('db1', lambda conn: True, compensation=_undo_step, compensation_args=('first',))
+        saga.execute_step('db2', lambda conn: True, compensation=_undo_step, compensation_args=('second',))
+        with pytest.raises(Exception):
+            saga.execute_step('db1', Mock(side_effect=Exception("boom")))
+
+        assert saga.compensate() == SagaState.COMPENSATED
+        assert self.connections['db1'].undone == ['first']
+        assert self.connections['db2'].undone == ['second']
+        assert self.connections['db1'].rollback.called
+
+    def test_compensation_skipped_without_marker(self):
+        """测试生效标记不存在（未生效或已补偿）时不重复补偿"""
+        saga = SagaExecutor('test', db_manager=self.db_manager, log_node='db2')
+        saga.execute_step('db1', lambda conn: True, compensation=_undo_step, compensation_args=('first',))
+        self.marker_rows = 0
+
+        assert saga.compensate() == SagaState.COMPENSATED
+        assert self.connections['db1'].undone == []
+
+    def test_false_result_rolls_back_step(self):
+        """测试操作返回False时回滚本地事务且不写生效标记"""
+        saga = SagaExecutor('test', db_manager=self.db_manager, log_node='db2')
+        assert saga.execute_step('db1', lambda conn: False, compensation=_undo_step,
+                                 compensation_args=('first',)) is False
+        assert self.connections['db1'].statements == []
+        self.connections['db1'].rollback.assert_called_once()
+
+    def test_unregistered_compensation_rejected(self):
+        """测试补偿操作必须注册"""
+        saga = SagaExecutor('test', db_manager=self.db_manager, log_node='db2')
+        with pytest.raises(ValueError):
+            saga.execute_step('db1', lambda conn: True, compensation=lambda conn: None)
+
+    def test_recovery_completes_or_compensates(self):
+        """测试恢复时关键步骤已生效的saga补记完成，其余saga补偿"""
+        rows = [
+            {'saga_id': 'a', 'step_no': 1, 'node_id': 'db1', 'compensation': '_undo_step', 'args': '["a1"]'},
+            {'saga_id': 'a', 'step_no': 2, 'node_id': 'db2', 'compensation': None, 'args': '[]'},
+            {'saga_id': 'b', 'step_no': 1, 'node_id': 'db1', 'compensation': '_undo_step', 'args': '["b1"]'},
+            {'saga_id': 'b', 'step_no': 2, 'node_id': 'db2', 'compensation': None, 'args': '[]'},
+        ]
+        self.db_manager.execute_query.side_effect = lambda node_id, query, params=None, **kwargs: (
+            rows if "FROM sagas" in query else ([{'1': 1}] if params == ('a', 2) else []))
+
+        self.db_manager.get_connection('db1').markers.update({('a', 1), ('b', 1)})
+
+        summary = recover_sagas(self.db_manager, log_node='db2', older_than=60)
+
+        assert summary == {'completed': 1, 'compensated': 1, 'failed': 0}
+        assert self.connections['db1'].undone == ['b1']
+
+    def test_recovery_purges_only_finished_saga_markers(self):
+        """测试恢复只清理已完成或已补偿saga的生效标记，补偿失败、补偿中和无记录的saga保留标记"""
+        statuses = {'done': 'COMPLETED', 'undone': 'COMPENSATED', 'failed': 'FAILED', 'busy': 'COMPENSATING'}
+
+        def execute_query(node_id, query, params=None, **kwargs):
+            if "FROM saga_applied" in query:
+                return [{'saga_id': saga_id} for saga_id in ('done', 'undone', 'failed', 'busy', 'orphan')] \
+                    if node_id == 'db1' else []
+            if "saga_id IN" in query:
+                return [{'saga_id': saga_id} for saga_id in params
+                        if statuses.get(saga_id) in ('COMPLETED', 'COMPENSATED')]
+            return []
+        self.db_manager.execute_query.side_effect = execute_query
+
+        recover_sagas(self.db_manager, log_node='db2', older_than=60)
+
+        db1 = self.connections['db1']
+        deletes = [call.args for call in db1.cursor.return_value.execute.call_args_list
+                   if call.args[0].startswith("DELETE FROM saga_applied")]
+        assert deletes == [("DELETE FROM saga_applied WHERE saga_id IN (%s, %s)", ('done', 'undone'))]
+        assert 'db2' not in self.connections
+
+    def test_saga_transfer_compensates_debit(self):
+        """测试saga转账入账失败时只补偿已提交的扣款"""
+        service = BankingService()
+        service.db_manager = self.db_manager
+        credit_rows = iter([1, 0])
+        db1 = self.db_manager.get_connection('db1')
+        cursor = db1.cursor.return_value
+        tracked_execute = cursor.execute.side_effect
+
+        def execute(sql, params=None):
+            tracked_execute(sql, params)
+            if sql.startswith("UPDATE accounts"):
+                cursor.rowcount = next(credit_rows, 1)
+        cursor.execute.side_effect = execute
+
+        assert service.transfer_money(1001, 9999, 100, mode='saga') is False
+
+        updates = [sql for sql in db1.statements if sql.startswith(("UPDATE", "DELETE"))]
+        assert updates == ["UPDATE accounts SET balance = balance - %s WHERE id = %s AND balance >= %s",
+                           "UPDATE accounts SET balance = balance + %s WHERE id = %s",
+                           "DELETE FROM saga_applied WHERE saga_id = %s AND step_no = %s",
+                           "DELETE FROM saga_applied WHERE saga_id = %s AND step_no = %s",
+                           "UPDATE accounts SET balance = balance + %s WHERE id = %s"]
+        assert cursor.execute.call_args.args[1] == (Decimal('100'), 1001)
+        assert not any(sql.startswith("XA") for sql in db1.statements)
+
+class TestOutbox:
+    """事务发件箱测试类"""
+
+    def _dispatcher(self, node_rows, emit):
+        """每个节点返回给定的事件行 (id, event_type, payload, expired)"""
+        self.connections = {}
+        for node_id, rows in node_rows.items():
+            conn = Mock()
+            conn.cursor.return_value.fetchall.return_value = rows
+            self.connections[node_id] = conn
+        db_manager = Mock()
+        db_manager.nodes = list(node_rows)
+        db_manager.get_connection.side_effect = lambda node_id: self.connections[node_id]
+        return OutboxDispatcher(emit, db_manager, interval_ms=10, batch_size=100, max_age=300)
+
+    def test_events_coalesced_per_type(self):
+        """测试各节点的同类事件合并为一次广播，广播后删除"""
+        emitted = []
+        dispatcher = self._dispatcher({
+            'db1': [(1, 'account_created', '{"account_id": 1}', 0)],
+            'db2': [(7, 'transfer_completed', '{"amount": 1.5}', 0),
+                    (8, 'transfer_completed', '{"amount": 2.5}', 0)],
+        }, lambda event_type, payload: emitted.append((event_type, payload)))
+
+        assert dispatcher.dispatch_once() == 3
+
+        assert emitted == [('account_created', {'count': 1, 'events': [{'account_id': 1}]}),
+                           ('transfer_completed', {'count': 2, 'events': [{'amount': 1.5}, {'amount': 2.5}]})]
+        db2_cursor = self.connections['db2'].cursor.return_value
+        assert db2_cursor.execute.call_args.args == ("DELETE FROM event_outbox WHERE id IN (%s, %s)", (7, 8))
+        assert all(conn.commit.called and conn.close.called for conn in self.connections.values())
+        assert dispatcher.get_stats()['broadcasts'] == 2
+
+    def test_failed_broadcast_keeps_events(self):
+        """测试广播失败时回滚，事件留待下次分发"""
+        dispatcher = self._dispatcher({'db2': [(7, 'order_processed', '{}', 0)]},
+                                      Mock(side_effect=Exception("socket down")))
+
+        with pytest.raises(Exception):
+            dispatcher.dispatch_once()
+
+        conn = self.connections['db2']
+        conn.rollback.assert_called_once()
+        conn.commit.assert_not_called()
+        assert not any(c.args[0].startswith("DELETE") for c in conn.cursor.return_value.execute.call_args_list)
+
+    def test_expired_events_dropped(self):
+        """测试过期事件直接删除，不再广播"""
+        emit = Mock()
+        dispatcher = self._dispatcher({'db2': [(3, 'order_processed', '{}', 1)]}, emit)
+
+        assert dispatcher.dispatch_once() == 1
+        emit.assert_not_called()
+        assert dispatcher.expired_count == 1
+
+    def test_order_event_written_in_transaction(self):
+        """测试订单事件与订单在同一XA分支中写入发件箱"""
+        service = InventoryService()
+        service.db_manager = MagicMock()
+        service.publish_events = True
+        db1_cursor, db2_cursor = Mock(), Mock()
+        db1_cursor.rowcount = 1
+        connections = {'db1': Mock(), 'db2': Mock()}
+        connections['db1'].cursor.return_value = db1_cursor
+        connections['db2'].cursor.return_value = db2_cursor
+        service.db_manager.get_connection.side_effect = lambda node_id: connections[node_id]
+
+        with patch('distributed_app.get_coordinator_log'):
+            assert service.process_order(101, 2, 2001) is True
+
+        sql, rows = db2_cursor.executemany.call_args.args
+        assert sql.startswith("INSERT INTO event_outbox")
+        assert rows[0][0] == 'order_processed'
+        assert json.loads(rows[0][1])['product_id'] == 101
+        executed = [c.args[0] for c in db2_cursor.execute.call_args_list]
+        assert executed[-1].startswith("XA COMMIT")
+        connections['db2'].commit.assert_not_called()
+
+class TestChangeFeed:
+    """页面变更推送测试类"""
+
+    def _feed(self, source):
+        """单主题的推送器，记录推送的差异"""
+        self.emitted = []
+        return ChangeFeed(lambda event, data, room: self.emitted.append((event, data, room)),
+                          {'accounts': source}, interval=60)
+
+    def test_diff_snapshots(self):
+        """测试快照差异只包含变化和删除的键"""
+        old = {'1': {'balance': 10.0}, '2': {'balance': 20.0}, '3': {'balance': 30.0}}
+        new = {'1': {'balance': 10.0}, '2': {'balance': 25.0}, '4': {'balance': 40.0}}
+
+        assert diff_snapshots(old, new) == {'upserts': {'2': {'balance': 25.0}, '4': {'balance': 40.0}},
+                                            'removed': ['3']}
+        assert diff_snapshots(new, dict(new)) is None
+
+    def test_snapshot_computed_once_for_all_subscribers(self):
+        """测试多个订阅者共享一次快照计算，刷新时只向房间推送一次差异"""
+        balances = {'1': 10.0}
+        source = Mock(side_effect=lambda: dict(balances))
+        feed = self._feed(source)
+
+        snapshots = [feed.subscribe(f"sid{i}", 'accounts') for i in range(20)]
+        assert source.call_count == 1
+        assert all(snapshot == {'topic': 'accounts', 'version': 0, 'data': {'1': 10.0}}
+                   for snapshot in snapshots)
+
+        balances['1'] = 15.0
+        assert feed.refresh_subscribed() == 1
+        assert source.call_count == 2
+        assert self.emitted == [('feed_delta', {'topic': 'accounts', 'version': 1,
+                                                'upserts': {'1': 15.0}, 'removed': []}, feed.room('accounts'))]
+
+        # 没有变化时不推送
+        feed.refresh_subscribed()
+        assert len(self.emitted) == 1
+
+    def test_unsubscribed_topics_not_computed(self):
+        """测试没有订阅者的主题不计算快照"""
+        source = Mock(return_value={'1': 10.0})
+        feed = self._feed(source)
+
+        assert feed.refresh_subscribed() == 0
+        feed.subscribe('sid1', 'accounts')
+        feed.unsubscribe('sid1')
+        assert feed.refresh_subscribed() == 0
+        assert source.call_count == 1
+        assert feed.get_stats()['subscribers'] == {'accounts': 0}
+
+        with pytest.raises(ValueError):
+            feed.subscribe('sid1', 'orders')
+
+    def test_notify_refreshes_before_interval(self):
+        """测试数据变化通知唤醒推送线程，不等待整个间隔"""
+        balances = {'1': 10.0}
+        feed = self._feed(lambda: dict(balances))
+        feed.subscribe('sid1', 'accounts')
+        feed.start()
+        try:
+            balances['1'] = 5.0
+            feed.notify('accounts')
+            deadline = time.time() + 2
+            while not self.emitted and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            feed.stop()
+        assert self.emitted[0][1]['upserts'] == {'1': 5.0}
+
+class TestWorkerProcesses:
+    """多进程部署测试类"""
+
+    def test_feed_rooms_scoped_per_process(self):
+        """测试推送房间带进程标识，经消息队列广播时只投递给本进程的订阅者"""
+        feed = ChangeFeed(Mock(), {'accounts': dict}, interval=60)
+        assert feed.room('accounts').startswith('feed:accounts:')
+        assert feed.room('accounts').endswith(f":{os.getpid()}")
+
+    @pytest.mark.skipif(not hasattr(os, 'fork'), reason="requires fork")
+    def test_singletons_reset_after_fork(self):
+        """测试fork出的worker不继承父进程的数据库管理器、协调者日志和分片映射"""
+        import database_manager
+        import coordinator_log
+        import shard_map
+        saved = (database_manager.db_manager, coordinator_log.coordinator_log, shard_map.shard_map)
+        database_manager.db_manager = Mock()
+        coordinator_log.coordinator_log = Mock()
+        shard_map.shard_map = Mock()
+        try:
+            pid = os.fork()
+            if pid == 0:
+                inherited = (database_manager.db_manager, coordinator_log.coordinator_log, shard_map.shard_map)
+                os._exit(0 if inherited == (None, None, None) else 1)
+            _, status = os.waitpid(pid, 0)
+            assert os.WEXITSTATUS(status) == 0
+            # 父进程中的实例不受影响
+            assert database_manager.db_manager is not None
+        finally:
+            database_manager.db_manager, coordinator_log.coordinator_log, shard_map.shard_map = saved
+
+class TestCircuitBreaker:
+    """节点熔断测试类"""
+
+    def test_opens_after_consecutive_failures(self):
+        """测试连续失败达到阈值后打开并快速失败"""
+        breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=60)
+        for _ in range(2):
+            breaker.record_failure()
+        assert breaker.state == CircuitState.CLOSED
+        assert breaker.allow_request() is True
+
+        breaker.record_failure()
+        assert breaker.state == CircuitState.OPEN
+        assert breaker.allow_request() is False
+        assert breaker.rejected == 1
+
+    def test_half_open_trial_closes_or_reopens(self):
+        """测试冷却后半开放行试探请求，成功关闭、失败重新打开"""
+        breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0.05, half_open_max_calls=1)
+        breaker.record_failure()
+        time.sleep(0.06)
+
+        assert breaker.allow_request() is True
+        assert breaker.state == CircuitState.HALF_OPEN
+        assert breaker.allow_request() is False
+
+        breaker.record_failure()
+        assert breaker.state == CircuitState.OPEN
+
+        time.sleep(0.06)
+        assert breaker.allow_request() is True
+        breaker.record_success()
+        assert breaker.state == CircuitState.CLOSED
+
+    def test_node_down_fails_fast_without_recreating_pool(self):
+        """测试节点故障时不重建连接池、不休眠，熔断后快速失败"""
+        from mysql.connector import InterfaceError
+        with patch('database_manager.mysql.connector.connect', side_effect=InterfaceError("refused")):
+            node = DatabaseNode('test', {'host': 'localhost', 'port': 3306, 'user': 'test',
+                                         'password': 'test', 'database': 'test'})
+            db_manager = DatabaseManager.__new__(DatabaseManager)
+            db_manager.nodes = {'test': node}
+            pool = node.pool
+
+            start_time = time.time()
+            for _ in range(DatabaseConfig.CIRCUIT_FAILURE_THRESHOLD + 3):
+                with pytest.raises(Exception):
+                    db_manager.get_connection('test')
+
+        assert time.time() - start_time < 1
+        assert node.pool is pool
+        assert node.breaker.state == CircuitState.OPEN
+        assert node.breaker.rejected >= 3
+        assert node.is_available is False
+
+class TestHealthMonitor:
+    """后台健康检查测试类"""
+
+    def _make_node(self, node_id, delay=0.0, ok=True):
+        """创建探测耗时可控的节点"""
+        with patch('database_manager.mysql.connector.connect'):
+            node = DatabaseNode(node_id, {'host': 'localhost', 'port': 3306, 'user': 'test',
+                                          'password': 'test', 'database': node_id})
+
+        def execute(sql):
+            time.sleep(delay)
+            if not ok:
+                raise Exception("node down")
+
+        conn = Mock()
+        conn.cursor.return_value.execute.side_effect = execute
+        node.get_connection = Mock(return_value=conn)
+        return node
+
+    def test_round_probes_nodes_concurrently_with_timeout(self):
+        """测试并发探测且挂起的节点按超时记为不可用"""
+        nodes = {'fast': self._make_node('fast', 0.01), 'hung': self._make_node('hung', 1.0)}
+        monitor = HealthMonitor(nodes, interval=60, timeout=0.2)
+
+        start_time = time.time()
+        monitor.run_round()
+
+        assert time.time() - start_time < 0.5
+        assert nodes['fast'].is_available is True
+        assert nodes['hung'].is_available is False
+        assert "timed out" in nodes['hung'].health_history[-1]['error']
+
+        # 上一次探测未返回时本轮跳过该节点
+        monitor.run_round()
+        assert nodes['hung'].get_connection.call_count == 1
+
+    def test_readers_use_cached_state(self):
+        """测试状态读取不触发同步探测"""
+        db_manager = DatabaseManager.__new__(DatabaseManager)
+        db_manager.nodes = {'db1': self._make_node('db1')}
+        db_manager.replicas = {}
+        db_manager.health_monitor = HealthMonitor(db_manager.nodes, interval=60, timeout=1)
+
+        db_manager.get_node_status()
+        db_manager.get_available_nodes()
+        db_manager.get_node_status()
+
+        assert db_manager.nodes['db1'].get_connection.call_count == 1
+
+    def test_round_results_shared_with_other_process(self):
+        """测试采用其他进程广播的探测结果后本进程在一个间隔内不再自行探测"""
+        leader = HealthMonitor({'db1': self._make_node('db1', ok=False)}, interval=60, timeout=1)
+        leader.on_round = Mock()
+        leader.run_round()
+        results = json.loads(json.dumps(leader.on_round.call_args.args[0]))
+
+        follower_node = self._make_node('db1')
+        follower = HealthMonitor({'db1': follower_node}, interval=60, timeout=1)
+        follower.apply_round(results)
+        follower.ensure_fresh()
+
+        assert follower_node.is_available is False
+        assert follower_node.health_history[-1]['error'] == "node down"
+        follower_node.get_connection.assert_not_called()
+
+    def test_latency_percentiles(self):
+        """测试探测延迟分位数"""
+        node = self._make_node('db1')
+        for latency_ms in range(1, 100):
+            node.record_probe(True, latency_ms / 1000)
+        node.record_probe(False, 2.0, "timeout")
+
+        stats = node.get_health_stats()
+        assert stats['p50_ms'] == 50
+        assert stats['p95_ms'] == 95
+        assert stats['p99_ms'] == 99
+        assert stats['probes'] == 100
+        assert stats['history'][-1]['ok'] is False
+
+class TestReadReplicas:
+    """只读副本与读写分离测试类"""
+
+    def setup_method(self):
+        """测试前准备：db1配置两个副本，记录每次查询实际使用的节点"""
+        with patch.dict(os.environ, {'DB1_REPLICAS': 'replica-a:3307,replica-b:3308'}), \
+             patch('database_manager.mysql.connector.connect', side_effect=lambda **kw: Mock()):
+            self.db_manager = DatabaseManager()
+        for replica in self.db_manager.replicas['db1']:
+            replica.lag_seconds = 0.0
+
+        self.used = []
+
+        def execute_once(node, query, params=None):
+            self.used.append(node.node_id)
+            return [{'node': node.node_id}]
+
+        self.db_manager._execute_query_once = execute_once
+
+    def test_replicas_loaded_from_config(self):
+        """测试从<NODE>_REPLICAS读取副本配置"""
+        replicas = self.db_manager.replicas['db1']
+        assert [r.node_id for r in replicas] == ['db1-replica1', 'db1-replica2']
+        assert (replicas[1].config['host'], replicas[1].config['port']) == ('replica-b', 3308)
+        assert replicas[0].config['database'] == self.db_manager.nodes['db1'].config['database']
+        assert self.db_manager.replicas['db2'] == []
+        assert len(self.db_manager.get_node_status()['db1']['replicas']) == 2
+
+    def test_round_robin_and_least_loaded(self):
+        """测试轮询和最少进行中查询两种选择策略"""
+        with patch.object(DatabaseConfig, 'REPLICA_SELECTION', 'round_robin'):
+            for _ in range(4):
+                self.db_manager.execute_query('db1', "SELECT 1")
+        assert self.used == ['db1-replica1', 'db1-replica2'] * 2
+
+        self.db_manager.replicas['db1'][0].active_queries = 3
+        with patch.object(DatabaseConfig, 'REPLICA_SELECTION', 'least_loaded'):
+            assert self.db_manager.select_replica('db1').node_id == 'db1-replica2'
+
+    def test_lagging_replica_skipped(self):
+        """测试延迟超过阈值或未知的副本不参与读取"""
+        replicas = self.db_manager.replicas['db1']
+        replicas[0].lag_seconds = DatabaseConfig.REPLICA_MAX_LAG_SECONDS + 1
+        replicas[1].lag_seconds = None
+
+        self.db_manager.execute_query('db1', "SELECT 1")
+        assert self.used == ['db1']
+
+    def test_writes_and_locking_reads_go_to_primary(self):
+        """测试写语句、加锁读取和强制主节点的查询不走副本"""
+        self.db_manager.execute_query('db1', "UPDATE accounts SET balance = 0")
+        self.db_manager.execute_query('db1', "SELECT * FROM accounts FOR UPDATE")
+        self.db_manager.execute_query('db1', "SELECT 1", primary=True)
+        self.db_manager.execute_query('db2', "SELECT 1")
+        assert self.used == ['db1', 'db1', 'db1', 'db2']
+
+    def test_cache_misses_filled_from_primary(self):
+        """测试缓存未命中时读主节点，失效后不会缓存落后副本的结果"""
+        self.db_manager.query_cache = QueryCache(max_entries=10, ttl=60)
+        for _ in range(2):
+            self.db_manager.execute_query('db1', "SELECT * FROM accounts", cache_tables=('accounts',))
+        self.db_manager.invalidate_cache('db1', 'accounts')
+        rows = self.db_manager.execute_query('db1', "SELECT * FROM accounts", cache_tables=('accounts',))
+
+        assert self.used == ['db1', 'db1']
+        assert rows == [{'node': 'db1'}]
+
+    def test_read_your_writes(self):
+        """测试会话写入节点后窗口内的读取走主节点"""
+        session = ReadSession()
+        self.db_manager.bind_session(session)
+        try:
+            self.db_manager.execute_query('db1', "SELECT 1")
+            conn = self.db_manager.get_connection('db1')
+            conn.commit()
+            conn.close()
+            self.db_manager.execute_query('db1', "SELECT 1")
+        finally:
+            self.db_manager.bind_session(None)
+
+        assert 'db1' in session.writes
+        assert self.used == ['db1-replica1', 'db1']
+
+        # 窗口过后恢复读副本
+        session.writes['db1'] -= DatabaseConfig.READ_YOUR_WRITES_WINDOW + 1
+        self.db_manager.bind_session(session)
+        try:
+            self.db_manager.execute_query('db1', "SELECT 1")
+        finally:
+            self.db_manager.bind_session(None)
+        assert self.used[-1].startswith('db1-replica')
+
+    def test_replica_failure_falls_back_to_primary(self):
+        """测试副本查询失败时回退到主节点"""
+        def execute_once(node, query, params=None):
+            self.used.append(node.node_id)
+            if node.node_id != 'db1':
+                raise Exception("replica down")
+            return [{'node': node.node_id}]
+
+        self.db_manager._execute_query_once = execute_once
+        result = self.db_manager.execute_query('db1', "SELECT 1")
+
+        assert result == [{'node': 'db1'}]
+        assert self.used == ['db1-replica1', 'db1']
+        assert all(r.active_queries == 0 for r in self.db_manager.replicas['db1'])
+
+class TestQueryCache:
+    """查询结果缓存测试类"""
+
+    def setup_method(self):
+        """测试前准备：记录实际执行到数据库的查询"""
+        with patch('database_manager.mysql.connector.connect', side_effect=lambda **kw: Mock()):
+            self.db_manager = DatabaseManager()
+        self.db_manager.query_cache = QueryCache(max_entries=10, ttl=60)
+
+        self.executed = []
+
+        def execute_once(node, query, params=None):
+            self.executed.append((node.node_id, query))
+            return [{'id': 1, 'balance': Decimal('100.00')}]
+
+        self.db_manager._execute_query_once = execute_once
+
+    def test_lru_and_ttl(self):
+        """测试按条目数淘汰最久未用的结果并按TTL过期"""
+        cache = QueryCache(max_entries=2, ttl=60)
+        for name in ('a', 'b'):
+            cache.put((name,), [{'v': name}], (('db1', 't'),), (0,))
+        assert cache.get(('a',)) == [{'v': 'a'}]
+        cache.put(('c',), [{'v': 'c'}], (('db1', 't'),), (0,))
+
+        assert cache.get(('b',)) is None
+        assert cache.get(('a',)) is not None
+        assert cache.evictions == 1
+
+        expired = QueryCache(max_entries=2, ttl=0)
+        expired.put(('a',), [], (('db1', 't'),), (0,))
+        assert expired.get(('a',)) is None
+
+    def test_whitelisted_query_cached_until_invalidated(self):
+        """测试白名单查询命中缓存，相关表写入后失效"""
+        for _ in range(3):
+            self.db_manager.execute_query('db1', "SELECT * FROM accounts", cache_tables=('accounts',))
+        self.db_manager.execute_query('db1', "SELECT * FROM accounts")
+        assert len(self.executed) == 2
+
+        # 其他节点或其他表的写入不影响该结果
+        self.db_manager.invalidate_cache('db2', 'accounts')
+        self.db_manager.invalidate_cache('db1', 'inventory')
+        self.db_manager.execute_query('db1', "SELECT * FROM accounts", cache_tables=('accounts',))
+        assert len(self.executed) == 2
+
+        self.db_manager.invalidate_cache('db1', 'accounts')
+        self.db_manager.execute_query('db1', "SELECT * FROM accounts", cache_tables=('accounts',))
+        assert len(self.executed) == 3
+
+        stats = self.db_manager.get_cache_stats()
+        assert (stats['hits'], stats['misses'], stats['invalidations']) == (3, 2, 1)
+
+    def test_invalidation_notifies_other_workers(self):
+        """测试失效通知其他worker，处理其他worker的通知时不再转发"""
+        self.db_manager.on_invalidate = Mock()
+        self.db_manager.execute_query('db1', "SELECT * FROM accounts", cache_tables=('accounts',))
+
+        self.db_manager.invalidate_cache('db1', 'accounts', 'transaction_logs')
+        self.db_manager.on_invalidate.assert_called_once_with('db1', ('accounts', 'transaction_logs'))
+
+        self.db_manager.execute_query('db1', "SELECT * FROM accounts", cache_tables=('accounts',))
+        self.db_manager.invalidate_cache('db1', 'accounts', broadcast=False)
+        self.db_manager.execute_query('db1', "SELECT * FROM accounts", cache_tables=('accounts',))
+        assert len(self.executed) == 3
+        assert self.db_manager.on_invalidate.call_count == 1
+
+    def test_results_are_copies(self):
+        """测试调用方修改返回结果不影响缓存"""
+        rows = self.db_manager.execute_query('db1', "SELECT * FROM accounts", cache_tables=('accounts',))
+        rows[0]['balance'] = 0.0
+        rows = self.db_manager.execute_query('db1', "SELECT * FROM accounts", cache_tables=('accounts',))
+        assert rows[0]['balance'] == Decimal('100.00')
+
+    def test_invalidation_during_query_discards_result(self):
+        """测试查询期间发生失效时旧结果不写入缓存"""
+        def execute_once(node, query, params=None):
+            self.executed.append((node.node_id, query))
+            self.db_manager.invalidate_cache('db1', 'accounts')
+            return [{'id': 1}]
+
+        self.db_manager._execute_query_once = execute_once
+        self.db_manager.execute_query('db1', "SELECT * FROM accounts", cache_tables=('accounts',))
+        assert self.db_manager.get_cache_stats()['entries'] == 0
+
+    def test_recent_writer_bypasses_cache(self):
+        """测试会话刚写入节点时不读缓存"""
+        self.db_manager.execute_query('db1', "SELECT * FROM accounts", cache_tables=('accounts',))
+        session = ReadSession()
+        session.record_write('db1')
+        self.db_manager.bind_session(session)
+        try:
+            self.db_manager.execute_query('db1', "SELECT * FROM accounts", cache_tables=('accounts',))
+        finally:
+            self.db_manager.bind_session(None)
+        assert len(self.executed) == 2
+
+    def test_service_writes_invalidate_cache(self):
+        """测试转账和开户提交后使所在分片的账户缓存失效"""
+        banking_service = BankingService()
+        banking_service.shard_map = RangeShardMap([(0, 2000, 'db1'), (2000, None, 'db3')])
+        banking_service.db_manager = MagicMock()
+        banking_service.db_manager.get_connection.return_value.cursor.return_value.rowcount = 1
+
+        with patch('distributed_app.get_coordinator_log'):
+            assert banking_service.transfer_money(1001, 2001, 10) is True
+            assert banking_service.create_account(1500, 10) is True
+
+        calls = [c.args for c in banking_service.db_manager.invalidate_cache.call_args_list]
+        assert calls == [('db1', 'accounts'), ('db3', 'accounts'), ('db1', 'accounts')]
+
+class TestPagination:
+    """键集分页与流式查询测试类"""
+
+    def setup_method(self):
+        """测试前的设置"""
+        self.banking_service = BankingService()
+        self.banking_service.shard_map = RangeShardMap([(0, 2000, 'db1'), (2000, None, 'db3')])
+        self.mock_db_manager = MagicMock()
+        self.banking_service.db_manager = self.mock_db_manager
+
+    def test_accounts_page_merges_shards(self):
+        """测试账户分页合并各分片并返回下一页游标"""
+        shards = {'db1': [{'id': 1001}, {'id': 1002}, {'id': 1003}], 'db3': [{'id': 2001}]}
+        self.mock_db_manager.execute_query.side_effect = \
+            lambda node_id, sql, params, **kwargs: shards[node_id][:params[-1]]
+
+        page, next_after_id = self.banking_service.get_accounts_page(after_id=1000, limit=2)
+
+        assert [a['id'] for a in page] == [1001, 1002]
+        assert next_after_id == 1002
+        call = self.mock_db_manager.execute_query.call_args
+        assert "id > %s" in call.args[1] and call.kwargs['params'] == (1000, 3)
+
+        page, next_after_id = self.banking_service.get_accounts_page(limit=10)
+        assert len(page) == 4 and next_after_id is None
+
+    def test_iter_accounts_merges_streams_in_order(self):
+        """测试流式读取按ID归并各分片"""
+        shards = {'db1': [{'id': 1}, {'id': 1995}], 'db3': [{'id': 2003}, {'id': 2007}]}
+        self.mock_db_manager.stream_query.side_effect = lambda node_id, sql, params: iter(shards[node_id])
+
+        assert [a['id'] for a in self.banking_service.iter_accounts()] == [1, 1995, 2003, 2007]
+
+    def test_history_page_uses_descending_keyset(self):
+        """测试交易历史按ID倒序分页"""
+        self.mock_db_manager.execute_query.return_value = [{'id': 9}, {'id': 8}, {'id': 7}]
+
+        page, next_after_id = self.banking_service.get_transaction_history_page(1001, after_id=10, limit=2)
+
+        assert [row['id'] for row in page] == [9, 8]
+        assert next_after_id == 8
+        node_id, sql, params = self.mock_db_manager.execute_query.call_args.args
+        assert node_id == 'db2'
+        assert "id < %s" in sql and "ORDER BY id DESC" in sql
+        assert params == (1001, 1001, 10, 3)
+
+    def _stream_manager(self, batches):
+        """创建一个按批返回结果的数据库管理器"""
+        with patch('database_manager.mysql.connector.connect', side_effect=lambda **kw: Mock()):
+            db_manager = DatabaseManager()
+        conn = Mock()
+        conn.cursor.return_value.fetchmany.side_effect = batches
+        db_manager._checkout = Mock(return_value=conn)
+        return db_manager, conn
+
+    def test_stream_query_fetches_in_batches(self):
+        """测试流式查询使用非缓冲游标按批读取并归还连接"""
+        db_manager, conn = self._stream_manager([[{'id': 1}, {'id': 2}], [{'id': 3}], []])
+
+        rows = list(db_manager.stream_query('db1', "SELECT * FROM accounts", fetch_size=2))
+
+        assert [row['id'] for row in rows] == [1, 2, 3]
+        conn.cursor.assert_called_once_with(dictionary=True, buffered=False)
+        conn.cursor.return_value.fetchmany.assert_called_with(2)
+        conn.close.assert_called_once()
+        conn.discard.assert_not_called()
+
+    def test_abandoned_stream_discards_connection(self):
+        """测试中途停止读取时丢弃连接"""
+        db_manager, conn = self._stream_manager([[{'id': 1}, {'id': 2}], [{'id': 3}], []])
+
+        stream = db_manager.stream_query('db1', "SELECT * FROM accounts", fetch_size=2)
+        next(stream)
+        stream.close()
+
+        conn.discard.assert_called_once()
+        conn.close.assert_not_called()
+
+class TestSerialization:
+    """结果集序列化测试类"""
+
+    DESCRIPTION = [('id', FieldType.LONG), ('balance', FieldType.NEWDECIMAL),
+                   ('created_at', FieldType.TIMESTAMP), ('name', FieldType.VAR_STRING)]
+
+    def _rows(self):
+        return ResultSet([
+            {'id': 1, 'balance': Decimal('10.50'), 'created_at': datetime(2024, 1, 1), 'name': 'a'},
+            {'id': 2, 'balance': None, 'created_at': None, 'name': 'b'},
+        ], self.DESCRIPTION)
+
+    def test_converts_by_column_type(self):
+        """测试按列描述转换Decimal和时间列，其余列不变"""
+        rows = serialize_rows(self._rows())
+
+        assert rows[0] == {'id': 1, 'balance': 10.5, 'created_at': '2024-01-01T00:00:00', 'name': 'a'}
+        assert rows[1]['balance'] is None and rows[1]['created_at'] is None
+
+    def test_infers_types_without_description(self):
+        """测试没有列描述时按首行推断，首行为NULL的列逐值判断"""
+        rows = [{'id': 1, 'price': None, 'at': datetime(2024, 1, 1)},
+                {'id': 2, 'price': Decimal('1.25'), 'at': datetime(2024, 1, 2)}]
+
+        serialize_rows(rows)
+
+        assert rows[1] == {'id': 2, 'price': 1.25, 'at': '2024-01-02T00:00:00'}
+
+    def test_row_serializer_and_dumps(self):
+        """测试流式逐行转换与JSON编码"""
+        serializer = RowSerializer(self.DESCRIPTION)
+        lines = [dumps(serializer(row), fast=False) for row in self._rows()]
+
+        assert '"balance": 10.5' in lines[0]
+        assert dumps({'amount': Decimal('2.5')}, fast=False) == '{"amount": 2.5}'
+        with pytest.raises(TypeError):
+            dumps({'value': object()}, fast=False)
+
+    def test_query_results_carry_description(self):
+        """测试查询结果和缓存副本都带有列描述"""
+        with patch('database_manager.mysql.connector.connect', side_effect=lambda **kw: Mock()):
+            db_manager = DatabaseManager()
+        conn = Mock()
+        conn.cursor.return_value.fetchall.return_value = [{'id': 1, 'balance': Decimal('1.00')}]
+        conn.cursor.return_value.description = self.DESCRIPTION[:2]
+        db_manager._checkout = Mock(return_value=conn)
+
+        first = db_manager.execute_query('db1', "SELECT * FROM accounts", cache_tables=('accounts',))
+        cached = db_manager.execute_query('db1', "SELECT * FROM accounts", cache_tables=('accounts',))
+
+        assert first.description == self.DESCRIPTION[:2]
+        assert cached.description == self.DESCRIPTION[:2]
+        assert serialize_rows(cached)[0]['balance'] == 1.0
+
 class TestBankingService:
     """银行服务测试类"""
     
@@ -259,6 +1779,702 @@ class TestBankingService:
         
         assert balance is None
 
+    def _node_connections(self, debit_rows=1, credit_rows=1):
+        """为db1/db2各准备一个模拟连接，db1上依次返回扣款与入账的影响行数"""
+        db1_cursor, db2_cursor = Mock(), Mock()
+        rowcounts = iter([debit_rows, credit_rows])
+
+        def execute(sql, params=None):
+            db1_cursor.rowcount = next(rowcounts) if sql.startswith("UPDATE") else 0
+        db1_cursor.execute.side_effect = execute
+        connections = {'db1': Mock(), 'db2': Mock()}
+        connections['db1'].cursor.return_value = db1_cursor
+        connections['db2'].cursor.return_value = db2_cursor
+        self.mock_db_manager.get_connection.side_effect = lambda node_id: connections[node_id]
+        return db1_cursor, db2_cursor
+
+    def test_transfer_uses_conditional_relative_updates(self):
+        """测试转账在SQL中做条件相对更新，不再先读余额"""
+        db1_cursor, db2_cursor = self._node_connections()
+
+        with patch('distributed_app.get_coordinator_log') as mock_log:
+            result = self.banking_service.transfer_money(1001, 1002, 100.1)
+
+        assert result is True
+        statements = [c.args for c in db1_cursor.execute.call_args_list if c.args[0].startswith("UPDATE")]
+        assert statements == [
+            ("UPDATE accounts SET balance = balance - %s WHERE id = %s AND balance >= %s",
+             (Decimal('100.1'), 1001, Decimal('100.1'))),
+            ("UPDATE accounts SET balance = balance + %s WHERE id = %s", (Decimal('100.1'), 1002)),
+        ]
+        assert not any("SELECT" in c.args[0] for c in db1_cursor.execute.call_args_list)
+        mock_log.return_value.log_decision.assert_called_once()
+
+    def test_transfer_insufficient_balance_rolls_back(self):
+        """测试扣款未命中任何行时回滚且不入账"""
+        db1_cursor, db2_cursor = self._node_connections(debit_rows=0)
+
+        with patch('distributed_app.get_coordinator_log'):
+            result = self.banking_service.transfer_money(1001, 1002, 100.0)
+
+        assert result is False
+        executed = [c.args[0] for c in db1_cursor.execute.call_args_list]
+        assert not any("balance + %s" in sql for sql in executed)
+        assert any(sql.startswith("XA ROLLBACK") for sql in executed)
+        db2_cursor.execute.assert_not_called()
+
+    def test_transfer_missing_target_rolls_back(self):
+        """测试目标账户不存在时回滚扣款"""
+        db1_cursor, _ = self._node_connections(credit_rows=0)
+
+        with patch('distributed_app.get_coordinator_log'):
+            result = self.banking_service.transfer_money(1001, 9999, 100.0)
+
+        assert result is False
+        assert any(c.args[0].startswith("XA ROLLBACK") for c in db1_cursor.execute.call_args_list)
+
+    def test_transfer_locks_accounts_in_ascending_order(self):
+        """测试反向转账也按账户ID升序更新，先入账后扣款"""
+        db1_cursor, _ = self._node_connections()
+
+        with patch('distributed_app.get_coordinator_log'):
+            result = self.banking_service.transfer_money(1002, 1001, 50)
+
+        assert result is True
+        updates = [c.args[1][1] for c in db1_cursor.execute.call_args_list if c.args[0].startswith("UPDATE")]
+        assert updates == [1001, 1002]
+
+    def test_transfer_retries_on_deadlock(self):
+        """测试死锁时整体重试并计数"""
+        db1_cursor, _ = self._node_connections()
+        execute = db1_cursor.execute.side_effect
+        failures = iter([mysql.connector.errors.DatabaseError(msg="Deadlock found", errno=1213)])
+
+        def deadlock_once(sql, params=None):
+            if sql.startswith("UPDATE"):
+                error = next(failures, None)
+                if error is not None:
+                    raise error
+            execute(sql, params)
+        db1_cursor.execute.side_effect = deadlock_once
+
+        with patch('distributed_app.get_coordinator_log'), \
+             patch('distributed_app.time.sleep') as mock_sleep:
+            result = self.banking_service.transfer_money(1001, 1002, 100.0)
+
+        assert result is True
+        assert self.banking_service.retry_count == 1
+        mock_sleep.assert_called_once()
+
+    def test_transfer_does_not_retry_other_errors(self):
+        """测试非锁冲突错误不重试"""
+        db1_cursor, _ = self._node_connections()
+        db1_cursor.execute.side_effect = mysql.connector.errors.ProgrammingError(msg="bad", errno=1064)
+
+        with patch('distributed_app.get_coordinator_log'), \
+             patch('distributed_app.time.sleep') as mock_sleep:
+            result = self.banking_service.transfer_money(1001, 1002, 100.0)
+
+        assert result is False
+        assert self.banking_service.retry_count == 0
+        mock_sleep.assert_not_called()
+
+    def test_is_retryable_error_follows_exception_chain(self):
+        """测试沿异常链识别死锁与锁等待超时"""
+        for errno, expected in [(1213, True), (1205, True), (1062, False)]:
+            try:
+                try:
+                    raise mysql.connector.errors.DatabaseError(msg="lock", errno=errno)
+                except Exception as e:
+                    raise Exception(f"Operation failed on db1: {e}")
+            except Exception as wrapped:
+                assert is_retryable_error(wrapped) is expected
+
+    def test_transfer_rejects_non_positive_amount(self):
+        """测试转账金额必须为正"""
+        assert self.banking_service.transfer_money(1001, 1002, -5) is False
+        self.mock_db_manager.get_connection.assert_not_called()
+
+    @pytest.mark.parametrize('amount', ['abc', float('nan'), 'NaN', float('inf'), None])
+    def test_transfer_rejects_invalid_amount(self, amount):
+        """测试无法解析或非有限的金额返回False而不是抛出异常"""
+        assert self.banking_service.transfer_money(1001, 1002, amount) is False
+        self.mock_db_manager.get_connection.assert_not_called()
+
+class TestBulkTransfer:
+    """批量转账测试类"""
+
+    def setup_method(self):
+        """测试前的设置"""
+        self.banking_service = BankingService()
+        self.mock_db_manager = MagicMock()
+        self.banking_service.db_manager = self.mock_db_manager
+        self.balances = {1001: Decimal('100'), 1002: Decimal('0'), 1003: Decimal('50')}
+
+        self.db1_cursor, self.db2_cursor = Mock(), Mock()
+        selected = []
+
+        def execute(sql, params=None):
+            if sql.startswith("SELECT"):
+                selected[:] = [acc for acc in params if acc in self.balances]
+        self.db1_cursor.execute.side_effect = execute
+        self.db1_cursor.fetchall.side_effect = lambda: [(acc, self.balances[acc]) for acc in selected]
+        connections = {'db1': Mock(), 'db2': Mock()}
+        connections['db1'].cursor.return_value = self.db1_cursor
+        connections['db2'].cursor.return_value = self.db2_cursor
+        self.mock_db_manager.get_connection.side_effect = lambda node_id: connections[node_id]
+
+    def _statements(self, prefix):
+        """db1上以prefix开头的语句"""
+        return [c.args for c in self.db1_cursor.execute.call_args_list if c.args[0].startswith(prefix)]
+
+    def test_chunks_use_set_based_update_and_multi_row_insert(self):
+        """测试每个分块一条CASE更新和一次多行插入"""
+        transfers = [(1001, 1002, 10), (1001, 1003, 20), (1003, 1002, 5)]
+
+        with patch('distributed_app.get_coordinator_log'):
+            result = self.banking_service.transfer_many(transfers, atomic=False, chunk_size=2)
+
+        assert result['success'] is True
+        assert [r['status'] for r in result['results']] == ['committed'] * 3
+        updates = self._statements("UPDATE")
+        assert len(updates) == 2
+        assert "CASE id" in updates[0][0]
+        assert updates[0][1] == (1001, Decimal('-30'), 1002, Decimal('10'), 1003, Decimal('20'),
+                                 1001, 1002, 1003)
+        assert self.db2_cursor.executemany.call_count == 2
+        assert len(self._statements("XA COMMIT")) == 2
+
+    def test_failed_chunk_does_not_affect_other_chunks(self):
+        """测试分块模式下只回滚含无效转账的分块"""
+        transfers = [(1001, 1002, 10), (1003, 1002, 500), (1003, 1001, 5)]
+
+        with patch('distributed_app.get_coordinator_log'):
+            result = self.banking_service.transfer_many(transfers, atomic=False, chunk_size=1)
+
+        assert result['committed'] == 2
+        assert [r['status'] for r in result['results']] == ['committed', 'rejected', 'committed']
+        assert "Insufficient balance" in result['results'][1]['error']
+        assert len(self._statements("XA ROLLBACK")) == 1
+
+    def test_atomic_mode_rolls_back_everything(self):
+        """测试原子模式下任一转账无效则全部回滚"""
+        transfers = [(1001, 1002, 10), (1001, 9999, 10), (1003, 1002, 5)]
+
+        with patch('distributed_app.get_coordinator_log'):
+            result = self.banking_service.transfer_many(transfers, atomic=True, chunk_size=1)
+
+        assert result['committed'] == 0
+        assert [r['status'] for r in result['results']] == ['aborted', 'rejected', 'aborted']
+        assert "Account 9999 not found" in result['results'][1]['error']
+        assert len(self._statements("XA COMMIT")) == 0
+        self.db2_cursor.executemany.assert_called_once()
+
+    def test_invalid_amount_is_rejected_before_database(self):
+        """测试无效金额在访问数据库前被拒绝"""
+        result = self.banking_service.transfer_many([(1001, 1002, 'abc'), (1001, 1002, 1)], atomic=True)
+
+        assert [r['status'] for r in result['results']] == ['rejected', 'aborted']
+        self.mock_db_manager.get_connection.assert_not_called()
+
+    def test_non_finite_amount_is_rejected(self):
+        """测试非有限金额被拒绝，分块模式下不影响其他分块"""
+        with patch('distributed_app.get_coordinator_log'):
+            result = self.banking_service.transfer_many([(1001, 1002, float('nan')), (1001, 1002, 1)],
+                                                        atomic=False, chunk_size=1)
+
+        assert [r['status'] for r in result['results']] == ['rejected', 'committed']
+        assert "must be positive" in result['results'][0]['error']
+
+class TestTransferApi:
+    """单笔转账接口参数校验测试类"""
+
+    @pytest.mark.parametrize('amount', ['abc', '10', 0, -1, True, None])
+    def test_invalid_amount_returns_400(self, amount):
+        """测试金额不是有限正数时返回400，请求不进入银行服务"""
+        import web_interface
+        with patch.object(web_interface, 'banking_service') as service, \
+                patch.object(web_interface, 'transfer_batcher', None):
+            response = web_interface.app.test_client().post(
+                '/api/transfer', json={'from_account': 1001, 'to_account': 1002, 'amount': amount})
+
+        assert response.status_code == 400
+        assert response.get_json() == {'success': False, 'error': 'amount must be a positive number'}
+        service.transfer_money.assert_not_called()
+
+class TestBulkTransferApi:
+    """批量转账接口参数校验测试类"""
+
+    def setup_method(self):
+        """测试前的设置"""
+        import web_interface
+        self.web = web_interface
+        self.client = web_interface.app.test_client()
+
+    def _post(self, body):
+        """以模拟的银行服务提交批量转账请求"""
+        with patch.object(self.web, 'banking_service') as service:
+            service.transfer_many.return_value = {'success': True, 'results': []}
+            response = self.client.post('/api/transfers/bulk', json=body)
+        return response, service
+
+    def test_valid_request_reaches_service(self):
+        """测试有效请求交给银行服务执行"""
+        response, service = self._post({'transfers': [{'from_account': 1001, 'to_account': 1002, 'amount': 10.5}],
+                                        'chunk_size': 50})
+
+        assert response.status_code == 200
+        service.transfer_many.assert_called_once_with([(1001, 1002, 10.5)], atomic=None, chunk_size=50)
+
+    @pytest.mark.parametrize('item, error', [
+        ([1001, 1002, 10], 'transfer must be an object'),
+        ({'from_account': '1001', 'to_account': 1002, 'amount': 10}, 'from_account must be an integer'),
+        ({'from_account': 1001, 'to_account': True, 'amount': 10}, 'to_account must be an integer'),
+        ({'from_account': 1001, 'to_account': 1002, 'amount': '10'}, 'amount must be a positive number'),
+        ({'from_account': 1001, 'to_account': 1002, 'amount': 0}, 'amount must be a positive number'),
+        ({'from_account': 1001, 'to_account': 1002}, 'amount must be a positive number'),
+    ])
+    def test_invalid_item_returns_index(self, item, error):
+        """测试无效转账返回400及其序号，请求不进入数据库"""
+        valid = {'from_account': 1001, 'to_account': 1002, 'amount': 1}
+        response, service = self._post({'transfers': [valid, item]})
+
+        assert response.status_code == 400
+        assert response.get_json() == {'success': False, 'index': 1, 'error': error}
+        service.transfer_many.assert_not_called()
+
+    @pytest.mark.parametrize('options', [{'chunk_size': '10'}, {'chunk_size': 0}, {'atomic': 'yes'}])
+    def test_invalid_options_rejected(self, options):
+        """测试分块大小和原子模式参数类型错误时返回400"""
+        body = {'transfers': [{'from_account': 1001, 'to_account': 1002, 'amount': 1}], **options}
+        response, service = self._post(body)
+
+        assert response.status_code == 400
+        assert 'index' not in response.get_json()
+        service.transfer_many.assert_not_called()
+
+    def test_non_object_body_rejected(self):
+        """测试请求体不是对象时返回400"""
+        response, service = self._post([{'from_account': 1001, 'to_account': 1002, 'amount': 1}])
+
+        assert response.status_code == 400
+        service.transfer_many.assert_not_called()
+
+class TestShardMap:
+    """分片映射测试类"""
+
+    def test_range_shard_map_routes_by_interval(self):
+        """测试区间分片按左闭右开区间路由"""
+        shard_map = RangeShardMap(parse_ranges("db1:0-2000, db3:2000-"))
+
+        assert shard_map.node_for(1001) == 'db1'
+        assert shard_map.node_for(2000) == 'db3'
+        assert shard_map.node_for(10 ** 9) == 'db3'
+        assert shard_map.nodes == ['db1', 'db3']
+        with pytest.raises(ValueError):
+            shard_map.node_for(-1)
+
+    def test_range_shard_map_rejects_overlaps(self):
+        """测试重叠或无效区间被拒绝"""
+        with pytest.raises(ValueError):
+            RangeShardMap(parse_ranges("db1:0-2000,db3:1500-"))
+        with pytest.raises(ValueError):
+            parse_ranges("db1:abc-")
+
+    def test_hash_shard_map_spreads_keys_and_moves_few_on_growth(self):
+        """测试一致性哈希均匀分布，新增节点只迁移部分键"""
+        keys = range(10000)
+        two = HashShardMap(['db1', 'db3'], virtual_nodes=100)
+        three = HashShardMap(['db1', 'db3', 'db4'], virtual_nodes=100)
+
+        counts = {node: len(ids) for node, ids in two.group_by_node(keys).items()}
+        assert min(counts.values()) > 3000
+        moved = sum(1 for key in keys if two.node_for(key) != three.node_for(key))
+        assert moved < 5000
+        assert all(three.node_for(key) == 'db4' for key in keys if two.node_for(key) != three.node_for(key))
+
+    def test_default_config_keeps_accounts_on_db1(self):
+        """测试默认配置下所有账户都在db1"""
+        with patch.object(ShardConfig, 'SHARD_STRATEGY', 'range'), \
+             patch.object(ShardConfig, 'ACCOUNT_SHARD_NODES', ['db1']), \
+             patch.object(ShardConfig, 'ACCOUNT_SHARD_RANGES', ''):
+            shard_map = load_shard_map()
+
+        assert shard_map.nodes == ['db1']
+        assert shard_map.node_for(1) == 'db1'
+
+    def test_database_manager_builds_configured_nodes(self):
+        """测试数据库管理器按配置创建任意数量的节点"""
+        with patch.object(DatabaseConfig, 'DB_NODES', ['db1', 'db2', 'db3']), \
+             patch('database_manager.mysql.connector.connect', side_effect=lambda **kw: Mock()):
+            manager = DatabaseManager()
+
+        assert list(manager.nodes.keys()) == ['db1', 'db2', 'db3']
+        assert manager.nodes['db3'].config['database'] == 'db3'
+
+class TestShardedBanking:
+    """分片路由的银行服务测试类"""
+
+    def setup_method(self):
+        """测试前的设置"""
+        self.banking_service = BankingService()
+        self.banking_service.shard_map = RangeShardMap([(0, 2000, 'db1'), (2000, None, 'db3')])
+        self.mock_db_manager = MagicMock()
+        self.banking_service.db_manager = self.mock_db_manager
+
+        self.cursors = {}
+        connections = {}
+        for node_id in ('db1', 'db2', 'db3'):
+            cursor = Mock()
+            cursor.rowcount = 1
+            self.cursors[node_id] = cursor
+            connections[node_id] = Mock()
+            connections[node_id].cursor.return_value = cursor
+        self.mock_db_manager.get_connection.side_effect = lambda node_id: connections[node_id]
+
+    def _enlisted(self):
+        """被借用连接的节点"""
+        return {c.args[0] for c in self.mock_db_manager.get_connection.call_args_list}
+
+    def test_same_shard_transfer_enlists_only_that_shard(self):
+        """测试同分片转账只加入该分片和日志节点"""
+        with patch('distributed_app.get_coordinator_log'):
+            assert self.banking_service.transfer_money(1001, 1002, 10) is True
+
+        assert self._enlisted() == {'db1', 'db2'}
+
+    def test_cross_shard_transfer_updates_each_shard(self):
+        """测试跨分片转账在各自分片上扣款和入账"""
+        with patch('distributed_app.get_coordinator_log'):
+            assert self.banking_service.transfer_money(2001, 1001, 10) is True
+
+        assert self._enlisted() == {'db1', 'db2', 'db3'}
+        db1_sql = [c.args[0] for c in self.cursors['db1'].execute.call_args_list]
+        db3_sql = [c.args[0] for c in self.cursors['db3'].execute.call_args_list]
+        assert any("balance + %s" in sql for sql in db1_sql)
+        assert any("balance - %s" in sql for sql in db3_sql)
+
+    def test_get_all_accounts_merges_shards(self):
+        """测试账户列表合并所有分片并排序"""
+        self.mock_db_manager.execute_query.side_effect = lambda node_id, sql, **kwargs: {
+            'db1': [{'id': 1001}, {'id': 1500}], 'db3': [{'id': 2001}]}[node_id]
+
+        accounts = self.banking_service.get_all_accounts()
+
+        assert [a['id'] for a in accounts] == [1001, 1500, 2001]
+
+class _FakeShardCursor:
+    """内存中的账户表/路由表游标，按语句关键字模拟迁移用到的SQL"""
+
+    def __init__(self, node):
+        self.node = node
+        self.rowcount = 0
+        self._result = []
+
+    def _in_range(self, params):
+        lower = params[0]
+        upper = params[1] if len(params) > 1 and "id < %s" in self._sql else None
+        return [acc for acc in sorted(self.node.accounts)
+                if acc >= lower and (upper is None or acc < upper)]
+
+    def execute(self, sql, params=()):
+        self._sql = sql
+        statement = " ".join(sql.split())
+        if statement.startswith(("XA ", "CREATE TABLE")):
+            return
+        if statement.startswith("DELETE FROM shard_ranges"):
+            self.node.routing = []
+        elif statement.startswith("DELETE FROM accounts"):
+            ids = self._in_range(params)
+            if "LIMIT" in statement:
+                ids = ids[:params[-1]]
+            for acc in ids:
+                del self.node.accounts[acc]
+            self.rowcount = len(ids)
+        elif statement.startswith("SELECT id, balance") and "IN (" in statement:
+            self._result = [(acc, self.node.accounts[acc]) for acc in params if acc in self.node.accounts]
+        elif statement.startswith("SELECT id, balance"):
+            ids = self._in_range(params)[:params[-1]]
+            self._result = [(acc, self.node.accounts[acc]) for acc in ids]
+        elif statement.startswith("SELECT COUNT(*)"):
+            ids = self._in_range(params)
+            self._result = [(len(ids), sum(self.node.accounts[acc] for acc in ids),
+                             hash(tuple((acc, self.node.accounts[acc]) for acc in ids)))]
+        elif statement.startswith("UPDATE accounts SET balance = balance + CASE"):
+            pairs = params[:len(params) * 2 // 3]
+            for acc, delta in zip(pairs[::2], pairs[1::2]):
+                if acc in self.node.accounts:
+                    self.node.accounts[acc] += delta
+
+    def executemany(self, sql, rows):
+        if "shard_ranges" in sql:
+            self.node.routing = [{'range_start': r[0], 'range_end': r[1], 'node_id': r[2], 'mirror_node': r[3]}
+                                 for r in rows]
+        elif "INTO accounts" in sql:
+            for acc, balance in rows:
+                self.node.accounts[acc] = balance
+
+    def fetchall(self):
+        return self._result
+
+    def fetchone(self):
+        return self._result[0]
+
+    def close(self):
+        pass
+
+class _FakeShardNode:
+    """内存中的分片节点"""
+
+    def __init__(self, accounts=None):
+        self.accounts = dict(accounts or {})
+        self.routing = []
+
+    def connection(self):
+        conn = Mock()
+        conn.cursor.side_effect = lambda *args, **kwargs: _FakeShardCursor(self)
+        return conn
+
+class TestShardRebalancer:
+    """在线分片迁移测试类"""
+
+    def setup_method(self):
+        """测试前的设置"""
+        self.nodes = {
+            'db1': _FakeShardNode({acc: Decimal(acc) for acc in range(1000, 1010)}),
+            'db2': _FakeShardNode(),
+            'db3': _FakeShardNode({1005: Decimal('1')}),
+        }
+        self.db_manager = MagicMock()
+        self.db_manager.nodes = self.nodes
+        self.db_manager.get_connection.side_effect = lambda node_id: self.nodes[node_id].connection()
+        self.db_manager.execute_query.side_effect = lambda node_id, sql, params=None, **kwargs: list(self.nodes[node_id].routing)
+        self.shard_map = RangeShardMap([(0, None, 'db1')])
+        self.rebalancer = ShardRebalancer(self.db_manager, self.shard_map, coordinator_log=Mock(),
+                                          batch_size=3, throttle_ms=0, propagation_delay=0)
+
+    def test_split_and_merge_ranges(self):
+        """测试区间切分与合并"""
+        ranges = split_range([(0, None, 'db1')], 1005, 1008, 'db3')
+        assert ranges == [(0, 1005, 'db1'), (1005, 1008, 'db3'), (1008, None, 'db1')]
+        assert merge_ranges(split_range(ranges, 1005, 1008, 'db1')) == [(0, None, 'db1')]
+        with pytest.raises(ValueError):
+            split_range(ranges, 1000, 1006, 'db2')
+
+    def test_move_range_copies_verifies_and_flips_routing(self):
+        """测试迁移复制数据、校验后切换路由并清理源分片"""
+        summary = self.rebalancer.move_range(1005, 1010, 'db3')
+
+        assert summary['copied'] == 5
+        assert summary['batches'] == 2
+        assert summary['deleted'] == 5
+        assert sorted(self.nodes['db3'].accounts) == [1005, 1006, 1007, 1008, 1009]
+        assert self.nodes['db3'].accounts[1005] == Decimal(1005)
+        assert sorted(self.nodes['db1'].accounts) == [1000, 1001, 1002, 1003, 1004]
+        assert self.shard_map.node_for(1007) == 'db3'
+        assert self.shard_map.node_for(1010) == 'db1'
+        assert self.shard_map.mirrors == {}
+        assert [row['node_id'] for row in self.nodes['db2'].routing] == ['db1', 'db3', 'db1']
+
+    def test_listing_between_flip_and_purge(self):
+        """测试切换路由后、清理源分片前，迁移区间的账户在列表、分页和流式读取中只出现一次"""
+        def query_accounts(node_id, sql, params=None, **kwargs):
+            ids = sorted(self.nodes[node_id].accounts)
+            if "id > %s" in sql:
+                ids = [acc for acc in ids if acc > params[0]]
+            if "LIMIT" in sql:
+                ids = ids[:params[-1]]
+            return [{'id': acc, 'balance': self.nodes[node_id].accounts[acc]} for acc in ids]
+
+        service = BankingService()
+        service.shard_map = self.shard_map
+        service.db_manager = MagicMock()
+        service.db_manager.execute_query.side_effect = query_accounts
+        service.db_manager.stream_query.side_effect = lambda node_id, sql, params: iter(query_accounts(node_id, sql))
+
+        listed = {}
+        original_purge = self.rebalancer._purge
+
+        def list_then_purge(*args):
+            assert 1007 in self.nodes['db1'].accounts and 1007 in self.nodes['db3'].accounts
+            listed['all'] = [a['id'] for a in service.get_all_accounts()]
+            listed['stream'] = [a['id'] for a in service.iter_accounts()]
+            listed['pages'], after_id = [], None
+            while True:
+                page, after_id = service.get_accounts_page(after_id, limit=3)
+                listed['pages'].extend(a['id'] for a in page)
+                if after_id is None:
+                    break
+            return original_purge(*args)
+        self.rebalancer._purge = list_then_purge
+
+        self.rebalancer.move_range(1005, 1010, 'db3')
+
+        expected = list(range(1000, 1010))
+        assert listed == {'all': expected, 'stream': expected, 'pages': expected}
+
+    def test_checksum_mismatch_keeps_dual_write(self):
+        """测试校验和不一致时不切换路由，保持双写"""
+        original_copy = self.rebalancer._copy
+
+        def copy_then_diverge(*args):
+            result = original_copy(*args)
+            self.nodes['db3'].accounts[1006] += 1
+            return result
+        self.rebalancer._copy = copy_then_diverge
+
+        with pytest.raises(Exception, match="Checksum mismatch"):
+            self.rebalancer.move_range(1005, 1010, 'db3')
+
+        assert self.shard_map.node_for(1007) == 'db1'
+        assert self.shard_map.mirror_for(1007) == 'db3'
+        assert 1007 in self.nodes['db1'].accounts
+
+    def test_dual_write_applies_deltas_to_mirror(self):
+        """测试双写期间批量转账同时更新镜像分片"""
+        service = BankingService()
+        service.db_manager = self.db_manager
+        service.shard_map = RangeShardMap([(0, 1005, 'db1'), (1005, None, 'db1')], {1005: 'db3'})
+        self.nodes['db3'].accounts = {1006: Decimal(1006)}
+
+        with patch('distributed_app.get_coordinator_log'):
+            result = service.transfer_many([(1001, 1006, 10)], atomic=True)
+
+        assert result['success'] is True
+        assert self.nodes['db1'].accounts[1006] == Decimal(1016)
+        assert self.nodes['db3'].accounts[1006] == Decimal(1016)
+        assert self.nodes['db1'].accounts[1001] == Decimal(991)
+
+class TestTransferBatcher:
+    """转账批处理测试类"""
+
+    def _submit_concurrently(self, batcher, transfers):
+        """并发提交转账并返回各自结果"""
+        results = {}
+        threads = [threading.Thread(target=lambda t=t: results.__setitem__(t, batcher.submit(*t)))
+                   for t in transfers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_transfers_share_one_transaction(self):
+        """测试窗口内的并发转账合并为一个事务"""
+        service = Mock()
+        service._apply_transfer_batch.side_effect = lambda items: [True] * len(items)
+        batcher = TransferBatcher(service, window_ms=100, max_size=5)
+
+        transfers = [(1001, 1002, float(i + 1)) for i in range(5)]
+        results = self._submit_concurrently(batcher, transfers)
+
+        assert all(results.values())
+        assert service._apply_transfer_batch.call_count == 1
+        service.transfer_money.assert_not_called()
+
+    def test_failed_items_are_retried_alone(self):
+        """测试批内未生效的转账单独重试"""
+        service = Mock()
+        service._apply_transfer_batch.side_effect = lambda items: [item[2] != 2.0 for item in items]
+        service.transfer_money.return_value = False
+        batcher = TransferBatcher(service, window_ms=100, max_size=3)
+
+        transfers = [(1001, 1002, 1.0), (1001, 1002, 2.0), (1001, 1002, 3.0)]
+        results = self._submit_concurrently(batcher, transfers)
+
+        assert results == {(1001, 1002, 1.0): True, (1001, 1002, 2.0): False, (1001, 1002, 3.0): True}
+        service.transfer_money.assert_called_once_with(1001, 1002, 2.0)
+
+    def test_retry_does_not_stall_next_batch(self):
+        """测试单笔重试不占用批处理线程，后续批次照常执行"""
+        release = threading.Event()
+        service = Mock()
+        service._apply_transfer_batch.side_effect = lambda items: [item[2] != 1.0 for item in items]
+        service.transfer_money.side_effect = lambda *transfer: release.wait(5)
+        batcher = TransferBatcher(service, window_ms=0, max_size=1)
+
+        retried = threading.Thread(target=batcher.submit, args=(1001, 1002, 1.0))
+        retried.start()
+        try:
+            assert batcher.submit(1003, 1004, 2.0) is True
+            assert retried.is_alive()
+        finally:
+            release.set()
+            retried.join()
+        service.transfer_money.assert_called_once_with(1001, 1002, 1.0)
+
+    def test_failed_batch_falls_back_to_single_transfers(self):
+        """测试整批事务失败时逐笔重试"""
+        service = Mock()
+        service._apply_transfer_batch.side_effect = Exception("deadlock")
+        service.transfer_money.return_value = True
+        batcher = TransferBatcher(service, window_ms=100, max_size=2)
+
+        results = self._submit_concurrently(batcher, [(1001, 1002, 1.0), (1003, 1004, 1.0)])
+
+        assert all(results.values())
+        assert service.transfer_money.call_count == 2
+
+    def test_unknown_batch_outcome_is_not_retried(self):
+        """测试批次提交结果未知时不逐笔重做，提交方得到未知结果"""
+        service = Mock()
+        service._apply_transfer_batch.return_value = None
+        batcher = TransferBatcher(service, window_ms=100, max_size=2)
+
+        results = self._submit_concurrently(batcher, [(1001, 1002, 1.0), (1003, 1004, 1.0)])
+
+        assert list(results.values()) == [None, None]
+        service.transfer_money.assert_not_called()
+
+    def test_submit_timeout_reports_unknown(self):
+        """测试等待批次超时时返回未知结果而不是失败"""
+        release = threading.Event()
+        service = Mock()
+        service._apply_transfer_batch.side_effect = lambda items: release.wait() and [True] * len(items)
+        batcher = TransferBatcher(service, window_ms=0, max_size=1)
+
+        with patch.object(TransactionConfig, 'TRANSACTION_TIMEOUT', 0.1):
+            assert batcher.submit(1001, 1002, 1.0) is None
+        release.set()
+
+    def _batch_manager(self, commit_error_state):
+        """模拟批次事务：锁定余额后提交抛出异常，异常时事务处于给定状态"""
+        tm = Mock()
+        tm.execute_operation.side_effect = lambda node_id, operation, *args: (
+            {1001: Decimal(100), 1002: Decimal(0)} if operation.__name__ == '_lock_accounts' else None)
+
+        def commit():
+            tm.state = commit_error_state
+            raise Exception("commit phase failed")
+        tm.commit.side_effect = commit
+        service = BankingService()
+        service.db_manager = MagicMock()
+        return service, tm
+
+    def test_error_after_commit_decision_keeps_batch_result(self):
+        """测试提交决策落盘后的错误不使批次被当作回滚"""
+        service, tm = self._batch_manager(TransactionState.COMMITTED)
+
+        with patch('distributed_app.EnhancedTransactionManager', return_value=tm), \
+             patch('distributed_app.get_coordinator_log'):
+            applied = service._apply_transfer_batch([(1001, 1002, 10.0), (1001, 1002, 500.0)])
+
+        assert applied == [True, False]
+        tm.rollback.assert_not_called()
+
+    def test_uncertain_rollback_reports_unknown(self):
+        """测试回滚不确定时批次结果为未知，确定回滚时抛出异常"""
+        service, tm = self._batch_manager(TransactionState.ABORTED)
+
+        with patch('distributed_app.EnhancedTransactionManager', return_value=tm), \
+             patch('distributed_app.get_coordinator_log'):
+            tm.is_rolled_back.return_value = False
+            assert service._apply_transfer_batch([(1001, 1002, 10.0)]) is None
+
+            tm.is_rolled_back.return_value = True
+            with pytest.raises(Exception):
+                service._apply_transfer_batch([(1001, 1002, 10.0)])
+
 class TestInventoryService:
     """库存服务测试类"""
     
@@ -268,6 +2484,174 @@ class TestInventoryService:
             self.mock_db_manager = mock_db_manager
             self.inventory_service = InventoryService()
 
+class TestInventoryReservation:
+    """库存条件扣减与子计数器测试类"""
+
+    def setup_method(self):
+        """测试前的设置"""
+        self.inventory_service = InventoryService()
+        self.mock_db_manager = MagicMock()
+        self.inventory_service.db_manager = self.mock_db_manager
+
+    def _node_connections(self, rowcounts):
+        """为db1/db2各准备一个模拟连接，db1上的UPDATE依次返回给定的影响行数"""
+        db1_cursor, db2_cursor = Mock(), Mock()
+        rowcounts = iter(rowcounts)
+
+        def execute(sql, params=None):
+            db1_cursor.rowcount = next(rowcounts) if sql.lstrip().startswith("UPDATE") else 0
+        db1_cursor.execute.side_effect = execute
+        db2_cursor.lastrowid = 42
+        connections = {'db1': Mock(), 'db2': Mock()}
+        connections['db1'].cursor.return_value = db1_cursor
+        connections['db2'].cursor.return_value = db2_cursor
+        self.mock_db_manager.get_connection.side_effect = lambda node_id: connections[node_id]
+        return db1_cursor, db2_cursor
+
+    def test_order_uses_conditional_decrement(self):
+        """测试下单在SQL中条件扣减库存，不再先读后写"""
+        db1_cursor, db2_cursor = self._node_connections([1])
+
+        with patch('distributed_app.get_coordinator_log'):
+            result = self.inventory_service.process_order(101, 3, 2001)
+
+        assert result is True
+        statements = [c.args for c in db1_cursor.execute.call_args_list if not c.args[0].startswith("XA")]
+        assert statements == [("UPDATE inventory SET quantity = quantity - %s WHERE product_id = %s "
+                               "AND quantity >= %s", (3, 101, 3))]
+        assert any("INSERT INTO orders" in c.args[0] for c in db2_cursor.execute.call_args_list)
+        self.mock_db_manager.invalidate_cache.assert_called_once_with('db1', 'inventory')
+
+    def test_insufficient_stock_rolls_back(self):
+        """测试库存不足时回滚且不创建订单"""
+        db1_cursor, db2_cursor = self._node_connections([0])
+
+        with patch('distributed_app.get_coordinator_log'):
+            result = self.inventory_service.process_order(101, 3, 2001)
+
+        assert result is False
+        assert any(c.args[0].startswith("XA ROLLBACK") for c in db1_cursor.execute.call_args_list)
+        db2_cursor.execute.assert_not_called()
+
+    def test_order_rejects_non_positive_quantity(self):
+        """测试订单数量必须为正"""
+        assert self.inventory_service.process_order(101, 0, 2001) is False
+        self.mock_db_manager.get_connection.assert_not_called()
+
+    def test_hot_product_claims_from_stripes(self):
+        """测试热点商品先不加锁读取子计数器，只对库存充足的子计数器条件扣减"""
+        self.inventory_service.hot_products = {101: 4}
+        db1_cursor, _ = self._node_connections([1])
+        db1_cursor.fetchall.return_value = [(0, 1), (1, 5), (2, 0), (3, 1)]
+
+        with patch('distributed_app.get_coordinator_log'):
+            result = self.inventory_service.process_order(101, 2, 2001)
+
+        assert result is True
+        updates = [c.args for c in db1_cursor.execute.call_args_list if c.args[0].lstrip().startswith("UPDATE")]
+        assert len(updates) == 1 and "inventory_stripes" in updates[0][0]
+        assert updates[0][1] == (2, 101, 1, 2)
+        assert not any("FOR UPDATE" in c.args[0] for c in db1_cursor.execute.call_args_list)
+
+    def test_low_stripes_lock_in_order_without_probing(self):
+        """测试没有充足的子计数器时不逐个试探，直接按顺序锁定全部库存行"""
+        cursor = Mock()
+        cursor.rowcount = 0
+        cursor.fetchall.return_value = [(0, 1), (1, 1)]
+        cursor.fetchone.return_value = (0,)
+        conn = Mock()
+        conn.cursor.return_value = cursor
+
+        assert reserve_striped_inventory(conn, 101, 3) is False
+        statements = [c.args[0] for c in cursor.execute.call_args_list]
+        assert not any("quantity >= %s" in sql for sql in statements)
+        assert "ORDER BY stripe FOR UPDATE" in statements[1]
+
+    def test_lost_stripe_race_raises_lock_conflict(self):
+        """测试条件扣减被并发订单抢先时不在同一事务中按顺序加锁，而是抛出可重试的锁冲突"""
+        cursor = Mock()
+        cursor.rowcount = 0
+        cursor.fetchall.return_value = [(0, 3), (1, 3)]
+        conn = Mock()
+        conn.cursor.return_value = cursor
+
+        with pytest.raises(LockConflict) as exc_info:
+            reserve_striped_inventory(conn, 101, 3)
+        assert is_retryable_error(exc_info.value)
+        statements = [c.args[0] for c in cursor.execute.call_args_list]
+        assert sum("quantity >= %s" in sql for sql in statements) == 1
+        assert not any("FOR UPDATE" in sql for sql in statements)
+
+    def test_lost_stripe_race_rolls_back_before_retry(self):
+        """测试抢先失败后先回滚XA分支释放行锁，再在新事务中重新读取并扣减"""
+        self.inventory_service.hot_products = {101: 4}
+        db1_cursor, _ = self._node_connections([0, 1])
+        db1_cursor.fetchall.return_value = [(0, 5)]
+
+        with patch('distributed_app.get_coordinator_log'), patch('distributed_app.time.sleep'):
+            assert self.inventory_service.process_order(101, 2, 2001) is True
+
+        executed = [c.args[0] for c in db1_cursor.execute.call_args_list]
+        updates = [i for i, sql in enumerate(executed) if "inventory_stripes SET" in sql]
+        rollbacks = [i for i, sql in enumerate(executed) if sql.startswith("XA ROLLBACK")]
+        assert len(updates) == 2 and len(rollbacks) == 1
+        assert updates[0] < rollbacks[0] < updates[1]
+        assert not any("FOR UPDATE" in sql for sql in executed)
+        assert self.inventory_service.retry_count == 1
+
+    def test_fragmented_stripes_reserve_from_total(self):
+        """测试各子计数器都不足但合计充足时按合计扣减"""
+        cursor = Mock()
+        cursor.rowcount = 0
+        cursor.fetchall.return_value = [(0, 2), (1, 2)]
+        cursor.fetchone.return_value = (1,)
+        conn = Mock()
+        conn.cursor.return_value = cursor
+
+        assert reserve_striped_inventory(conn, 101, 4) is True
+        statements = [c.args[0] for c in cursor.execute.call_args_list]
+        assert not any("quantity >= %s" in sql for sql in statements)
+        updates = [c.args[1] for c in cursor.execute.call_args_list if c.args[0].startswith("UPDATE")]
+        assert updates == [(1, 101), (2, 101, 0), (1, 101, 1)]
+
+        cursor.execute.reset_mock()
+        assert reserve_striped_inventory(conn, 101, 6) is False
+
+    def test_reads_include_striped_stock(self):
+        """测试读取库存时计入子计数器中的库存"""
+        self.inventory_service.hot_products = {101: 4}
+        self.mock_db_manager.execute_query.side_effect = lambda node_id, query, *args, **kwargs: (
+            [{'product_id': 101, 'quantity': Decimal('37')}] if "inventory_stripes" in query
+            else [{'product_id': 101, 'quantity': 1}, {'product_id': 102, 'quantity': 200}])
+
+        inventory = self.inventory_service.get_inventory()
+
+        assert [row['quantity'] for row in inventory] == [38, 200]
+
+    def test_fold_redistributes_stripes(self):
+        """测试合并后均分到各子计数器，余数留在主库存行"""
+        cursor = Mock()
+        cursor.fetchall.return_value = [(0, 3), (1, 0)]
+        cursor.fetchone.return_value = (50,)
+        conn = Mock()
+        conn.cursor.return_value = cursor
+        db_manager = Mock()
+        db_manager.get_connection.return_value = conn
+        db_manager.execute_query.return_value = [{'product_id': 102}]
+        folder = InventoryStripeFolder(db_manager, hot_products={101: 4})
+
+        assert folder.fold(101, 4) is True
+        assert call("UPDATE inventory SET quantity = %s WHERE product_id = %s", (1, 101)) in \
+            cursor.execute.call_args_list
+        assert cursor.executemany.call_args.args[1] == [(101, stripe, 13) for stripe in range(4)]
+        conn.commit.assert_called_once()
+
+        # 已不再是热点的商品全部并回主库存行
+        with patch.object(folder, 'fold', return_value=True) as fold:
+            assert folder.fold_all() == 2
+        assert fold.call_args_list == [call(101, 4), call(102, 0)]
+        db_manager.invalidate_cache.assert_called_once_with('db1', 'inventory')
+
 class TestIntegration:
     """集成测试类"""
     
@@ -359,3 +2743,54 @@ def run_tests():
 
 if __name__ == "__main__":
     run_tests()
+
+class TestWorkerSync:
+    """多worker协调测试类"""
+
+    def _sync(self, tmp_path, client=None):
+        """以模拟的redis客户端创建同步器，文件锁放在临时目录"""
+        return WorkerSync('redis://test', lock_path=str(tmp_path / 'web.lock'),
+                          client=client or Mock(), retry_interval=0.05)
+
+    def test_messages_reach_other_workers_only(self):
+        """测试消息交给其他worker的处理函数，忽略本进程发出的消息"""
+        client = Mock()
+        sender = WorkerSync('redis://test', client=client)
+        receiver = WorkerSync('redis://test', client=client)
+        receiver.origin = 'other-worker'
+        handler = Mock()
+        receiver.on('invalidate', handler)
+        sender.on('invalidate', handler)
+
+        sender.publish('invalidate', node_id='db1', tables=['accounts'])
+        channel, data = client.publish.call_args.args
+        receiver.handle({'channel': channel, 'data': data})
+        sender.handle({'channel': channel, 'data': data})
+
+        handler.assert_called_once()
+        assert handler.call_args.args[0]['tables'] == ['accounts']
+
+    def test_publish_failure_is_not_raised(self):
+        """测试redis不可用时发布只记录警告，不影响提交方"""
+        client = Mock()
+        client.publish.side_effect = ConnectionError("redis down")
+        WorkerSync('redis://test', client=client).publish('routing')
+
+    def test_single_leader_and_takeover(self, tmp_path):
+        """测试只有一个worker成为leader，leader退出后其他worker接替"""
+        first, second = self._sync(tmp_path), self._sync(tmp_path)
+        first_tasks, second_tasks = Mock(), threading.Event()
+
+        first.start(on_elected=first_tasks)
+        second.start(on_elected=second_tasks.set)
+        try:
+            first_tasks.assert_called_once()
+            assert second.is_leader is False
+
+            first.stop()
+            assert second_tasks.wait(2)
+            assert second.is_leader is True
+        finally:
+            first.stop()
+            second.stop()
+
@@ -7,6 +7,7 @@ from mysql.connector import Error
 import uuid
 import time
 import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from typing import List, Dict, Optional, Callable, Any
 from enum import Enum
 from config import TransactionConfig
@@ -27,11 +28,52 @@ class TransactionState(Enum):
 class ParticipantState(Enum):
     """参与者状态枚举"""
     ACTIVE = "ACTIVE"
+    IDLE = "IDLE"          # 已XA END，等待一阶段提交
     PREPARED = "PREPARED"
+    READ_ONLY = "READ_ONLY"  # 只读参与者，准备阶段已提交，不参与第二阶段
+    SKIPPED = "SKIPPED"    # 未执行任何操作，已提前释放
     COMMITTED = "COMMITTED"
     ABORTED = "ABORTED"
     FAILED = "FAILED"
 
+# 可整体重试的MySQL错误：死锁（1213）与锁等待超时（1205）
+RETRYABLE_ERRNOS = (1213, 1205)
+
+class LockConflict(Exception):
+    """应用检测到的锁冲突：事务已持有的行锁可能导致死锁，须回滚整个事务释放行锁后整体重试"""
+
+def is_retryable_error(error: BaseException) -> bool:
+    """沿异常链判断失败是否由死锁、锁等待超时或应用检测到的锁冲突引起"""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, LockConflict):
+            return True
+        if isinstance(error, Error) and error.errno in RETRYABLE_ERRNOS:
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+# 所有事务共享的有界线程池，用于并行向各参与者下发2PC命令
+_participant_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+def get_participant_executor() -> ThreadPoolExecutor:
+    """获取共享的参与者线程池（延迟初始化）"""
+    global _participant_executor
+    if _participant_executor is None:
+        with _executor_lock:
+            if _participant_executor is None:
+                _participant_executor = ThreadPoolExecutor(
+                    max_workers=TransactionConfig.PARTICIPANT_WORKERS,
+                    thread_name_prefix='2pc-participant')
+    return _participant_executor
+
+def read_only_operation(func: Callable) -> Callable:
+    """标记只读操作：只执行过只读操作的参与者在准备阶段投只读票，跳过第二阶段"""
+    func.read_only = True
+    return func
+
 class TransactionParticipant:
     """事务参与者类"""
 
@@ -41,6 +83,13 @@ class TransactionParticipant:
         self.state = ParticipantState.ACTIVE
         self.xa_id = None
         self.last_operation_time = time.time()
+        # 超时后仍在执行的阶段命令（连接此时不能被其他线程使用）
+        self.pending = None
+        self.detached = False
+        # 是否通过execute_operation执行过操作
+        self.touched = False
+        # 是否只执行过只读操作
+        self.read_only = True
 
     def set_xa_id(self, xa_id: str):
         """设置XA事务ID"""
@@ -53,8 +102,14 @@ class TransactionParticipant:
 class EnhancedTransactionManager:
     """增强的分布式事务管理器"""
 
-    def __init__(self, connections: List[mysql.connector.MySQLConnection]):
-        self.transaction_id = str(uuid.uuid4())
+    def __init__(self, connections: Optional[List[mysql.connector.MySQLConnection]] = None,
+                 db_manager=None, coordinator_log=None):
+        """
+        connections: 预先获取的连接列表，参与者在begin_transaction时全部开启XA分支
+        db_manager: 数据库管理器，参与者按节点ID延迟加入，首次执行操作时才借用连接并开启XA分支
+        coordinator_log: 协调者决策日志，提交前持久化决策以便崩溃恢复
+        """
+        self.transaction_id = str(uuid.uuid1())
         self.participants: Dict[str, TransactionParticipant] = {}
         self.state = TransactionState.INIT
         self.start_time = time.time()
@@ -62,9 +117,15 @@ class EnhancedTransactionManager:
         self.prepare_timeout = TransactionConfig.PREPARE_TIMEOUT
         self._lock = threading.Lock()
         self.operations: List[Dict] = []  # 记录所有操作
+        self.one_phase = False  # 只有一个参与者写入时使用一阶段提交
+        self.decision_attempted = False  # 已尝试写入提交决策（写入失败时决策仍可能已落盘）
+
+        self.db_manager = db_manager
+        self.lazy = db_manager is not None
+        self.coordinator_log = coordinator_log
 
         # 初始化参与者
-        for i, conn in enumerate(connections):
+        for i, conn in enumerate(connections or []):
             participant_id = f"participant_{i+1}"
             self.participants[participant_id] = TransactionParticipant(participant_id, conn)
 
@@ -78,6 +139,35 @@ class EnhancedTransactionManager:
         """生成XA事务ID"""
         return f"{self.transaction_id}_{participant_id}"
 
+    def _start_participant(self, participant_id: str, participant: TransactionParticipant):
+        """为参与者开启XA分支"""
+        xa_id = self._generate_xa_id(participant_id)
+        participant.set_xa_id(xa_id)
+
+        cursor = participant.connection.cursor()
+        cursor.execute(f"XA START '{xa_id}'")
+        cursor.close()
+
+        participant.update_last_operation()
+        transaction_logger.debug(f"Started XA transaction {xa_id} for {participant_id}")
+
+    def _enlist(self, node_id: str) -> TransactionParticipant:
+        """延迟加入参与者：从数据库管理器借用连接并开启XA分支"""
+        connection = self.db_manager.get_connection(node_id)
+        participant = TransactionParticipant(node_id, connection)
+        try:
+            self._start_participant(node_id, participant)
+        except Exception:
+            try:
+                connection.close()
+            except:
+                pass
+            raise
+
+        self.participants[node_id] = participant
+        transaction_logger.debug(f"Transaction {self.transaction_id} enlisted participant {node_id}")
+        return participant
+
     def begin_transaction(self) -> bool:
         """开始分布式事务"""
         with self._lock:
@@ -88,16 +178,9 @@ class EnhancedTransactionManager:
                 raise Exception(f"Transaction {self.transaction_id} timed out before starting")
 
             try:
+                # 延迟模式下参与者在首次操作时才开启XA分支
                 for participant_id, participant in self.participants.items():
-                    xa_id = self._generate_xa_id(participant_id)
-                    participant.set_xa_id(xa_id)
-
-                    cursor = participant.connection.cursor()
-                    cursor.execute(f"XA START '{xa_id}'")
-                    cursor.close()
-
-                    participant.update_last_operation()
-                    transaction_logger.debug(f"Started XA transaction {xa_id} for {participant_id}")
+                    self._start_participant(participant_id, participant)
 
                 self.state = TransactionState.ACTIVE
                 transaction_logger.info(f"Transaction {self.transaction_id} started successfully")
@@ -118,7 +201,15 @@ class EnhancedTransactionManager:
                 raise Exception(f"Transaction {self.transaction_id} timed out")
 
             if participant_id not in self.participants:
-                raise ValueError(f"Unknown participant: {participant_id}")
+                if not self.lazy:
+                    raise ValueError(f"Unknown participant: {participant_id}")
+                try:
+                    self._enlist(participant_id)
+                except ValueError:
+                    raise
+                except Exception as e:
+                    log_system_error(f"TransactionManager.enlist.{participant_id}", str(e))
+                    raise Exception(f"Failed to enlist {participant_id}: {e}")
 
             participant = self.participants[participant_id]
 
@@ -134,6 +225,9 @@ class EnhancedTransactionManager:
                 self.operations.append(operation_record)
 
                 # 执行操作
+                participant.touched = True
+                if not getattr(operation, 'read_only', False):
+                    participant.read_only = False
                 result = operation(participant.connection, *args, **kwargs)
                 participant.update_last_operation()
 
@@ -141,7 +235,7 @@ class EnhancedTransactionManager:
                 return result
 
             except Exception as e:
-                participant.state = ParticipantState.FAILED
+                # 语句失败时XA分支仍处于活动状态，保持ACTIVE使回滚执行XA END和XA ROLLBACK释放其行锁
                 log_system_error(f"TransactionManager.execute_operation.{participant_id}", str(e))
                 raise Exception(f"Operation failed on {participant_id}: {e}")
 
@@ -155,31 +249,24 @@ class EnhancedTransactionManager:
                 raise Exception(f"Transaction {self.transaction_id} timed out")
 
             self.state = TransactionState.PREPARING
-            prepare_start_time = time.time()
-
-            try:
-                # 对所有参与者执行准备操作
-                for participant_id, participant in self.participants.items():
-                    if time.time() - prepare_start_time > self.prepare_timeout:
-                        raise Exception(f"Prepare phase timed out for transaction {self.transaction_id}")
 
-                    try:
-                        cursor = participant.connection.cursor()
-                        cursor.execute(f"XA END '{participant.xa_id}'")
-                        cursor.execute(f"XA PREPARE '{participant.xa_id}'")
-                        cursor.close()
+            # 未执行操作的参与者直接释放，只读参与者投只读票；只有一个参与者写入时跳过PREPARE，改用一阶段提交
+            written = [pid for pid, p in self.participants.items()
+                       if p.touched and not p.read_only]
+            self.one_phase = len(written) <= 1
 
-                        participant.state = ParticipantState.PREPARED
-                        participant.update_last_operation()
-                        log_transaction_prepare(self.transaction_id, participant_id, True)
-
-                    except Exception as e:
-                        participant.state = ParticipantState.FAILED
-                        log_transaction_prepare(self.transaction_id, participant_id, False)
-                        raise Exception(f"Prepare failed for {participant_id}: {e}")
+            try:
+                # 并行对所有参与者执行准备操作，每个参与者的超时从其命令开始执行时计算
+                errors = self._fan_out(self._prepare_action, self.participants,
+                                       timeout=self.prepare_timeout)
+                failed = {pid: e for pid, e in errors.items() if e is not None}
+                if failed:
+                    details = "; ".join(f"{pid}: {e}" for pid, e in failed.items())
+                    raise Exception(f"Prepare failed for {details}")
 
                 self.state = TransactionState.PREPARED
-                transaction_logger.info(f"Transaction {self.transaction_id} prepared successfully")
+                transaction_logger.info(f"Transaction {self.transaction_id} prepared successfully"
+                                      f"{' (one-phase)' if self.one_phase else ''}")
                 return True
 
             except Exception as e:
@@ -189,31 +276,169 @@ class EnhancedTransactionManager:
                 self._rollback_internal()
                 raise Exception(f"Prepare phase failed for transaction {self.transaction_id}: {e}")
 
+    def _prepare_action(self, participant_id: str, participant: TransactionParticipant):
+        """根据参与者是否写入选择释放、结束或准备"""
+        if not participant.touched:
+            self._release_participant(participant_id, participant)
+        elif participant.read_only:
+            self._finish_read_only(participant_id, participant)
+        elif self.one_phase:
+            self._end_participant(participant_id, participant)
+        else:
+            self._prepare_participant(participant_id, participant)
+
+    def _release_participant(self, participant_id: str, participant: TransactionParticipant):
+        """结束并回滚未执行任何操作的空分支"""
+        try:
+            cursor = participant.connection.cursor()
+            cursor.execute(f"XA END '{participant.xa_id}'")
+            cursor.execute(f"XA ROLLBACK '{participant.xa_id}'")
+            cursor.close()
+
+            participant.state = ParticipantState.SKIPPED
+            participant.update_last_operation()
+            transaction_logger.debug(f"Released untouched participant {participant_id}")
+
+        except Exception:
+            participant.state = ParticipantState.FAILED
+            raise
+
+    def _finish_read_only(self, participant_id: str, participant: TransactionParticipant):
+        """只读参与者直接一阶段提交，不参与第二阶段"""
+        try:
+            cursor = participant.connection.cursor()
+            cursor.execute(f"XA END '{participant.xa_id}'")
+            cursor.execute(f"XA COMMIT '{participant.xa_id}' ONE PHASE")
+            cursor.close()
+
+            participant.state = ParticipantState.READ_ONLY
+            participant.update_last_operation()
+            log_transaction_prepare(self.transaction_id, participant_id, True)
+
+        except Exception:
+            participant.state = ParticipantState.FAILED
+            log_transaction_prepare(self.transaction_id, participant_id, False)
+            raise
+
+    def _end_participant(self, participant_id: str, participant: TransactionParticipant):
+        """一阶段提交：只执行XA END，提交时使用ONE PHASE"""
+        try:
+            cursor = participant.connection.cursor()
+            cursor.execute(f"XA END '{participant.xa_id}'")
+            cursor.close()
+
+            participant.state = ParticipantState.IDLE
+            participant.update_last_operation()
+            log_transaction_prepare(self.transaction_id, participant_id, True)
+
+        except Exception:
+            participant.state = ParticipantState.FAILED
+            log_transaction_prepare(self.transaction_id, participant_id, False)
+            raise
+
+    def _prepare_participant(self, participant_id: str, participant: TransactionParticipant):
+        """对单个参与者执行XA END和XA PREPARE"""
+        try:
+            cursor = participant.connection.cursor()
+            cursor.execute(f"XA END '{participant.xa_id}'")
+            cursor.execute(f"XA PREPARE '{participant.xa_id}'")
+            cursor.close()
+
+            participant.state = ParticipantState.PREPARED
+            participant.update_last_operation()
+            log_transaction_prepare(self.transaction_id, participant_id, True)
+
+        except Exception:
+            participant.state = ParticipantState.FAILED
+            log_transaction_prepare(self.transaction_id, participant_id, False)
+            raise
+
+    def _fan_out(self, action: Callable, participants: Dict[str, TransactionParticipant],
+                 timeout: Optional[float] = None) -> Dict[str, Optional[Exception]]:
+        """
+        在共享线程池中并行执行参与者操作，返回每个参与者的异常（成功为None）。
+        timeout从操作开始执行时计时，在线程池中排队的时间不计入；排队和执行的总等待不超过事务超时时间
+        """
+        if len(participants) == 1 and timeout is None:
+            # 不限时的单个参与者直接在当前线程执行，省去线程切换
+            participant_id, participant = next(iter(participants.items()))
+            try:
+                action(participant_id, participant)
+                return {participant_id: None}
+            except Exception as e:
+                return {participant_id: e}
+
+        started: Dict[str, float] = {}
+
+        def run(participant_id: str, participant: TransactionParticipant):
+            started[participant_id] = time.monotonic()
+            action(participant_id, participant)
+
+        executor = get_participant_executor()
+        futures = {executor.submit(run, pid, participant): pid
+                   for pid, participant in participants.items()}
+        if timeout is None:
+            wait(futures)
+        else:
+            give_up = time.monotonic() + self.timeout
+            pending = set(futures)
+            while pending:
+                now = time.monotonic()
+                # 最早开始的操作到期即结束等待；尚未开始的操作开始后的到期时间不早于now + timeout
+                limit = min([started[futures[f]] + timeout for f in pending if futures[f] in started]
+                            + [give_up])
+                if now >= limit:
+                    break
+                _, pending = wait(pending, timeout=min(limit - now, timeout), return_when=FIRST_COMPLETED)
+
+        errors: Dict[str, Optional[Exception]] = {}
+        for future, participant_id in futures.items():
+            if future.done():
+                errors[participant_id] = future.exception()
+            else:
+                self.participants[participant_id].pending = future
+                errors[participant_id] = TimeoutError(f"{participant_id} did not respond within {timeout}s")
+        return errors
+
     def commit(self) -> bool:
         """第二阶段：提交事务"""
         with self._lock:
             if self.state != TransactionState.PREPARED:
                 raise Exception(f"Transaction {self.transaction_id} is not prepared")
 
+            # 两阶段提交的提交点：先持久化决策，协调者崩溃后据此恢复悬挂分支
+            if not self.one_phase and self.coordinator_log is not None:
+                prepared = [pid for pid, p in self.participants.items()
+                            if p.state == ParticipantState.PREPARED]
+                self.decision_attempted = True
+                try:
+                    self.coordinator_log.log_decision(self.transaction_id, prepared)
+                except Exception as e:
+                    log_system_error("TransactionManager.commit", str(e))
+                    self._rollback_internal()
+                    raise Exception(f"Commit phase failed for transaction {self.transaction_id}: {e}")
+
             self.state = TransactionState.COMMITTING
 
             try:
-                # 对所有参与者执行提交操作
-                for participant_id, participant in self.participants.items():
-                    try:
-                        cursor = participant.connection.cursor()
-                        cursor.execute(f"XA COMMIT '{participant.xa_id}'")
-                        cursor.close()
-
-                        participant.state = ParticipantState.COMMITTED
-                        participant.update_last_operation()
-
-                    except Exception as e:
-                        # 提交阶段的错误比较严重，但不应该阻止其他参与者提交
-                        participant.state = ParticipantState.FAILED
-                        transaction_logger.error(f"Commit failed for {participant_id}: {e}")
+                # 并行对所有参与者执行提交操作；单个参与者失败不阻止其他参与者提交
+                pending = {pid: p for pid, p in self.participants.items()
+                           if p.state in (ParticipantState.PREPARED, ParticipantState.IDLE)}
+                errors = self._fan_out(self._commit_participant, pending) if pending else {}
+                for participant_id, error in errors.items():
+                    if error is not None:
+                        transaction_logger.error(f"Commit failed for {participant_id}: {error}")
 
                 self.state = TransactionState.COMMITTED
+                # 在调用线程中记录会话写入的节点，之后的读取在窗口内走主节点
+                if self.db_manager is not None:
+                    for participant_id in pending:
+                        if self.participants[participant_id].state == ParticipantState.COMMITTED:
+                            self.db_manager.record_write(participant_id)
+                # 只有所有分支都已提交时决策才不再需要；提交失败的分支留给恢复流程按决策提交
+                if (not self.one_phase and self.coordinator_log is not None
+                        and all(self.participants[pid].state == ParticipantState.COMMITTED for pid in pending)):
+                    self.coordinator_log.log_end(self.transaction_id)
                 log_transaction_commit(self.transaction_id, True)
                 transaction_logger.info(f"Transaction {self.transaction_id} committed successfully")
                 return True
@@ -223,6 +448,24 @@ class EnhancedTransactionManager:
                 log_transaction_commit(self.transaction_id, False)
                 raise Exception(f"Commit phase failed for transaction {self.transaction_id}: {e}")
 
+    def _commit_participant(self, participant_id: str, participant: TransactionParticipant):
+        """对单个参与者执行XA COMMIT"""
+        try:
+            cursor = participant.connection.cursor()
+            if participant.state == ParticipantState.IDLE:
+                cursor.execute(f"XA COMMIT '{participant.xa_id}' ONE PHASE")
+            else:
+                cursor.execute(f"XA COMMIT '{participant.xa_id}'")
+            cursor.close()
+
+            participant.state = ParticipantState.COMMITTED
+            participant.update_last_operation()
+
+        except Exception:
+            # 提交阶段的错误比较严重，记录为失败状态
+            participant.state = ParticipantState.FAILED
+            raise
+
     def rollback(self) -> bool:
         """回滚事务"""
         with self._lock:
@@ -236,24 +479,23 @@ class EnhancedTransactionManager:
         self.state = TransactionState.ABORTING
 
         try:
-            # 对所有参与者执行回滚操作
+            # 超时未返回的参与者在其阶段命令结束后再回滚，其余参与者并行回滚
+            ready = {}
             for participant_id, participant in self.participants.items():
-                try:
-                    cursor = participant.connection.cursor()
-
-                    # 根据参与者状态选择合适的回滚命令
-                    if participant.state == ParticipantState.PREPARED:
-                        cursor.execute(f"XA ROLLBACK '{participant.xa_id}'")
-                    elif participant.state == ParticipantState.ACTIVE:
-                        cursor.execute(f"XA END '{participant.xa_id}'")
-                        cursor.execute(f"XA ROLLBACK '{participant.xa_id}'")
-
-                    cursor.close()
-                    participant.state = ParticipantState.ABORTED
-                    participant.update_last_operation()
-
-                except Exception as e:
-                    transaction_logger.error(f"Rollback failed for {participant_id}: {e}")
+                if participant.state in (ParticipantState.SKIPPED, ParticipantState.READ_ONLY):
+                    continue
+                if participant.pending is not None and not participant.pending.done():
+                    participant.detached = True
+                    participant.pending.add_done_callback(
+                        lambda _, pid=participant_id, p=participant: self._rollback_detached(pid, p))
+                else:
+                    ready[participant_id] = participant
+
+            if ready:
+                errors = self._fan_out(self._rollback_participant, ready)
+                for participant_id, error in errors.items():
+                    if error is not None:
+                        transaction_logger.error(f"Rollback failed for {participant_id}: {error}")
 
             self.state = TransactionState.ABORTED
             log_transaction_commit(self.transaction_id, False)
@@ -264,6 +506,46 @@ class EnhancedTransactionManager:
             log_system_error("TransactionManager.rollback", str(e))
             raise Exception(f"Rollback failed for transaction {self.transaction_id}: {e}")
 
+    def is_rolled_back(self) -> bool:
+        """
+        事务是否确定不会提交：没有写入提交决策的中止事务，未回滚的分支也由恢复流程回滚；
+        决策写入失败时决策可能已落盘，要求每个分支都已回滚
+        """
+        with self._lock:
+            if self.state != TransactionState.ABORTED:
+                return False
+            if not self.decision_attempted:
+                return True
+            return all(p.state in (ParticipantState.ABORTED, ParticipantState.SKIPPED, ParticipantState.READ_ONLY)
+                       for p in self.participants.values())
+
+    def _rollback_participant(self, participant_id: str, participant: TransactionParticipant):
+        """对单个参与者执行回滚"""
+        cursor = participant.connection.cursor()
+
+        # 根据参与者状态选择合适的回滚命令
+        if participant.state in (ParticipantState.PREPARED, ParticipantState.IDLE):
+            cursor.execute(f"XA ROLLBACK '{participant.xa_id}'")
+        elif participant.state == ParticipantState.ACTIVE:
+            cursor.execute(f"XA END '{participant.xa_id}'")
+            cursor.execute(f"XA ROLLBACK '{participant.xa_id}'")
+
+        cursor.close()
+        participant.state = ParticipantState.ABORTED
+        participant.update_last_operation()
+
+    def _rollback_detached(self, participant_id: str, participant: TransactionParticipant):
+        """超时参与者的阶段命令结束后回滚并释放其连接"""
+        try:
+            self._rollback_participant(participant_id, participant)
+        except Exception as e:
+            transaction_logger.error(f"Deferred rollback failed for {participant_id}: {e}")
+        finally:
+            try:
+                participant.connection.close()
+            except:
+                pass
+
     def get_transaction_info(self) -> Dict:
         """获取事务信息"""
         with self._lock:
@@ -272,6 +554,8 @@ class EnhancedTransactionManager:
                 participant_info[pid] = {
                     'state': participant.state.value,
                     'xa_id': participant.xa_id,
+                    'touched': participant.touched,
+                    'read_only': participant.read_only,
                     'last_operation_time': participant.last_operation_time
                 }
 
@@ -280,6 +564,7 @@ class EnhancedTransactionManager:
                 'state': self.state.value,
                 'start_time': self.start_time,
                 'timeout': self.timeout,
+                'one_phase': self.one_phase,
                 'participants': participant_info,
                 'operations_count': len(self.operations),
                 'elapsed_time': time.time() - self.start_time
@@ -293,8 +578,10 @@ class EnhancedTransactionManager:
         except:
             pass
 
-        # 关闭所有连接
+        # 关闭所有连接（仍在执行的参与者由延迟回滚负责释放）
         for participant in self.participants.values():
+            if participant.detached:
+                continue
             try:
                 participant.connection.close()
             except:
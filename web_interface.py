@@ -2,62 +2,178 @@
 Web可视化界面
 提供分布式数据库系统的Web管理界面
 """
-from flask import Flask, render_template, request, jsonify, redirect, url_for
-from flask_socketio import SocketIO, emit
-import json
-import threading
+from flask import (Flask, Response, render_template, request, jsonify, redirect, url_for,
+                   session, g, stream_with_context)
+from flask.json.provider import DefaultJSONProvider
+from flask_socketio import SocketIO, emit, join_room, leave_room
+import math
 import time
 from datetime import datetime
-from decimal import Decimal
-from typing import Dict, List
-from config import WebConfig
-from database_manager import get_db_manager
-from distributed_app import BankingService, InventoryService
-from logger import web_logger, log_web_request, log_system_info
-
-def convert_decimal_and_datetime(obj):
-    """转换Decimal和datetime对象为JSON可序列化的类型"""
-    if isinstance(obj, Decimal):
-        return float(obj)
-    elif isinstance(obj, datetime):
-        return obj.isoformat()
-    return obj
-
-def process_query_result(data):
-    """处理查询结果，转换Decimal和datetime类型"""
-    if isinstance(data, list):
-        for item in data:
-            if isinstance(item, dict):
-                for key, value in item.items():
-                    item[key] = convert_decimal_and_datetime(value)
-    elif isinstance(data, dict):
-        for key, value in data.items():
-            data[key] = convert_decimal_and_datetime(value)
-    return data
+from typing import Dict, Iterable, List, Optional, Tuple
+from config import WebConfig, TransactionConfig, DatabaseConfig
+from database_manager import get_db_manager, ReadSession
+from distributed_app import BankingService, InventoryService, TransferBatcher, start_inventory_folding
+from coordinator_log import recover_in_doubt_transactions
+from saga_manager import recover_sagas
+from outbox import OutboxDispatcher
+from change_feed import ChangeFeed
+from shard_map import start_routing_refresh, get_routing_refresher
+from worker_sync import create_worker_sync
+import serialization
+from serialization import RowSerializer, serialize_rows
+from logger import web_logger, log_web_request, log_system_info, log_system_error
+
+class FastJSONProvider(DefaultJSONProvider):
+    """API响应的JSON编码统一走serialization（安装orjson时使用orjson）"""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return serialization.dumps(obj)
+
+    def loads(self, s, **kwargs):
+        return serialization.loads(s)
+
+def page_args(default_limit: int = None) -> Tuple[Optional[int], Optional[int]]:
+    """解析键集分页参数 ?after_id=&limit=，返回 (after_id, limit)；未请求分页且没有默认页大小时limit为None"""
+    after_id = request.args.get('after_id', type=int)
+    limit = request.args.get('limit', type=int)
+    if after_id is None and limit is None and default_limit is None:
+        return None, None
+    limit = limit or default_limit or WebConfig.API_PAGE_SIZE
+    return after_id, max(1, min(limit, WebConfig.API_MAX_PAGE_SIZE))
+
+def _is_integer(value) -> bool:
+    """JSON整数（排除布尔值）"""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def _is_positive_amount(amount) -> bool:
+    """金额须为有限正数（JSON数字）"""
+    return (isinstance(amount, (int, float)) and not isinstance(amount, bool)
+            and math.isfinite(amount) and amount > 0)
+
+def bulk_transfer_error(items: List, chunk_size=None, atomic=None) -> Optional[Tuple[Optional[int], str]]:
+    """校验批量转账请求，返回第一个问题的 (转账序号, 原因)，与单笔转账无关的问题序号为None；请求有效时返回None"""
+    if chunk_size is not None and (not _is_integer(chunk_size) or chunk_size < 1):
+        return None, 'chunk_size must be a positive integer'
+    if atomic is not None and not isinstance(atomic, bool):
+        return None, 'atomic must be a boolean'
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            return index, 'transfer must be an object'
+        for field in ('from_account', 'to_account'):
+            if not _is_integer(item.get(field)):
+                return index, f'{field} must be an integer'
+        if not _is_positive_amount(item.get('amount')):
+            return index, 'amount must be a positive number'
+    return None
+
+def stream_requested() -> bool:
+    """是否请求NDJSON流式输出（?stream=1）"""
+    return request.args.get('stream', '').lower() in ('1', 'true')
+
+def ndjson_response(rows: Iterable[Dict], source: str) -> Response:
+    """以分块传输的NDJSON逐行输出结果，内存占用与结果集大小无关"""
+    def generate():
+        try:
+            serializer = RowSerializer()
+            for row in rows:
+                yield serialization.dumps(serializer(row)) + '\n'
+        except Exception as e:
+            # 响应头已发送，只能记录错误并提前结束输出
+            log_system_error(f"Stream {source}", str(e))
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 # 创建Flask应用
 app = Flask(__name__)
 app.config['SECRET_KEY'] = WebConfig.SECRET_KEY
+app.json = FastJSONProvider(app)
 
 # 创建SocketIO实例
+# 配置了消息队列时广播经队列发送，多个worker进程的客户端都能收到
+message_queue = WebConfig.SOCKETIO_MESSAGE_QUEUE or None
 try:
-    socketio = SocketIO(app, async_mode=WebConfig.SOCKETIO_ASYNC_MODE, cors_allowed_origins="*")
+    socketio = SocketIO(app, async_mode=WebConfig.SOCKETIO_ASYNC_MODE, cors_allowed_origins="*",
+                        message_queue=message_queue)
 except Exception as e:
     # 如果SocketIO初始化失败，尝试使用threading模式
     print(f"SocketIO初始化失败，尝试使用threading模式: {e}")
-    socketio = SocketIO(app, async_mode='threading', cors_allowed_origins="*")
+    socketio = SocketIO(app, async_mode='threading', cors_allowed_origins="*", message_queue=message_queue)
+
+# 多worker时查询缓存失效、变更通知、健康探测结果和路由变化经同一redis广播给其他worker
+worker_sync = create_worker_sync(message_queue)
 
-# 全局服务实例
+@app.context_processor
+def socketio_options():
+    """多进程部署时客户端只使用WebSocket：长轮询的后续请求可能落到其他worker，而WebSocket始终是同一个连接"""
+    return {'socketio_transports': ['websocket'] if message_queue else ['polling', 'websocket']}
+
+# 全局服务实例：提交的业务事务同时写入发件箱事件，由分发线程合并推送
 banking_service = BankingService()
+banking_service.publish_events = True
 inventory_service = InventoryService()
-
-# 全局状态存储
-system_status = {
-    'databases': {},
-    'transactions': [],
-    'last_update': None
+inventory_service.publish_events = True
+transfer_batcher = TransferBatcher(banking_service) if TransactionConfig.TRANSFER_BATCHING_ENABLED else None
+
+def system_snapshot() -> Dict:
+    """系统状态快照：各节点状态（健康检查缓存）、查询缓存和发件箱统计"""
+    snapshot = dict(get_db_manager().get_node_status())
+    snapshot['cache'] = get_db_manager().get_cache_stats()
+    snapshot['outbox'] = outbox_dispatcher.get_stats()
+    return snapshot
+
+def accounts_snapshot() -> Dict:
+    """账户快照：以账户ID为键"""
+    return {str(account['id']): account for account in serialize_rows(banking_service.get_all_accounts())}
+
+def inventory_snapshot() -> Dict:
+    """库存快照：以商品ID为键"""
+    return {str(item['product_id']): item for item in serialize_rows(inventory_service.get_inventory())}
+
+# 页面变更推送：每个间隔每个主题只计算一次快照，差异推送到订阅房间
+change_feed = ChangeFeed(lambda event, data, room: socketio.emit(event, data, to=room), {
+    'system': system_snapshot,
+    'accounts': accounts_snapshot,
+    'inventory': inventory_snapshot
+})
+
+# 发件箱事件对应的变更主题，事件推送后这些主题立即刷新
+EVENT_TOPICS = {
+    'account_created': ('accounts',),
+    'transfer_completed': ('accounts',),
+    'transfers_completed': ('accounts',),
+    'order_processed': ('inventory',)
 }
 
+def publish_event(event_type: str, payload: Dict):
+    """广播合并后的发件箱事件并通知相关主题刷新"""
+    socketio.emit(event_type, payload)
+    topics = EVENT_TOPICS.get(event_type, ())
+    change_feed.notify(*topics)
+    if worker_sync is not None and topics:
+        # 发件箱只在leader中分发，其他worker的变更推送同样立即刷新
+        worker_sync.publish('feed', topics=list(topics))
+
+outbox_dispatcher = OutboxDispatcher(publish_event)
+
+@app.before_request
+def bind_read_session():
+    """把浏览器会话记录的写入时间绑定为读会话，保证同一用户读到自己的写入"""
+    g.read_session = ReadSession(session.get('db_writes'))
+    get_db_manager().bind_session(g.read_session)
+
+@app.after_request
+def save_read_session(response):
+    """保存窗口内的写入时间并解除绑定"""
+    read_session = g.pop('read_session', None)
+    get_db_manager().bind_session(None)
+    if read_session is not None:
+        now = time.time()
+        writes = {node_id: written_at for node_id, written_at in read_session.writes.items()
+                  if now - written_at <= DatabaseConfig.READ_YOUR_WRITES_WINDOW}
+        if writes != session.get('db_writes', {}):
+            session['db_writes'] = writes
+    return response
+
 @app.route('/')
 def index():
     """主页"""
@@ -100,20 +216,61 @@ def get_system_status():
             'error': str(e)
         }), 500
 
+@app.route('/api/system/cache')
+def get_cache_status():
+    """获取查询缓存统计API"""
+    log_web_request('GET', '/api/system/cache', 200)
+    return jsonify({
+        'success': True,
+        'data': get_db_manager().get_cache_stats(),
+        'timestamp': datetime.now().isoformat()
+    })
+
+@app.route('/api/system/outbox')
+def get_outbox_status():
+    """获取发件箱事件分发统计API"""
+    log_web_request('GET', '/api/system/outbox', 200)
+    return jsonify({
+        'success': True,
+        'data': outbox_dispatcher.get_stats(),
+        'timestamp': datetime.now().isoformat()
+    })
+
+@app.route('/api/system/feed')
+def get_feed_status():
+    """获取页面变更推送统计API"""
+    log_web_request('GET', '/api/system/feed', 200)
+    return jsonify({
+        'success': True,
+        'data': change_feed.get_stats(),
+        'timestamp': datetime.now().isoformat()
+    })
+
 @app.route('/api/accounts')
 def get_accounts():
-    """获取所有账户信息"""
+    """获取账户信息：?after_id=&limit= 键集分页，?stream=1 以NDJSON流式输出"""
     try:
-        accounts = get_db_manager().execute_query('db1', "SELECT * FROM accounts ORDER BY id")
+        after_id, limit = page_args()
+        if stream_requested():
+            log_web_request('GET', '/api/accounts', 200)
+            return ndjson_response(banking_service.iter_accounts(after_id), '/api/accounts')
+
+        if limit is None:
+            accounts = banking_service.get_all_accounts()
+        else:
+            accounts, next_after_id = banking_service.get_accounts_page(after_id, limit)
 
-        # 处理Decimal和datetime类型
-        accounts = process_query_result(accounts)
+        # 按列类型转换Decimal和datetime
+        accounts = serialize_rows(accounts)
 
         log_web_request('GET', '/api/accounts', 200)
-        return jsonify({
+        result = {
             'success': True,
             'data': accounts
-        })
+        }
+        if limit is not None:
+            result['next_after_id'] = next_after_id
+        return jsonify(result)
     except Exception as e:
         log_web_request('GET', '/api/accounts', 500)
         return jsonify({
@@ -133,11 +290,6 @@ def create_account():
 
         if success:
             log_web_request('POST', '/api/accounts', 201)
-            # 通知所有客户端
-            socketio.emit('account_created', {
-                'account_id': account_id,
-                'balance': initial_balance
-            })
             return jsonify({
                 'success': True,
                 'message': f'Account {account_id} created successfully'
@@ -163,20 +315,32 @@ def transfer_money():
         data = request.get_json()
         from_account = data.get('from_account')
         to_account = data.get('to_account')
-        amount = float(data.get('amount'))
+        amount = data.get('amount')
+        # 事务模式：xa 或 saga，未指定时取配置
+        mode = data.get('mode')
+        if not _is_positive_amount(amount):
+            log_web_request('POST', '/api/transfer', 400)
+            return jsonify({
+                'success': False,
+                'error': 'amount must be a positive number'
+            }), 400
 
-        # 执行转账
-        success = banking_service.transfer_money(from_account, to_account, amount)
+        # 执行转账（启用批处理时与并发请求合并提交，批处理只用于XA模式）
+        if transfer_batcher and mode != 'saga':
+            success = transfer_batcher.submit(from_account, to_account, amount)
+        else:
+            success = banking_service.transfer_money(from_account, to_account, amount, mode=mode)
 
+        if success is None:
+            # 批次提交结果未知，客户端不应直接重试
+            log_web_request('POST', '/api/transfer', 202)
+            return jsonify({
+                'success': False,
+                'status': 'unknown',
+                'error': 'Transfer outcome unknown, check the account balances before retrying'
+            }), 202
         if success:
             log_web_request('POST', '/api/transfer', 200)
-            # 通知所有客户端
-            socketio.emit('transfer_completed', {
-                'from_account': from_account,
-                'to_account': to_account,
-                'amount': amount,
-                'timestamp': datetime.now().isoformat()
-            })
             return jsonify({
                 'success': True,
                 'message': 'Transfer completed successfully'
@@ -195,22 +359,71 @@ def transfer_money():
             'error': str(e)
         }), 500
 
+@app.route('/api/transfers/bulk', methods=['POST'])
+def transfer_many():
+    """批量转账：每个分块一个分布式事务，返回每笔转账的状态"""
+    try:
+        data = request.get_json(silent=True)
+        items = data.get('transfers') if isinstance(data, dict) else None
+        if not isinstance(items, list) or not items:
+            log_web_request('POST', '/api/transfers/bulk', 400)
+            return jsonify({
+                'success': False,
+                'error': 'transfers must be a non-empty list'
+            }), 400
+
+        # 在进入数据库前校验全部转账，返回第一个无效转账的序号
+        problem = bulk_transfer_error(items, data.get('chunk_size'), data.get('atomic'))
+        if problem:
+            index, error = problem
+            log_web_request('POST', '/api/transfers/bulk', 400)
+            response = {'success': False, 'error': error}
+            if index is not None:
+                response['index'] = index
+            return jsonify(response), 400
+
+        transfers = [(item.get('from_account'), item.get('to_account'), item.get('amount'))
+                     for item in items]
+        result = banking_service.transfer_many(transfers,
+                                               atomic=data.get('atomic'),
+                                               chunk_size=data.get('chunk_size'))
+
+        status_code = 200 if result['success'] else 400
+        log_web_request('POST', '/api/transfers/bulk', status_code)
+        return jsonify(result), status_code
+
+    except Exception as e:
+        log_web_request('POST', '/api/transfers/bulk', 500)
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
 @app.route('/api/inventory')
 def get_inventory():
-    """获取库存信息"""
+    """获取库存信息：?after_id=&limit= 键集分页，?stream=1 以NDJSON流式输出"""
     try:
-        inventory = get_db_manager().execute_query('db1', "SELECT * FROM inventory ORDER BY product_id")
+        after_id, limit = page_args()
+        if stream_requested():
+            log_web_request('GET', '/api/inventory', 200)
+            return ndjson_response(inventory_service.iter_inventory(after_id), '/api/inventory')
+
+        if limit is None:
+            inventory = inventory_service.get_inventory()
+        else:
+            inventory, next_after_id = inventory_service.get_inventory_page(after_id, limit)
 
-        # 转换Decimal类型为float，确保前端可以正确处理
-        for item in inventory:
-            if 'price' in item and item['price'] is not None:
-                item['price'] = float(item['price'])
+        # 按列类型转换Decimal和datetime
+        inventory = serialize_rows(inventory)
 
         log_web_request('GET', '/api/inventory', 200)
-        return jsonify({
+        result = {
             'success': True,
             'data': inventory
-        })
+        }
+        if limit is not None:
+            result['next_after_id'] = next_after_id
+        return jsonify(result)
     except Exception as e:
         log_web_request('GET', '/api/inventory', 500)
         return jsonify({
@@ -227,17 +440,10 @@ def process_order():
         quantity = int(data.get('quantity'))
         customer_id = data.get('customer_id')
 
-        success = inventory_service.process_order(product_id, quantity, customer_id)
+        success = inventory_service.process_order(product_id, quantity, customer_id, mode=data.get('mode'))
 
         if success:
             log_web_request('POST', '/api/orders', 200)
-            # 通知所有客户端
-            socketio.emit('order_processed', {
-                'product_id': product_id,
-                'quantity': quantity,
-                'customer_id': customer_id,
-                'timestamp': datetime.now().isoformat()
-            })
             return jsonify({
                 'success': True,
                 'message': 'Order processed successfully'
@@ -258,13 +464,21 @@ def process_order():
 
 @app.route('/api/transactions/history/<int:account_id>')
 def get_transaction_history(account_id):
-    """获取账户交易历史"""
+    """获取账户交易历史（按时间倒序）：?after_id=&limit= 键集分页，默认最近10条；?stream=1 流式输出全部"""
     try:
-        history = banking_service.get_transaction_history(account_id)
+        after_id, limit = page_args(default_limit=10)
+        if stream_requested():
+            log_web_request('GET', f'/api/transactions/history/{account_id}', 200)
+            return ndjson_response(banking_service.iter_transaction_history(account_id, after_id),
+                                   f'/api/transactions/history/{account_id}')
+
+        history, next_after_id = banking_service.get_transaction_history_page(account_id, after_id, limit)
+        history = serialize_rows(history)
         log_web_request('GET', f'/api/transactions/history/{account_id}', 200)
         return jsonify({
             'success': True,
-            'data': history
+            'data': history,
+            'next_after_id': next_after_id
         })
     except Exception as e:
         log_web_request('GET', f'/api/transactions/history/{account_id}', 500)
@@ -284,6 +498,32 @@ def handle_connect():
 def handle_disconnect():
     """客户端断开连接事件"""
     web_logger.info(f"Client disconnected: {request.sid}")
+    change_feed.unsubscribe(request.sid)
+
+def _feed_topics(data) -> List[str]:
+    """解析订阅请求中的主题列表"""
+    topics = (data or {}).get('topics', [])
+    return [topics] if isinstance(topics, str) else list(topics)
+
+@socketio.on('subscribe')
+def handle_subscribe(data):
+    """订阅变更主题：加入主题房间并发送当前完整快照"""
+    for topic in _feed_topics(data):
+        try:
+            join_room(change_feed.room(topic))
+            emit('feed_snapshot', change_feed.subscribe(request.sid, topic))
+        except Exception as e:
+            leave_room(change_feed.room(topic))
+            change_feed.unsubscribe(request.sid, [topic])
+            emit('error', {'message': str(e)})
+
+@socketio.on('unsubscribe')
+def handle_unsubscribe(data):
+    """取消订阅变更主题"""
+    topics = _feed_topics(data)
+    for topic in topics:
+        leave_room(change_feed.room(topic))
+    change_feed.unsubscribe(request.sid, topics)
 
 @socketio.on('request_status')
 def handle_status_request():
@@ -294,32 +534,58 @@ def handle_status_request():
     except Exception as e:
         emit('error', {'message': str(e)})
 
-def background_monitor():
-    """后台监控线程"""
-    while True:
-        try:
-            # 获取系统状态
-            status = get_db_manager().get_node_status()
-
-            # 广播状态更新
-            socketio.emit('system_status', {
-                'databases': status,
-                'timestamp': datetime.now().isoformat()
-            })
-
-            time.sleep(5)  # 每5秒更新一次
-
-        except Exception as e:
-            web_logger.error(f"Background monitor error: {e}")
-            time.sleep(10)
+def start_background_tasks():
+    """启动只需运行一份的后台任务（多worker时只在leader worker中运行）"""
+    db_manager = get_db_manager()
+    if worker_sync is not None:
+        # 探测结果和路由变化广播给其他worker，它们不再各自探测和轮询路由表
+        db_manager.health_monitor.on_round = lambda results: worker_sync.publish('health', results=results)
+        get_routing_refresher().on_change = lambda: worker_sync.publish('routing')
+    # 节点健康探测由数据库管理器的后台检查器负责，监控线程只读取缓存状态
+    db_manager.start_health_monitor()
+    # 定期重新加载分片路由，使在线迁移的双写和路由切换生效
+    start_routing_refresh()
+    # 定期合并热点商品的库存子计数器
+    start_inventory_folding()
+    # 推送发件箱中已提交事务的事件
+    outbox_dispatcher.start()
+    log_system_info("WebInterface", "Background tasks started")
 
 def start_background_monitor():
-    """启动后台监控"""
-    monitor_thread = threading.Thread(target=background_monitor, daemon=True)
-    monitor_thread.start()
+    """启动后台监控：变更推送在每个worker中运行，其余后台任务由leader worker运行"""
+    # 按主题计算快照并向本进程订阅的页面推送差异（取代向所有客户端广播完整状态）
+    change_feed.start()
+    if worker_sync is None:
+        start_background_tasks()
+    else:
+        db_manager = get_db_manager()
+        db_manager.on_invalidate = lambda node_id, tables: worker_sync.publish(
+            'invalidate', node_id=node_id, tables=list(tables))
+        worker_sync.on('invalidate', lambda message: db_manager.invalidate_cache(
+            message['node_id'], *message['tables'], broadcast=False))
+        worker_sync.on('health', lambda message: db_manager.health_monitor.apply_round(message['results']))
+        worker_sync.on('routing', lambda message: get_routing_refresher().refresh())
+        worker_sync.on('feed', lambda message: change_feed.notify(*message['topics']))
+        worker_sync.start(on_elected=start_background_tasks)
     log_system_info("WebInterface", "Background monitor started")
 
+def run_startup_recovery():
+    """启动时恢复协调者崩溃遗留的悬挂XA分支，并完成或补偿未结束的saga"""
+    if not TransactionConfig.RECOVER_ON_STARTUP:
+        return
+    try:
+        recover_in_doubt_transactions()
+    except Exception as e:
+        log_system_error("WebInterface.run_startup_recovery", str(e))
+    try:
+        recover_sagas()
+    except Exception as e:
+        log_system_error("WebInterface.run_startup_recovery", str(e))
+
 if __name__ == '__main__':
+    # 恢复悬挂事务
+    run_startup_recovery()
+
     # 启动后台监控
     start_background_monitor()
 
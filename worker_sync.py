@@ -0,0 +1,132 @@
+"""
+多worker协调模块
+gunicorn以多个worker进程运行Web服务时，每个worker有自己的查询缓存、节点健康状态和分片路由。
+- 查询缓存失效、变更推送通知、健康探测结果和路由变化经SOCKETIO_MESSAGE_QUEUE所在的redis频道广播到其他worker
+- 同一主机上只有持有文件锁的leader worker运行后台任务（健康检查、路由刷新、库存子计数器合并、发件箱分发）；
+  leader退出时锁随进程释放，其余worker定期尝试加锁并接替
+"""
+import fcntl
+import json
+import os
+import socket
+import threading
+from typing import Callable, Dict, Optional
+from config import WebConfig
+from logger import system_logger, log_system_info
+
+CHANNEL = 'ddbs:worker-sync'
+
+class WorkerSync:
+    """worker间同步：频道消息为 {'origin': 发送方, 'kind': 类型, ...}，忽略本进程发出的消息"""
+
+    def __init__(self, url: str, lock_path: str = None, client=None, retry_interval: float = None):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.lock_path = lock_path or WebConfig.WEB_LEADER_LOCK_FILE
+        self.retry_interval = retry_interval or WebConfig.WEB_LEADER_RETRY_INTERVAL
+        self.origin = f"{socket.gethostname()}:{os.getpid()}"
+        self.is_leader = False
+        self.published = 0
+        self.received = 0
+        self._handlers: Dict[str, Callable[[Dict], None]] = {}
+        self._lock_file = None
+        self._listener = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def on(self, kind: str, handler: Callable[[Dict], None]):
+        """登记某类消息的处理函数"""
+        self._handlers[kind] = handler
+
+    def publish(self, kind: str, **payload):
+        """向其他worker广播一条消息；redis不可用时只记录警告（其他worker的缓存最多过期TTL）"""
+        try:
+            self.client.publish(CHANNEL, json.dumps({'origin': self.origin, 'kind': kind, **payload}))
+            self.published += 1
+        except Exception as e:
+            system_logger.warning(f"Worker sync publish of {kind} failed: {e}")
+
+    def handle(self, message: Dict):
+        """处理一条频道消息"""
+        try:
+            data = json.loads(message['data'])
+            if data.get('origin') == self.origin:
+                return
+            handler = self._handlers.get(data.get('kind'))
+            if handler is not None:
+                self.received += 1
+                handler(data)
+        except Exception as e:
+            system_logger.warning(f"Worker sync message failed: {e}")
+
+    def try_lead(self) -> bool:
+        """尝试获取leader文件锁（非阻塞），进程退出时锁自动释放"""
+        if self.is_leader:
+            return True
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        self.is_leader = True
+        return True
+
+    def release(self):
+        """释放leader文件锁"""
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+        self.is_leader = False
+
+    def start(self, on_elected: Callable[[], None]):
+        """订阅频道，并在成为leader时调用on_elected（未成为leader时后台定期重试）"""
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{CHANNEL: self.handle})
+        self._listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+        if self.try_lead():
+            self._elected(on_elected)
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._campaign, args=(on_elected,), daemon=True,
+                                        name='worker-leader')
+        self._thread.start()
+
+    def stop(self):
+        """停止订阅和竞选，释放leader文件锁"""
+        self._stop.set()
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+        self.release()
+
+    def _campaign(self, on_elected: Callable[[], None]):
+        """定期尝试接替退出的leader"""
+        while not self._stop.wait(self.retry_interval):
+            if self.try_lead():
+                self._elected(on_elected)
+                return
+
+    def _elected(self, on_elected: Callable[[], None]):
+        """成为leader后启动后台任务"""
+        log_system_info("WorkerSync", f"Worker {self.origin} is the background task leader")
+        on_elected()
+
+    def get_stats(self) -> Dict:
+        """同步统计"""
+        return {
+            'origin': self.origin,
+            'leader': self.is_leader,
+            'published': self.published,
+            'received': self.received
+        }
+
+def create_worker_sync(url: Optional[str]) -> Optional['WorkerSync']:
+    """配置了消息队列且以多个worker运行时创建worker间同步，否则返回None（单进程内无需同步）"""
+    if not url or WebConfig.WEB_WORKERS <= 1:
+        return None
+    return WorkerSync(url)
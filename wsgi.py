@@ -0,0 +1,8 @@
+"""
+生产部署入口：gunicorn -c gunicorn.conf.py wsgi:app
+每个worker在fork之后导入本模块，数据库管理器和连接池都在worker进程内初始化，
+后台任务只由leader worker运行；启动恢复已由gunicorn主进程执行过一次
+"""
+from web_interface import app, start_background_monitor
+
+start_background_monitor()